@@ -0,0 +1,142 @@
+"""Landing page weight with and without the built assets.
+
+Builds the static assets into a throwaway folder and loads the landing page
+the way a browser with a 1280px wide window would: the stylesheets and
+scripts it links to, the <img> candidate its srcset and sizes pick, and
+every font the stylesheet refers to. Reports requests and bytes on the wire
+before the build (the unbundled files under /static, full-size images) and
+after it. Then checks that /assets answers brotli, gzip or plain bodies that
+decode to the same file, marks them immutable, answers If-None-Match with
+304 and does not cache a 404. Resized images need Pillow and brotli bodies
+the brotli package, as for `flask build-assets`.
+
+Usage: python benchmarks/bench_assets.py [viewport width]
+"""
+import gzip
+import os
+import re
+import sys
+import tempfile
+import time
+
+from utils import ROOT, make_app
+
+from pghr import assets
+
+CANDIDATE = re.compile(r'(\S+) (\d+)w')
+SIZE = re.compile(r'\s*(?:\(min-width: (\d+)px\)\s*)?(\d+)(px|vw)\s*$')
+COMMENT = re.compile(r'<!--.*?-->', re.S)
+TAG = re.compile(r'<(link|script|img)\b([^>]*)>')
+ATTRIBUTE = re.compile(r'''([\w-]+)="([^"]*)"''')
+
+
+def slot(sizes, viewport):
+    """Width in px that a sizes attribute gives an image at this viewport width."""
+    for condition in sizes.split(','):
+        minimum, width, unit = SIZE.match(condition).groups()
+        if minimum is None or viewport >= int(minimum):
+            return int(width) * (viewport / 100 if unit == 'vw' else 1)
+
+
+def page_resources(html, viewport):
+    """(url, eager) for every file the page makes the browser fetch."""
+    for tag, body in TAG.findall(COMMENT.sub('', html)):
+        attributes = dict(ATTRIBUTE.findall(body))
+        if tag == 'link' and attributes.get('rel') == 'stylesheet':
+            yield attributes['href'], True
+        elif tag == 'script' and 'src' in attributes:
+            yield attributes['src'], True
+        elif tag == 'img':
+            url = attributes['src']
+            candidates = sorted((int(width), candidate) for candidate, width in CANDIDATE.findall(attributes.get('srcset', '')))
+            if candidates:
+                wanted = slot(attributes['sizes'], viewport)
+                url = next((candidate for width, candidate in candidates if width >= wanted), candidates[-1][1])
+            yield url, attributes.get('loading') != 'lazy'
+
+
+def fetch(client, url):
+    response = client.get(url, headers={'Accept-Encoding': 'br, gzip'})
+    assert response.status_code == 200, (url, response.status_code)
+    return response
+
+
+def load(client, viewport):
+    """Requests and bytes to show the top of the landing page, then the whole of it."""
+    html = fetch(client, '/').get_data(as_text=True)
+    totals = {'first view': [0, 0], 'whole page': [0, 0]}
+    for url, eager in page_resources(html, viewport):
+        response = fetch(client, url)
+        fetched = [(url, response)]
+        if 'css' in response.mimetype:
+            body = decode(response)
+            folder = url.rsplit('/', 1)[0]
+            # only the fonts a browser uses: woff2 from each @font-face
+            fetched += [(font, fetch(client, folder + '/' + font)) for font in re.findall(r"url\('([^']+\.woff2)", body)]
+        for _, response in fetched:
+            for name in totals if eager else ['whole page']:
+                totals[name][0] += 1
+                totals[name][1] += len(response.data)
+    return totals
+
+
+def decode(response):
+    encoding = response.headers.get('Content-Encoding')
+    data = response.data
+    if encoding == 'br':
+        import brotli
+        data = brotli.decompress(data)
+    elif encoding == 'gzip':
+        data = gzip.decompress(data)
+    return data.decode('utf-8')
+
+
+def main():
+    viewport = int(sys.argv[1]) if len(sys.argv) > 1 else 1280
+    folder = tempfile.mkdtemp()
+    start = time.perf_counter()
+    assets.build_assets(os.path.join(ROOT, 'static'), folder)
+    print('built assets in %.1fs' % (time.perf_counter() - start))
+    app = make_app(ASSETS_FOLDER=folder)
+    client = app.test_client()
+    page_cache = app.extensions['pghr']['page_cache']
+    built = assets.manifest
+    assert built['files'], 'manifest not loaded'
+
+    # the landing page is cached with the asset names in it
+    assets.manifest = {'files': {}, 'srcsets': {}}
+    page_cache.backend.clear()
+    before = load(client, viewport)
+    assets.manifest = built
+    page_cache.backend.clear()
+    after = load(client, viewport)
+    for name in before:
+        print('%-10s at %dpx: %2d requests %8.1f kB before, %2d requests %8.1f kB after (%.1f%% of it)' % (
+            name, viewport, before[name][0], before[name][1] / 1000, after[name][0], after[name][1] / 1000, 100 * after[name][1] / before[name][1]))
+    assert after['first view'][1] < before['first view'][1] / 10
+
+    css = '/assets/' + built['files']['app.css']
+    raw = open('%s/%s' % (folder, built['files']['app.css']), encoding='utf-8').read()
+    brotli = os.path.isfile('%s/%s.br' % (folder, built['files']['app.css']))
+    for accept, encoding in (('br, gzip', 'br' if brotli else 'gzip'), ('gzip', 'gzip'), ('identity', None)):
+        response = client.get(css, headers={'Accept-Encoding': accept})
+        assert response.status_code == 200
+        assert response.headers.get('Content-Encoding') == encoding, (accept, response.headers)
+        assert response.mimetype == 'text/css'
+        assert decode(response) == raw, accept
+        assert 'Accept-Encoding' in response.vary
+        cache = response.cache_control
+        assert cache.public and cache.immutable and cache.max_age == app.config['ASSET_MAX_AGE'], response.headers['Cache-Control']
+    etag = response.headers['ETag']
+    assert client.get(css, headers={'If-None-Match': etag}).status_code == 304
+    for reference in re.findall(r"url\('([^']+)'\)", raw):
+        if not reference.startswith('data:'):
+            fetch(client, '/assets/' + re.sub(r'[?#].*', '', reference))
+    missing = client.get('/assets/app.000000000000.css')
+    assert missing.status_code == 404 and 'immutable' not in missing.headers.get('Cache-Control', '')
+    print('/assets: brotli, gzip and plain bodies match, immutable for %d days, 304 on If-None-Match, every url() in app.css found'
+          % (app.config['ASSET_MAX_AGE'] // 86400))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Restaurant order ingestion and invoicing at scale.
+
+Ingests a stream of orders (4 line items each by default) in batches through
+pghr.billing.ingest_orders, then generates a month of invoices from two
+concurrent runs, which must not invoice anyone twice, and checks that the
+running totals agree with the line items.
+
+Usage: python benchmarks/bench_billing.py [line items] [orders per batch]
+"""
+import random
+import sys
+import threading
+import time
+
+from utils import make_app
+
+from pghr.database import db
+from pghr.models import User, Mess, MenuItem, Order, OrderItem, Invoice, BillingAccount
+from pghr.billing import current_period, ingest_orders, generate_invoices
+from seed import insert
+
+USERS = 5000
+MESSES = 3
+ITEMS_PER_MESS = 20
+LINES_PER_ORDER = 4
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    batch = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    rng = random.Random(7)
+    app = make_app()
+    with app.app_context():
+        insert(User, ({'id': i, 'username': 'user%d' % i, 'email': 'user%d@pghr.local' % i, 'password': 'x', 'admin': False}
+                      for i in range(1, USERS + 1)))
+        insert(Mess, ({'id': i, 'name': 'mess %d' % i, 'description': '', 'status': 'A', 'price': 3000} for i in range(1, MESSES + 1)))
+        insert(MenuItem, ({'id': (mess - 1) * ITEMS_PER_MESS + i, 'mess_id': mess, 'name': 'item %d' % i, 'price': 20 + 5 * i, 'status': 'A'}
+                          for mess in range(1, MESSES + 1) for i in range(1, ITEMS_PER_MESS + 1)))
+        db.session.commit()
+
+        orders = []
+        for number in range(lines // LINES_PER_ORDER):
+            mess = rng.randint(1, MESSES)
+            orders.append({'reference': 'till-%d' % number, 'user_id': rng.randint(1, USERS), 'mess_id': mess,
+                           'items': [{'menu_item_id': (mess - 1) * ITEMS_PER_MESS + rng.randint(1, ITEMS_PER_MESS), 'quantity': rng.randint(1, 3)}
+                                     for _ in range(LINES_PER_ORDER)]})
+
+        start = time.perf_counter()
+        created = 0
+        for offset in range(0, len(orders), batch):
+            created += ingest_orders(orders[offset:offset + batch])['created']
+            db.session.commit()
+        elapsed = time.perf_counter() - start
+        print('ingested %d orders / %d line items in %.2fs (%.0f line items/s)' % (created, created * LINES_PER_ORDER, elapsed, created * LINES_PER_ORDER / elapsed))
+
+        start = time.perf_counter()
+        result = ingest_orders(orders[:batch])
+        db.session.commit()
+        print('re-sent a batch of %d in %.2fs: %d created, %d duplicates' % (min(batch, len(orders)), time.perf_counter() - start, result['created'], result['duplicates']))
+
+        residents = db.session.query(db.func.count(db.distinct(Order.user_id))).scalar()
+        db.session.remove()
+
+    runs = []
+
+    def run():
+        with app.app_context():
+            try:
+                runs.append(generate_invoices(current_period()))
+            except Exception as error:
+                runs.append(error)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(runs, key=str) == [0, residents], runs
+    print('two concurrent runs made %d and %d invoices in %.2fs' % (runs[0], runs[1], time.perf_counter() - start))
+
+    with app.app_context():
+
+        line_total = db.session.query(db.func.sum(OrderItem.amount)).scalar()
+        invoiced = db.session.query(db.func.sum(Invoice.total)).scalar()
+        accounts = db.session.query(db.func.sum(BillingAccount.order_total), db.func.sum(BillingAccount.invoiced_total)).one()
+        assert line_total == invoiced == accounts[0] == accounts[1], (line_total, invoiced, accounts)
+        print('line items, invoices and running totals all sum to %d' % line_total)
+
+
+if __name__ == '__main__':
+    main()
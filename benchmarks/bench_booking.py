@@ -0,0 +1,53 @@
+"""Admin booking console timings against booking counts.
+
+Usage: python benchmarks/bench_booking.py
+"""
+from utils import make_app, reset_db, login, time_get
+
+from pghr.database import db
+from pghr.models import User, Room, Mess, RoomBookings, MessBookings
+
+SCALES = [1000, 10000, 100000]
+ROOMS = 200
+STATUSES = ('pending', 'approved', 'cancelled')
+
+
+def seed(bookings):
+    reset_db()
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': 'user%d' % i, 'email': 'user%d@pghr.local' % i, 'password': 'x', 'admin': i == 1}
+        for i in range(1, bookings + 2)
+    ])
+    db.session.execute(Room.__table__.insert(), [
+        {'id': i, 'name': 'room %d' % i, 'size': 3, 'attached_bathroom': False, 'status': 'A', 'price': 5000}
+        for i in range(1, ROOMS + 1)
+    ])
+    db.session.execute(Mess.__table__.insert(), [
+        {'id': 1, 'name': 'veg', 'status': 'A', 'price': 3000},
+        {'id': 2, 'name': 'non-veg', 'status': 'A', 'price': 3500},
+    ])
+    db.session.execute(RoomBookings.__table__.insert(), [
+        {'user_id': i, 'room_id': 1 + i % ROOMS, 'status': STATUSES[i % 3]}
+        for i in range(2, bookings + 2)
+    ])
+    db.session.execute(MessBookings.__table__.insert(), [
+        {'user_id': i, 'mess_id': 1 + i % 2, 'status': STATUSES[i % 3]}
+        for i in range(2, bookings + 2)
+    ])
+    db.session.commit()
+
+
+def main():
+    app = make_app()
+    client = app.test_client()
+    urls = ['/admin/booking', '/admin/booking?status=pending', '/admin/booking?user=user500', '/admin/booking?room=7&status=approved']
+    print('%9s  %s' % ('bookings', '  '.join('%s (ms)' % url for url in urls)))
+    for bookings in SCALES:
+        with app.app_context():
+            seed(bookings)
+        login(client, 1)
+        print('%9d  %s' % (bookings, '  '.join('%*.1f' % (len(url) + 5, time_get(client, url)) for url in urls)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Concurrent booking load test: many residents race for the same room.
+
+Each thread logs in as a different resident (and some submit twice) and
+posts to /booking/<id>/room at the same moment. Afterwards the room must
+hold exactly `size` pending bookings, its occupancy counter must match, and
+no resident may have more than one booking.
+
+Usage: python benchmarks/bench_booking_race.py [threads] [beds]
+"""
+import sys
+import threading
+import time
+
+from utils import make_app, login
+
+from pghr.database import db
+from pghr.models import User, Room, RoomBookings
+
+
+def main():
+    threads = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    beds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    app = make_app()
+    with app.app_context():
+        db.session.execute(User.__table__.insert(), [
+            {'id': i, 'username': 'user%d' % i, 'email': 'user%d@pghr.local' % i, 'password': 'x', 'admin': False}
+            for i in range(1, threads + 1)
+        ])
+        db.session.add(Room(id=1, name='contested', size=beds, status='A', price=5000))
+        db.session.commit()
+
+    barrier = threading.Barrier(threads)
+    errors = []
+
+    def resident(user_id):
+        client = app.test_client()
+        login(client, user_id)
+        barrier.wait()
+        try:
+            # every fifth resident double-submits
+            for _ in range(2 if user_id % 5 == 0 else 1):
+                response = client.post('/booking/1/room')
+                assert response.status_code == 302, response.status_code
+        except Exception as error:
+            errors.append(error)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=resident, args=(i,)) for i in range(1, threads + 1)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        bookings = RoomBookings.query.filter_by(room_id=1).count()
+        per_user = db.session.query(db.func.count(RoomBookings.id)).group_by(RoomBookings.user_id).all()
+        occupancy = Room.query.get(1).occupancy
+    print('%d threads, %d beds: %d bookings, occupancy %d, %d errors, %.2fs' % (threads, beds, bookings, occupancy, len(errors), elapsed))
+    assert not errors, errors
+    assert bookings == beds == occupancy, 'room over- or under-booked'
+    assert all(count == 1 for count, in per_user), 'duplicate booking for a resident'
+    print('ok')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Monthly charge run at scale.
+
+Seeds residents with room and mess bookings that start and end at random
+points around the month, runs pghr.charges.run_charges twice, and checks
+both runs against the same proration computed in Python.
+
+Usage: python benchmarks/bench_charges.py [residents] [period]
+"""
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from utils import make_app
+
+from pghr.database import db
+from pghr.models import User, Room, Mess, RoomBookings, MessBookings, Charge
+from pghr.charges import run_charges, period_bounds
+from seed import insert
+
+ROOMS = 2000
+MESSES = 5
+
+
+def stay(rng, first):
+    """A (status, check_in, check_out) around the month starting at `first`."""
+    check_in = datetime.combine(first, datetime.min.time()) + timedelta(days=rng.randint(-90, 40), hours=rng.randint(0, 23))
+    status = rng.choice(('approved', 'approved', 'approved', 'cancelled', 'pending'))
+    check_out = check_in + timedelta(days=rng.randint(1, 120)) if status == 'cancelled' else None
+    return status, check_in, check_out
+
+
+def expected(bookings, prices, first, following):
+    total = 0
+    month_days = (following - first).days
+    for status, check_in, check_out, item_id in bookings:
+        if status == 'pending' or (status == 'cancelled' and check_out is None):
+            continue
+        start = max(check_in.date(), first)
+        end = min(check_out.date() if check_out else following, following)
+        days = (end - start).days
+        if days > 0:
+            # rounded half up, as in pghr.charges
+            total += (2 * prices[item_id] * days + month_days) // (2 * month_days)
+    return total
+
+
+def main():
+    residents = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    period = sys.argv[2] if len(sys.argv) > 2 else '2026-02'
+    first, following = period_bounds(period)
+    rng = random.Random(3)
+    app = make_app()
+    room_prices = {i: 4000 + 100 * (i % 20) for i in range(1, ROOMS + 1)}
+    mess_prices = {i: 2500 + 250 * i for i in range(1, MESSES + 1)}
+    rooms = [stay(rng, first) + (1 + i % ROOMS,) for i in range(residents)]
+    messes = [stay(rng, first) + (1 + i % MESSES,) for i in range(residents)]
+    with app.app_context():
+        insert(User, ({'id': i, 'username': 'user%d' % i, 'email': 'user%d@pghr.local' % i, 'password': 'x', 'admin': False}
+                      for i in range(1, residents + 1)))
+        insert(Room, ({'id': i, 'name': 'room %d' % i, 'size': 30, 'attached_bathroom': False, 'status': 'A', 'price': price, 'description': ''}
+                      for i, price in room_prices.items()))
+        insert(Mess, ({'id': i, 'name': 'mess %d' % i, 'description': '', 'status': 'A', 'price': price} for i, price in mess_prices.items()))
+        insert(RoomBookings, ({'user_id': i + 1, 'room_id': room_id, 'status': status, 'check_in': check_in, 'check_out': check_out, 'starts_on': check_in.date()}
+                              for i, (status, check_in, check_out, room_id) in enumerate(rooms)))
+        insert(MessBookings, ({'user_id': i + 1, 'mess_id': mess_id, 'status': status, 'check_in': check_in, 'check_out': check_out}
+                              for i, (status, check_in, check_out, mess_id) in enumerate(messes)))
+        db.session.commit()
+
+        want = expected(rooms, room_prices, first, following) + expected(messes, mess_prices, first, following)
+        for attempt in ('first run', 'second run'):
+            start = time.perf_counter()
+            run = run_charges(period)
+            print('%-10s %d charges totalling %d in %.2fs' % (attempt, run.charges, run.total, time.perf_counter() - start))
+            assert run.total == want, (run.total, want)
+        assert db.session.query(Charge).filter(Charge.period == period).count() == run.charges
+        print('totals match the Python proration (%d) and the second run changed nothing' % want)
+
+
+if __name__ == '__main__':
+    main()
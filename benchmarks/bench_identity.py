@@ -0,0 +1,48 @@
+"""Requests per second on admin routes with and without the identity cache.
+
+With the cache off every request loads the user from the database in
+load_user; with it on, only the first request does.
+
+Usage: python benchmarks/bench_identity.py [requests]
+"""
+import sys
+import time
+
+from utils import make_app, login
+
+from pghr.database import db
+from pghr.models import User
+
+URLS = ['/admin/dashboard', '/admin/metrics.json']
+
+
+def requests_per_second(client, url, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        assert client.get(url).status_code == 200, url
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    app = make_app()
+    with app.app_context():
+        db.session.add(User(id=1, username='admin', email='admin@pghr.local', password='x', admin=True))
+        db.session.commit()
+    identity_cache = app.extensions['pghr']['identity_cache']
+    client = app.test_client()
+    login(client, 1)
+
+    print('%-22s %12s %12s' % ('url', 'cache off', 'cache on'))
+    for url in URLS:
+        maxsize = identity_cache.maxsize
+        identity_cache.maxsize = 0
+        identity_cache.clear()
+        uncached = requests_per_second(client, url, count)
+        identity_cache.maxsize = maxsize
+        cached = requests_per_second(client, url, count)
+        print('%-22s %10.0f/s %10.0f/s' % (url, uncached, cached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""Login throughput under concurrent load.
+
+Seeds users with legacy sha256 hashes and runs a threaded HTTP server. The
+first pass logs every user in once, which verifies the legacy hash and
+upgrades it to PASSWORD_HASH_METHOD. The following passes hammer /login
+at increasing concurrency and report logins per second, p95 latency and how
+many requests were turned away with 503 by the hashing pool's backpressure.
+
+Usage: python benchmarks/bench_login.py [users] [seconds per level]
+"""
+import contextlib
+import http.client
+import io
+import logging
+import sys
+import threading
+import time
+import urllib.parse
+
+from utils import make_app
+
+from werkzeug.serving import make_server
+
+from pghr.database import db
+from pghr.models import User
+from seed import insert, PASSWORD
+
+from werkzeug.security import generate_password_hash
+
+LEVELS = [1, 4, 16, 64]
+
+
+def post_login(port, username):
+    """POST the login form; returns (status, seconds)."""
+    body = urllib.parse.urlencode({'username': username, 'password': PASSWORD})
+    start = time.perf_counter()
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    connection.request('POST', '/login', body, {'Content-Type': 'application/x-www-form-urlencoded'})
+    status = connection.getresponse().status
+    connection.close()
+    return status, time.perf_counter() - start
+
+
+def hammer(port, usernames, concurrency, seconds=None):
+    """Log in from `concurrency` threads, for `seconds` or once per username."""
+    results = []
+    lock = threading.Lock()
+    pending = list(usernames)
+    deadline = time.perf_counter() + seconds if seconds else None
+
+    def client(offset):
+        mine = []
+        index = offset
+        while True:
+            if deadline is None:
+                with lock:
+                    if not pending:
+                        break
+                    username = pending.pop()
+            else:
+                if time.perf_counter() >= deadline:
+                    break
+                username = usernames[index % len(usernames)]
+                index += concurrency
+            mine.append(post_login(port, username))
+        with lock:
+            results.extend(mine)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(offset,)) for offset in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - started
+
+
+def report(label, results, elapsed):
+    ok = sorted(seconds for status, seconds in results if status == 302)
+    busy = sum(1 for status, _ in results if status == 503)
+    failed = len(results) - len(ok) - busy
+    p95 = ok[min(len(ok) - 1, int(0.95 * (len(ok) - 1)))] * 1000 if ok else 0.0
+    print('%-18s %10.1f/s %10.1f ms %8d %8d' % (label, len(ok) / elapsed, p95, busy, failed))
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 3.0
+    app = make_app()
+    legacy = generate_password_hash(PASSWORD, method='sha256')
+    with app.app_context():
+        insert(User, ({'id': i, 'username': 'user%d' % i, 'email': 'user%d@pghr.local' % i, 'password': legacy, 'admin': False}
+                      for i in range(1, users + 1)))
+        db.session.commit()
+    password_hasher = app.extensions['pghr']['password_hasher']
+    usernames = ['user%d' % i for i in range(1, users + 1)]
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('hasher: %(method)s, %(workers)d %(pool)s workers' % password_hasher.stats())
+    print('%-18s %12s %13s %8s %8s' % ('pass', 'logins', 'p95', '503s', 'failed'))
+    # the login view prints form errors on GETs; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        results, elapsed = hammer(server.server_port, usernames, 8)
+    report('rehash (c=8)', results, elapsed)
+    with app.app_context():
+        upgraded = User.query.filter(User.password.like(password_hasher.method + '$%')).count()
+    print('%d of %d hashes upgraded' % (upgraded, users))
+    for concurrency in LEVELS:
+        with contextlib.redirect_stdout(io.StringIO()):
+            results, elapsed = hammer(server.server_port, usernames, concurrency, seconds)
+        report('c=%d' % concurrency, results, elapsed)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
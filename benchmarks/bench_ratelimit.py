@@ -0,0 +1,151 @@
+"""Rate limits on login, signup, booking and tickets.
+
+Runs the app with the default RATE_LIMITS and checks that
+  - a burst of failed logins from one address gets 429 with Retry-After
+    once the address's bucket is empty, and rejected requests run no SQL
+    and no password hashing
+  - guessing one account's password from one address is stopped by that
+    address's bucket for the account, and the owner still logs in from
+    another address
+  - guessing one account's password from many addresses is stopped by the
+    looser per-username cap, while other accounts still log in
+  - booking and ticket posts are limited per logged-in account
+  - GET requests to the same pages are not limited
+  - /admin/ratelimits counts what was allowed and rejected
+Then times one check in each backend, and has several processes share one
+bucket through the sqlite backend to show that they never let more than its
+burst through together.
+
+Usage: python benchmarks/bench_ratelimit.py [failed logins]
+"""
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from utils import make_app, login
+
+from flask import Flask
+from sqlalchemy import event
+from pghr.database import db
+from pghr.ratelimit import MemoryBackend, RateLimiter, SQLiteBackend, parse_limit
+from seed import seed, PASSWORD
+
+
+def post_login(client, username, password, address):
+    start = time.perf_counter()
+    response = client.post('/login', data={'username': username, 'password': password}, environ_base={'REMOTE_ADDR': address})
+    return response, (time.perf_counter() - start) * 1000
+
+
+def shared_bucket(path, checks, results):
+    app = Flask('shared')
+    limiter = RateLimiter(SQLiteBackend(path), {'login': {'ip': '50/hour'}})
+    allowed = 0
+    with app.test_request_context('/login', method='POST', environ_base={'REMOTE_ADDR': '10.9.9.9'}):
+        for _ in range(checks):
+            allowed += not limiter.check('login')
+    results.put(allowed)
+
+
+def check_timing(limiter, app, repeat=20000):
+    with app.test_request_context('/login', method='POST', data={'username': 'user2'}, environ_base={'REMOTE_ADDR': '10.1.1.1'}):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            limiter.check('login')
+        return (time.perf_counter() - start) / repeat * 1e6
+
+
+def main():
+    attempts = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    app = make_app(RATE_LIMITING=True)
+    with app.app_context():
+        seed(users=50, rooms=5, messes=2, bookings=0, tickets=0, replies=0, announcements=0)
+        db.session.remove()
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    client = app.test_client()
+    ip_burst = parse_limit(app.config['RATE_LIMITS']['login']['ip'])[0]
+    account_burst = parse_limit(app.config['RATE_LIMITS']['login']['account'])[0]
+    username_burst = parse_limit(app.config['RATE_LIMITS']['login']['username'])[0]
+
+    # one address tries many accounts
+    allowed, rejected = [], []
+    for number in range(attempts):
+        statements.clear()
+        response, ms = post_login(client, 'user%d' % (2 + number % 40), 'wrong-password', '10.0.0.1')
+        if response.status_code == 429:
+            # the password is only checked against the user row, so no SQL means no hashing either
+            assert not statements, statements
+            assert int(response.headers['Retry-After']) >= 1
+            rejected.append(ms)
+        else:
+            assert response.status_code == 200 and b'Invalid' in response.data, response.status_code
+            allowed.append(ms)
+    assert len(allowed) == ip_burst, len(allowed)
+    print('%d failed logins from one address: %d checked (p50 %.1fms with SQL and a hash), %d rejected with 429 (p50 %.3fms, no SQL)'
+          % (attempts, len(allowed), statistics.median(allowed), len(rejected), statistics.median(rejected)))
+
+    # one address tries one account; its owner is elsewhere
+    codes = [post_login(client, 'user44', 'wrong-password', '10.0.4.1')[0].status_code for _ in range(account_burst + 5)]
+    assert codes.count(200) == account_burst and codes.count(429) == 5, codes
+    response, ms = post_login(client, 'user44', PASSWORD, '10.0.4.2')
+    assert response.status_code == 302, 'the owner is locked out by guesses from another address'
+    print('%d guesses at one account from one address: %d checked, the rest rejected; the owner still logs in'
+          % (account_burst + 5, account_burst))
+
+    # many addresses try one account
+    client = app.test_client()
+    tries = username_burst + 10
+    codes = [post_login(client, 'user45', 'wrong-password', '10.0.%d.%d' % (5 + number // 250, 1 + number % 250))[0].status_code
+             for number in range(tries)]
+    assert codes.count(200) == username_burst and codes.count(429) == 10, codes
+    response, ms = post_login(client, 'user45', PASSWORD, '10.0.2.1')
+    assert response.status_code == 429, 'the right password is refused too while the username is limited'
+    response, ms = post_login(client, 'user46', PASSWORD, '10.0.2.2')
+    assert response.status_code == 302, 'another account from a fresh address'
+    print('%d addresses guessing one account: %d checked, the rest rejected; other accounts still log in' % (tries, username_burst))
+
+    # logged-in posts are limited per account, whatever the address
+    resident = app.test_client()
+    login(resident, 7)
+    burst = parse_limit(app.config['RATE_LIMITS']['ticket']['account'])[0]
+    codes = [resident.post('/ticket', data={'title': 'leak %d' % number, 'description': 'tap leaking'},
+                           environ_base={'REMOTE_ADDR': '10.0.3.%d' % number}).status_code for number in range(1, 20)]
+    assert codes.count(302) == burst and codes.count(429) == 19 - burst, codes
+    assert resident.get('/ticket').status_code == 200, 'GET limited'
+    burst = parse_limit(app.config['RATE_LIMITS']['booking']['account'])[0]
+    codes = [resident.post('/booking/%d/mess' % (1 + number % 2)).status_code for number in range(20)]
+    assert codes.count(302) == burst and codes.count(429) == 20 - burst, codes
+    print('ticket and booking posts limited per account; GETs never limited')
+
+    admin = app.test_client()
+    login(admin, 1)
+    stats = admin.get('/admin/ratelimits').get_json()
+    assert stats['checks']['login:ip']['rejected'] == len(rejected), stats['checks']
+    assert stats['top_rejected'][0]['key'] == 'login:ip:10.0.0.1', stats['top_rejected']
+    text = admin.get('/admin/ratelimits.txt').get_data(as_text=True)
+    assert 'pghr_rate_limit_checks_total{group="login",scope="ip",outcome="rejected"} %d' % len(rejected) in text
+    print('/admin/ratelimits: %s' % ', '.join('%s %d/%d' % (name, counts['allowed'], counts['rejected']) for name, counts in sorted(stats['checks'].items())))
+
+    path = os.path.join(tempfile.mkdtemp(), 'ratelimit.db')
+    limits = {'login': {'ip': '1000000/second', 'account': '1000000/second', 'username': '1000000/second'}}
+    memory_us = check_timing(RateLimiter(MemoryBackend(), limits), app)
+    sqlite_us = check_timing(RateLimiter(SQLiteBackend(path), limits), app, 2000)
+    print('one login check (address, account and username): %.1fus in memory, %.1fus in the shared sqlite file' % (memory_us, sqlite_us))
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=shared_bucket, args=(path, 40, results)) for _ in range(4)]
+    for process in processes:
+        process.start()
+    allowed = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    assert allowed == 50, allowed
+    print('4 processes sharing a 50/hour bucket through sqlite let %d of 160 checks through' % allowed)
+
+
+if __name__ == '__main__':
+    main()
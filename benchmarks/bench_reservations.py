@@ -0,0 +1,111 @@
+"""Date-ranged reservations against a day-by-day recount.
+
+Residents request random stays (some open-ended) in a few small rooms through
+pghr.bookings.book_room, from many threads at once, and some are cancelled
+again. Afterwards no room may have more bookings than beds on any day, and
+the reservation book must answer "is room X free for [a, b)" exactly like a
+day-by-day count over the bookings table, for random windows. Also times
+those answers.
+
+Usage: python benchmarks/bench_reservations.py [requests] [rooms]
+"""
+import random
+import statistics
+import sys
+import threading
+import time
+from datetime import date, timedelta
+
+from utils import make_app
+
+from pghr.database import db
+from pghr.models import User, Room, RoomBookings
+from pghr.bookings import BookingError, book_room, set_room_booking_status
+from pghr.reservations import DAYS, HOLDING_STATUSES, book, stay_days
+from seed import insert
+
+HORIZON = 120  # days ahead that stays start in
+
+
+def random_stay(rng, today):
+    starts_on = today + timedelta(days=rng.randint(0, HORIZON))
+    ends_on = None if rng.random() < 0.1 else starts_on + timedelta(days=rng.randint(1, 30))
+    return starts_on, ends_on
+
+
+def counted(stays, size, start, end):
+    """Brute force: is a bed free on every day of [start, end)?"""
+    # the count only changes on days where a stay starts or ends, so later days repeat the last one
+    changes = [s for s, e in stays] + [e for s, e in stays if e < DAYS]
+    last = min(end, max(changes + [start]) + 1)
+    return all(sum(1 for s, e in stays if s <= day < e) < size for day in range(start, last))
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rooms = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    rng = random.Random(9)
+    today = date.today()
+    app = make_app()
+    app.config['AVAILABILITY_MAX_AGE'] = 3600
+    with app.app_context():
+        insert(User, ({'id': i, 'username': 'user%d' % i, 'email': 'user%d@pghr.local' % i, 'password': 'x', 'admin': False}
+                      for i in range(1, requests + 1)))
+        insert(Room, ({'id': i, 'name': 'room %d' % i, 'size': 1 + i % 3, 'attached_bathroom': False, 'status': 'A', 'price': 5000, 'description': ''}
+                      for i in range(1, rooms + 1)))
+        db.session.commit()
+        sizes = dict(db.session.query(Room.id, Room.size))
+
+    stays = [(user_id, rng.randint(1, rooms)) + random_stay(rng, today) for user_id in range(1, requests + 1)]
+    outcomes = {'booked': 0, 'refused': 0}
+    lock = threading.Lock()
+
+    def resident(chunk):
+        with app.app_context():
+            for user_id, room_id, starts_on, ends_on in chunk:
+                try:
+                    book_room(user_id, room_id, starts_on, ends_on)
+                    outcome = 'booked'
+                except BookingError:
+                    outcome = 'refused'
+                with lock:
+                    outcomes[outcome] += 1
+            db.session.remove()
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=resident, args=(stays[i::8],)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print('%d stay requests from 8 threads in %.2fs: %d booked, %d refused' % (requests, time.perf_counter() - start, outcomes['booked'], outcomes['refused']))
+
+    with app.test_request_context():
+        for booking in RoomBookings.query.filter(RoomBookings.id % 5 == 0):
+            set_room_booking_status(booking, 'cancelled')
+        db.session.commit()
+
+        held = {}
+        for room_id, starts_on, ends_on in db.session.query(RoomBookings.room_id, RoomBookings.starts_on, RoomBookings.ends_on) \
+                .filter(RoomBookings.status.in_(HOLDING_STATUSES)):
+            held.setdefault(room_id, []).append(stay_days(starts_on, ends_on))
+        first, last = stay_days(today, today + timedelta(days=HORIZON + 31))
+        for room_id, room_stays in held.items():
+            for day in range(first, last):
+                assert sum(1 for s, e in room_stays if s <= day < e) <= sizes[room_id], (room_id, day)
+        print('no room is over capacity on any day')
+
+        book.refresh(0)
+        windows = [(rng.randint(1, rooms),) + random_stay(rng, today) for _ in range(2000)]
+        timings = []
+        for room_id, starts_on, ends_on in windows:
+            began = time.perf_counter()
+            free = book.is_free(room_id, sizes[room_id], starts_on, ends_on)
+            timings.append((time.perf_counter() - began) * 1e6)
+            assert free == counted(held.get(room_id, []), sizes[room_id], *stay_days(starts_on, ends_on)), (room_id, starts_on, ends_on)
+        print('%d "is room X free for [a, b)" answers match a day-by-day count; p50 %.1fus, max %.1fus'
+              % (len(windows), statistics.median(timings), max(timings)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+"""Room availability search at scale.
+
+Seeds rooms of mixed size, price and bathroom with some beds already booked,
+builds the availability index and reservation book, and times searches with
+different filters through pghr.availability.search_rooms. Every page is checked against the
+same filter written as SQL over the room table. Then books, approves and
+cancels through pghr.bookings and checks the index follows without a full
+reload.
+
+Usage: python benchmarks/bench_room_search.py [rooms]
+"""
+import random
+import statistics
+import sys
+import time
+
+from utils import make_app
+
+from pghr.database import db
+from pghr.models import User, Room, RoomBookings
+from pghr.availability import index, search_rooms
+from pghr.reservations import book
+from pghr.bookings import book_room, set_room_booking_status, rebuild_occupancy
+from seed import insert
+
+USERS = 2000
+
+SEARCHES = [
+    {},
+    {'order': '-price'},
+    {'min_price': 5000, 'max_price': 6000},
+    {'size': 3, 'bathroom': True},
+    {'bathroom': False, 'min_free': 2, 'order': '-price'},
+    {'min_price': 7900, 'size': 6, 'min_free': 6},
+]
+
+
+def expected(min_price=None, max_price=None, size=None, bathroom=None, min_free=1, order='price'):
+    """The same search as SQL: (id, price) of every match in order."""
+    query = db.session.query(Room.id, Room.price).filter(Room.status == 'A', Room.size - Room.occupancy >= min_free)
+    if min_price is not None:
+        query = query.filter(Room.price >= min_price)
+    if max_price is not None:
+        query = query.filter(Room.price <= max_price)
+    if size is not None:
+        query = query.filter(Room.size == size)
+    if bathroom is not None:
+        query = query.filter(Room.attached_bathroom == bathroom)
+    if order == '-price':
+        return query.order_by(Room.price.desc(), Room.id.desc()).all()
+    return query.order_by(Room.price, Room.id).all()
+
+
+def all_pages(search, limit):
+    found, cursor = [], None
+    while True:
+        rooms, cursor = search_rooms(cursor=cursor, limit=limit, **search)
+        found.extend((id, price) for id, name, price, size, bathroom, free in rooms)
+        if cursor is None:
+            return found
+
+
+def main():
+    rooms = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    rng = random.Random(5)
+    app = make_app()
+    # only the writes below may refresh the index during the run
+    app.config['AVAILABILITY_MAX_AGE'] = 3600
+    with app.test_request_context():
+        sizes = [rng.randint(1, 6) for _ in range(rooms)]
+        # fill some beds without going through the booking engine; residents come after USERS
+        taken = [room_id for room_id, size in enumerate(sizes, 1) for _ in range(rng.randint(0, size))]
+        insert(User, ({'id': i, 'username': 'user%d' % i, 'email': 'user%d@pghr.local' % i, 'password': 'x', 'admin': False}
+                      for i in range(1, USERS + len(taken) + 1)))
+        insert(Room, ({'id': i, 'name': 'room %d' % i, 'size': size, 'attached_bathroom': rng.random() < 0.4,
+                       'status': 'NA' if rng.random() < 0.05 else 'A', 'price': rng.randint(30, 80) * 100, 'description': ''}
+                      for i, size in enumerate(sizes, 1)))
+        insert(RoomBookings, ({'user_id': USERS + i, 'room_id': room_id, 'status': rng.choice(('pending', 'approved'))}
+                              for i, room_id in enumerate(taken, 1)))
+        db.session.commit()
+        rebuild_occupancy()
+
+        start = time.perf_counter()
+        search_rooms(limit=1)
+        print('index of %d available rooms and %d bookings built in %.0fms' % (len(index), len(taken), (time.perf_counter() - start) * 1000))
+
+        for search in SEARCHES:
+            timings = []
+            for _ in range(50):
+                start = time.perf_counter()
+                search_rooms(limit=20, **search)
+                timings.append((time.perf_counter() - start) * 1000)
+            start = time.perf_counter()
+            want = expected(**search)
+            sql_ms = (time.perf_counter() - start) * 1000
+            got = all_pages(search, 500)
+            assert got == [tuple(row) for row in want], search
+            print('%-70s first page p50 %.3fms, max %.3fms; %d matches (SQL %.0fms)'
+                  % (search or 'no filters', statistics.median(timings), max(timings), len(got), sql_ms))
+
+        # incremental refresh after booking writes
+        loaded_at = index.loaded_at, book.loaded_at
+        free = [id for id, in db.session.query(Room.id).filter(Room.status == 'A', Room.occupancy < Room.size).limit(200)]
+        start = time.perf_counter()
+        for user_id, room_id in zip(range(1, USERS + 1), free):
+            book_room(user_id, room_id)
+        bookings = RoomBookings.query.filter(RoomBookings.user_id <= USERS).all()
+        for booking in bookings[::2]:
+            set_room_booking_status(booking, 'cancelled')
+        for booking in bookings[1::2]:
+            set_room_booking_status(booking, 'approved')
+        db.session.commit()
+        for search in SEARCHES:
+            assert all_pages(search, 500) == [tuple(row) for row in expected(**search)], search
+        assert (index.loaded_at, book.loaded_at) == loaded_at, 'index was reloaded in full'
+        print('%d bookings, approvals and cancellations reflected incrementally in %.2fs' % (len(bookings) * 2, time.perf_counter() - start))
+
+        rebuild_occupancy()
+        for search in SEARCHES:
+            assert all_pages(search, 500) == [tuple(row) for row in expected(**search)], search
+        print('searches match SQL after rebuild-occupancy')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Full-text search over tickets, replies and announcements at scale.
+
+Seeds tickets written from a Zipf-distributed vocabulary (a handful of words
+are in most tickets, most words are rare), with replies and announcements,
+builds the FTS5 index and times pghr.search.search for common, rare,
+multi-word and prefix queries and for pages deep into the matches. Every
+result must contain every query word, and the in-process fallback index,
+built over the same rows, must pick the same candidates. Then adds, edits and deletes documents through the ORM
+and checks both indexes follow.
+
+Usage: python benchmarks/bench_search.py [tickets]
+"""
+import itertools
+import random
+import statistics
+import sys
+import time
+
+from utils import make_app
+
+from pghr.database import db
+from pghr.models import User, Ticket, TicketReplies, Announcements
+from pghr.search import KINDS, memory, parse_query, search, words, fts_candidates, rebuild_search_index
+from seed import insert
+
+USERS = 5000
+COMMON = ['water', 'leak', 'wifi', 'slow', 'power', 'cut', 'cleaning', 'room', 'bathroom', 'tap', 'fan', 'light',
+          'noise', 'door', 'lock', 'key', 'bed', 'window', 'heater', 'mess', 'food', 'late', 'broken', 'please', 'fix']
+VOCABULARY = COMMON + ['word%d' % i for i in range(20000)]
+CUMULATIVE = list(itertools.accumulate(1.0 / rank for rank in range(1, len(VOCABULARY) + 1)))
+
+QUERIES = ['water', 'water leak', 'wifi slow please', 'word1234', 'word77 fix', 'wat*', 'bro* tap', 'word12*', 'broken tap bathroom']
+
+
+def text(rng, count):
+    return ' '.join(rng.choices(VOCABULARY, cum_weights=CUMULATIVE, k=count))
+
+
+def timed(query, repeat=30, **kwargs):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results, has_next = search(query, **kwargs)
+        timings.append((time.perf_counter() - start) * 1000)
+    return results, statistics.median(timings), max(timings)
+
+
+def check(query, results):
+    terms = parse_query(query)
+    for result in results:
+        found = set(words(result['title'].striptags()) + words(result['snippet'].striptags()))
+        assert all(any(word.startswith(term) for word in found) if prefix else term in found for term, prefix in terms) \
+            or len(result['snippet'].striptags().split()) >= 24, (query, result)
+
+
+def candidate_keys(query, owner=None, limit=100):
+    terms = parse_query(query)
+    connection = db.session.connection()
+    fts = {kind: sorted(row[0] for row in fts_candidates(connection, terms, kind, owner, limit)) for kind in KINDS}
+    mem = {kind: sorted(key for key, score in memory.candidates(terms, kind, owner, limit)) for kind in KINDS}
+    return fts, mem
+
+
+def main():
+    tickets = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    replies = tickets // 2
+    rng = random.Random(11)
+    app = make_app()
+    app.config['SEARCH_MAX_AGE'] = 3600
+    with app.test_request_context():
+        start = time.perf_counter()
+        insert(User, ({'id': i, 'username': 'user%d' % i, 'email': 'user%d@pghr.local' % i, 'password': 'x', 'admin': i == 1}
+                      for i in range(1, USERS + 1)))
+        insert(Ticket, ({'id': i, 'user_id': 2 + i % (USERS - 1), 'title': text(rng, 3), 'description': text(rng, 15), 'status': 'pending'}
+                        for i in range(1, tickets + 1)))
+        insert(TicketReplies, ({'ticket_id': 1 + rng.randrange(tickets), 'user_id': 1, 'description': text(rng, 10)} for _ in range(replies)))
+        insert(Announcements, ({'title': 'notice %d %s' % (i, text(rng, 3)), 'description': text(rng, 20)} for i in range(1, tickets // 200 + 1)))
+        db.session.commit()
+        print('seeded %d tickets, %d replies, %d announcements in %.0fs' % (tickets, replies, tickets // 200, time.perf_counter() - start))
+        start = time.perf_counter()
+        rebuild_search_index()
+        print('FTS5 index built in %.1fs' % (time.perf_counter() - start))
+
+        for query in QUERIES:
+            results, p50, worst = timed(query)
+            check(query, results)
+            _, resident_p50, _ = timed(query, user_id=2 + rng.randrange(USERS - 1))
+            print('%-24s FTS5 p50 %6.2fms  max %6.2fms  resident p50 %5.2fms  %2d results' % (query, p50, worst, resident_p50, len(results)))
+
+        # pages past the first window of candidates go on to older matches, none repeated
+        per_page = app.config['SEARCH_RESULTS_PER_PAGE']
+        shown = set()
+        for page in range(1, 16):
+            results, has_next = search('water', ['ticket'], page=page)
+            shown.update(result['id'] for result in results)
+        assert len(shown) == 15 * per_page and has_next, len(shown)
+        for page in (10, 100):
+            results, p50, worst = timed('water', repeat=5, page=page)
+            assert len(results) == per_page, page
+            print('%-24s FTS5 p50 %6.2fms  max %6.2fms  page %d' % ('water', p50, worst, page))
+
+        app.config['SEARCH_BACKEND'] = 'memory'
+        start = time.perf_counter()
+        memory.refresh(3600)
+        print('in-process index of %d documents built in %.1fs' % (len(memory), time.perf_counter() - start))
+        for query in QUERIES:
+            results, p50, worst = timed(query, repeat=5)
+            check(query, results)
+            fts, mem = candidate_keys(query)
+            assert fts == mem, query
+            fts, mem = candidate_keys(query, owner=7)
+            assert fts == mem, (query, 'resident')
+            print('%-24s memory p50 %6.2fms  max %6.2fms  same candidates as FTS5' % (query, p50, worst))
+
+        # incremental upkeep through the ORM: both indexes follow without a rebuild
+        loaded_at = memory.loaded_at
+        ticket = Ticket(user_id=2, title='zebracrossing', description='a unique complaint', status='pending')
+        announcement = Announcements(title='quokka day', description='zebracrossing closed')
+        db.session.add_all([ticket, announcement])
+        db.session.commit()
+        db.session.add(TicketReplies(ticket_id=ticket.id, user_id=1, description='zebracrossing fixed'))
+        db.session.commit()
+        for backend in ('auto', 'memory'):
+            app.config['SEARCH_BACKEND'] = backend
+            assert sorted(result['kind'] for result in search('zebracrossing')[0]) == ['announcement', 'reply', 'ticket'], backend
+            assert sorted(result['kind'] for result in search('zebracrossing', user_id=2)[0]) == ['announcement', 'reply', 'ticket'], backend
+            assert [result['kind'] for result in search('zebracrossing', user_id=3)[0]] == ['announcement'], backend
+        ticket.description = 'an ordinary complaint'
+        db.session.delete(announcement)
+        db.session.commit()
+        for backend in ('auto', 'memory'):
+            app.config['SEARCH_BACKEND'] = backend
+            assert sorted(result['kind'] for result in search('zebracrossing')[0]) == ['reply', 'ticket'], backend
+            assert [result['id'] for result in search('ordinary complaint')[0]] == [ticket.id], backend
+        assert memory.loaded_at == loaded_at, 'in-process index was reloaded in full'
+        print('inserts, edits and deletes reflected in both indexes')
+
+
+if __name__ == '__main__':
+    main()
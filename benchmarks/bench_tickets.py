@@ -0,0 +1,48 @@
+"""Ticket page timings against ticket and reply counts.
+
+Usage: python benchmarks/bench_tickets.py
+"""
+from utils import make_app, reset_db, login, time_get
+
+from pghr.database import db
+from pghr.models import User, Ticket, TicketReplies
+
+SCALES = [(100, 1), (1000, 1), (5000, 1), (5000, 3)]
+RESIDENTS = 50
+
+
+def seed(tickets, replies_per_ticket):
+    reset_db()
+    db.session.execute(User.__table__.insert(), [
+        {'id': 1, 'username': 'admin', 'email': 'admin@pghr.local', 'password': 'x', 'admin': True}
+    ] + [
+        {'id': i, 'username': 'user%d' % i, 'email': 'user%d@pghr.local' % i, 'password': 'x', 'admin': False}
+        for i in range(2, RESIDENTS + 2)
+    ])
+    db.session.execute(Ticket.__table__.insert(), [
+        {'id': i, 'user_id': 2 + i % RESIDENTS, 'title': 'ticket %d' % i, 'description': 'water', 'status': 'pending'}
+        for i in range(1, tickets + 1)
+    ])
+    db.session.execute(TicketReplies.__table__.insert(), [
+        {'ticket_id': i, 'user_id': 1, 'description': 'fixed'}
+        for i in range(1, tickets + 1) for _ in range(replies_per_ticket)
+    ])
+    db.session.commit()
+
+
+def main():
+    app = make_app()
+    client = app.test_client()
+    print('%8s %8s %14s %14s' % ('tickets', 'replies', 'admin (ms)', 'customer (ms)'))
+    for tickets, replies_per_ticket in SCALES:
+        with app.app_context():
+            seed(tickets, replies_per_ticket)
+        login(client, 1)
+        admin_ms = time_get(client, '/admin/ticket')
+        login(client, 2)
+        customer_ms = time_get(client, '/ticket')
+        print('%8d %8d %14.1f %14.1f' % (tickets, tickets * replies_per_ticket, admin_ms, customer_ms))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Bulk export and import round trip.
+
+Seeds users, rooms, bookings and tickets, exports every table as CSV and as
+JSON lines and reports rows/s and the peak memory Python allocated while
+streaming, which must not grow with the table. Then empties the database,
+imports the CSV files back and checks that exporting again gives identical
+files, and that the dashboard counters, room occupancy and search index
+match a recount. Finally imports a file of broken rows and checks each one
+is rejected with its line number and reason, and that CSV the reader cannot
+parse stops the import with a TransferError.
+
+Usage: python benchmarks/bench_transfer.py [users]
+"""
+import csv
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from utils import make_app, reset_db
+
+from pghr.database import db
+from pghr.models import User, Mess, Room, RoomBookings, Statistic
+from pghr.search import rebuild_search_index, search
+from pghr.stats import compute_stats
+from pghr.transfer import TABLES, ErrorFile, TransferError, export_rows, import_rows, read_rows
+from seed import insert, seed
+
+# parents before the rows that refer to them
+ORDER = ('users', 'rooms', 'room_bookings', 'mess_bookings', 'tickets')
+
+
+def export(directory, table, format):
+    path = os.path.join(directory, '%s.%s' % (table, format))
+    start = time.perf_counter()
+    with open(path, 'w', encoding='utf-8') as stream:
+        for chunk in export_rows(table, format, passwords=True):
+            stream.write(chunk)
+    elapsed = time.perf_counter() - start
+    db.session.rollback()
+    return path, elapsed
+
+
+def peak_memory(table, format):
+    """Most memory Python had allocated at once while streaming the table."""
+    tracemalloc.start()
+    for _ in export_rows(table, format):
+        pass
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    db.session.rollback()
+    return peak
+
+
+def read(path):
+    with open(path, encoding='utf-8') as stream:
+        return stream.read()
+
+
+def counters():
+    return {name: value for name, value in db.session.query(Statistic.name, Statistic.value) if value}
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    app = make_app()
+    directory = tempfile.mkdtemp()
+    with app.app_context():
+        scale = seed(users=users, rooms=users // 20, messes=5, bookings=users * 9 // 10, tickets=users * 2, replies=0, announcements=0)
+        messes = [dict(id=id, name=name, description=description, status=status, price=price)
+                  for id, name, description, status, price in db.session.query(Mess.id, Mess.name, Mess.description, Mess.status, Mess.price)]
+        print('seeded %s' % ', '.join('%d %s' % (count, name) for name, count in scale.items() if count))
+
+        exported = {}
+        for table in ORDER:
+            for format in ('csv', 'jsonl'):
+                path, elapsed = export(directory, table, format)
+                rows = sum(1 for _ in open(path, encoding='utf-8')) - (format == 'csv')
+                exported[table, format] = path
+                print('export %-14s %-5s %8d rows in %5.2fs (%7.0f rows/s)' % (table, format, rows, elapsed, rows / elapsed))
+        for format in ('csv', 'jsonl'):
+            small, large = peak_memory('rooms', format), peak_memory('tickets', format)
+            print('export peak memory, %s: %.1f MB for rooms, %.1f MB for %d times as many tickets' % (format, small / 1e6, large / 1e6, scale['tickets'] // scale['rooms']))
+            assert large < 2 * small + 1e6, 'export memory grows with the table'
+
+        reset_db()
+        insert(Mess, messes)
+        db.session.commit()
+        for table in ORDER:
+            start = time.perf_counter()
+            with open(exported[table, 'csv'], encoding='utf-8', newline='') as stream:
+                report = import_rows(table, read_rows(stream, 'csv'))
+            elapsed = time.perf_counter() - start
+            assert report['rejected'] == 0 and report['imported'] == report['rows'], (table, report)
+            print('import %-14s %8d rows in %5.2fs (%7.0f rows/s)' % (table, report['rows'], elapsed, report['rows'] / elapsed))
+
+        for table in ORDER:
+            path, _ = export(directory, table, 'csv')
+            assert read(path) == read(exported[table, 'csv']), '%s differs after the round trip' % table
+        assert counters() == {name: value for name, value in compute_stats(db.session).items() if value}, 'dashboard counters'
+        for room_id, occupancy, held in db.session.query(Room.id, Room.occupancy, db.select(db.func.count(RoomBookings.id)).where(
+                RoomBookings.room_id == Room.id, RoomBookings.status.in_(('pending', 'approved'))).scalar_subquery()):
+            assert occupancy == held, ('occupancy', room_id, occupancy, held)
+        with app.test_request_context():
+            assert [result['id'] for result in search('ticket %d' % users)[0]][:1] == [users], 'imported ticket not found'
+            rebuild_search_index()
+            assert [result['id'] for result in search('ticket %d' % users)[0]][:1] == [users]
+        print('re-exported files are identical; counters, occupancy and search index match a recount')
+
+        # one full room and a file of broken rows
+        db.session.add(Room(id=10 ** 6, name='single', size=1, attached_bathroom=False, status='A', price=1, description=''))
+        db.session.commit()
+        rows = [
+            {'id': '1', 'username': 'again', 'email': 'again@pghr.local', 'password': 'long enough'},
+            {'username': 'user2', 'email': 'new@pghr.local', 'password': 'long enough'},
+            {'username': 'fresh', 'email': 'fresh@pghr.local', 'password': 'short'},
+            {'username': 'fresh', 'email': 'not an address', 'password': 'long enough'},
+            {'username': 'fresh', 'email': 'fresh@pghr.local', 'password': 'long enough', 'admin': 'maybe'},
+            {'username': 'fresh', 'email': 'fresh@pghr.local', 'password': 'long enough'},
+            {'username': 'fresh', 'email': 'other@pghr.local', 'password': 'long enough'},
+        ]
+        errors = []
+        report = import_rows('users', enumerate(rows, 2), lambda line, row, reason: errors.append((line, reason)))
+        assert report == {'rows': 7, 'imported': 1, 'rejected': 6}, report
+        assert errors == [(2, 'id 1 is already taken'), (3, 'username user2 is already taken'),
+                          (4, 'password must be a password hash or at least 8 characters'), (5, 'email must be an email address'),
+                          (6, 'admin must be true or false'), (8, 'username fresh is already taken')], errors
+        fresh = User.query.filter_by(username='fresh').one().id
+        lines = ['{"user_id": %d, "room_id": 1000000, "status": "pending"}' % fresh,
+                 '{"user_id": %d, "room_id": 1000000, "status": "approved"}' % (fresh - 1),
+                 '{"user_id": 1, "room_id": 999999, "status": "pending"',
+                 '["not", "an", "object"]',
+                 '{"user_id": %d, "room_id": 999999, "status": "gone"}' % fresh]
+        path = os.path.join(directory, 'bad.jsonl')
+        with open(path, 'w', encoding='utf-8') as stream:
+            stream.write('\n'.join(lines) + '\n')
+        errors_path = os.path.join(directory, 'bad.errors.jsonl')
+        with open(path, encoding='utf-8') as stream, ErrorFile(errors_path, 'jsonl', TABLES['room_bookings'][1]) as error_file:
+            report = import_rows('room_bookings', read_rows(stream, 'jsonl'), error_file.write)
+        assert report == {'rows': 5, 'imported': 1, 'rejected': 4}, report
+        rejected = [(record['line'], record['error']) for record in map(json.loads, read(errors_path).splitlines())]
+        assert rejected == [(2, 'room 1000000 has no free bed for those dates'), (3, 'not a valid JSON line'),
+                            (4, 'a line must hold one JSON object'), (5, 'status must be one of: pending, approved, cancelled')], rejected
+        assert Room.query.get(10 ** 6).occupancy == 1
+        print('broken rows rejected with their line and reason:')
+        print(read(errors_path), end='')
+
+        # CSV the reader gives up on stops the import with a TransferError, not a csv.Error
+        try:
+            list(read_rows(io.StringIO('name,size\nbig,%s\n' % ('1' * (csv.field_size_limit() + 1))), 'csv'))
+        except TransferError as error:
+            print('unreadable CSV: %s' % error)
+        else:
+            raise AssertionError('an oversized CSV field was read')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,153 @@
+"""Check the booking and ticket event history against the live tables.
+
+Seeds a database, then drives random writes through the routes as
+check_stats.py does: bookings, cancellations, single and bulk approvals and
+rejections (inline and queued), tickets, replies and deletions, plus a
+booking import. Midway it notes every status and the time. Afterwards
+  - replaying the whole history gives exactly the statuses in the tables
+  - replaying up to the noted time gives the statuses noted then
+  - every change made through a page is attributed to the user who made it
+Then appends synthetic events until the table holds `events` rows and times
+a full replay and a one-day report, with the peak memory of each.
+
+Usage: python benchmarks/check_events.py [operations] [events]
+"""
+import contextlib
+import io
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from utils import make_app, login
+
+from pghr import events
+from pghr.database import db
+from pghr.jobs import Worker
+from pghr.models import User, RoomBookings, MessBookings, Event
+from pghr.transfer import import_rows
+from seed import seed
+
+USERS = 400
+
+
+def live_statuses():
+    return {entity: dict(db.session.query(model.id, model.status)) for model, (entity, item_id) in events.ENTITIES.items()}
+
+
+def measured(function):
+    """Result, seconds and peak MB allocated; timed untraced, as tracing slows it down."""
+    start = time.perf_counter()
+    result = function()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, elapsed, peak / 1e6
+
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    total = int(sys.argv[2]) if len(sys.argv) > 2 else 500000
+    rng = random.Random(5)
+    app = make_app()
+    with app.app_context():
+        seed(users=USERS, rooms=40, messes=3, bookings=200, tickets=60, replies=80, announcements=0, rng=rng)
+        usernames = dict(db.session.query(User.id, User.username))
+        db.session.remove()
+
+    admin, resident = app.test_client(), app.test_client()
+    login(admin, 1)
+    worker = Worker(app, threads=1, poll_interval=0.1, visibility_timeout=60, retry_delay=0)
+
+    def as_resident(user_id, path, data=None):
+        login(resident, user_id)
+        return resident.post(path, data=data)
+
+    def bulk(kind, action):
+        model = RoomBookings if kind == 'room' else MessBookings
+        with app.app_context():
+            ids = [id for id, in db.session.query(model.id).order_by(db.func.random()).limit(rng.choice((5, 60)))]
+            db.session.remove()
+        admin.post('/admin/booking/bulk', json={'kind': kind, 'action': action, 'booking_ids': ids})
+
+    actions = [
+        lambda: as_resident(rng.randint(2, USERS), '/booking/%d/room' % rng.randint(1, 40)),
+        lambda: as_resident(rng.randint(2, USERS), '/booking/%d/mess' % rng.randint(1, 3)),
+        lambda: as_resident(rng.randint(2, USERS), '/booking/room/delete'),
+        lambda: as_resident(rng.randint(2, USERS), '/booking/mess/delete'),
+        lambda: admin.post('/admin/booking/%s/%s/%s' % (rng.choice(('room', 'mess')), usernames[rng.randint(2, USERS)], rng.choice(('approve', 'reject')))),
+        lambda: bulk(rng.choice(('room', 'mess')), rng.choice(('approve', 'reject'))),
+        lambda: as_resident(rng.randint(2, USERS), '/ticket', {'title': 'leak', 'description': 'tap leaking'}),
+        lambda: admin.post('/admin/ticket', data={'ticket_id': str(rng.randint(1, 99)), 'description': 'fixed it'}),
+        lambda: admin.get('/admin/ticket/%d/delete' % rng.randint(1, 99)),
+    ]
+
+    def run(count):
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            for _ in range(count):
+                try:
+                    rng.choice(actions)()
+                except Exception:
+                    # deleting a missing ticket and the like fail in the views; the history must still agree
+                    pass
+            with app.app_context():
+                worker.run_pending()
+
+    start = time.perf_counter()
+    run(operations // 2)
+    with app.app_context():
+        noted, noted_at = live_statuses(), datetime.utcnow()
+        db.session.remove()
+    time.sleep(0.01)
+    run(operations - operations // 2)
+    with app.app_context():
+        free = [id for id, in db.session.query(User.id).filter(~User.id.in_(db.session.query(MessBookings.user_id)), User.id > 1).limit(20)]
+        report = import_rows('mess_bookings', enumerate(({'user_id': str(id), 'mess_id': '1', 'status': 'approved'} for id in free), 2))
+        assert report['imported'] == len(free), report
+    print('%d random writes and %d imported bookings in %.2fs' % (operations, len(free), time.perf_counter() - start))
+
+    with app.app_context():
+        kinds = dict(db.session.query(Event.action, db.func.count(Event.id)).group_by(Event.action).all())
+        print('history: %s' % ', '.join('%d %s' % (count, action) for action, count in sorted(kinds.items())))
+        mismatches = events.verify()
+        assert not mismatches, mismatches[:10]
+        then = events.replay(events.CurrentStatus(), until=noted_at)
+        assert {entity: then.get(entity, {}) for entity in noted} == noted, 'state at the midpoint differs'
+        print('replaying every event gives the tables; replaying to the midpoint gives the statuses noted then')
+        # page changes carry their user: residents book and raise tickets, the admin decides
+        unattributed = db.session.query(db.func.count(Event.id)).filter(Event.action.in_(('created', 'status', 'deleted')), Event.actor_id == None).scalar()  # noqa: E711
+        by_admin = db.session.query(db.func.count(Event.id)).filter(Event.action == 'status', Event.actor_id == 1).scalar()
+        assert unattributed == 0, unattributed
+        print('every change made through a page names its user (%d by the admin)' % by_admin)
+
+        # a history of `total` events spread over a year
+        existing = db.session.query(db.func.count(Event.id)).scalar()
+        now = datetime.utcnow()
+        entities = [entity for entity, item_id in events.ENTITIES.values()]
+        for offset in range(existing, total, 50000):
+            rows = []
+            for number in range(offset, min(offset + 50000, total)):
+                entity = rng.choice(entities)
+                rows.append({'entity': entity, 'entity_id': 100000 + number // 3, 'action': ('created', 'status', 'status')[number % 3],
+                             'old_status': (None, 'pending', 'approved')[number % 3], 'status': ('pending', 'approved', 'cancelled')[number % 3],
+                             'user_id': 2, 'item_id': 1, 'actor_id': 1, 'at': now - timedelta(seconds=(total - number) * 60)})
+            db.session.execute(Event.__table__.insert(), rows)
+        db.session.commit()
+        day = (now - timedelta(days=30)).date()
+        plan = ' '.join(str(row[-1]) for row in db.session.execute(db.text(
+            "EXPLAIN QUERY PLAN SELECT * FROM event WHERE entity IN ('ticket') AND at >= :since AND at < :until ORDER BY id"),
+            {'since': datetime.combine(day, datetime.min.time()), 'until': datetime.combine(day + timedelta(days=1), datetime.min.time())}))
+        assert 'ix_event_entity_at' in plan, plan
+        full, full_seconds, full_peak = measured(lambda: events.replay(events.DailyTransitions()))
+        window, window_seconds, window_peak = measured(lambda: events.replay(events.DailyTransitions(), ['ticket'], since=day, until=day))
+        decisions, decision_seconds, decision_peak = measured(lambda: events.replay(events.DecisionTimes(), since=day - timedelta(days=6), until=day))
+    print('%d events: full replay %.2fs (peak %.1f MB), one day of tickets %.1fms (peak %.2f MB, %s), a week of decision times %.1fms'
+          % (total, full_seconds, full_peak, window_seconds * 1000, window_peak, plan, decision_seconds * 1000))
+    assert sum(full.values()) > sum(window.values()) > 0
+
+
+if __name__ == '__main__':
+    main()
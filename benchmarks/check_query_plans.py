@@ -0,0 +1,88 @@
+"""Check that the dashboard, booking and ticket queries use the indexes.
+
+Requests each page through the test client, captures the SQL it runs and
+asks SQLite for the plan of every statement. Exits non-zero when a filtered
+query on a booking or ticket table falls back to a full table scan.
+
+Usage: python benchmarks/check_query_plans.py
+"""
+import re
+import sys
+
+from sqlalchemy import event
+
+from utils import make_app, login
+from bench_booking import seed as seed_bookings
+
+from pghr.database import db
+from pghr.models import Ticket, TicketReplies
+
+INDEXED_TABLES = ('room_bookings', 'mess_bookings', 'ticket', 'ticket_replies')
+PAGES = [
+    (2, '/dashboard'),
+    (2, '/booking'),
+    (2, '/ticket'),
+    (1, '/admin/ticket'),
+    (1, '/admin/booking?status=pending'),
+    (1, '/admin/booking?user=user7'),
+    (1, '/admin/booking?room=7&status=approved'),
+    (1, '/admin/booking?mess=1&status=cancelled'),
+]
+
+
+def seed():
+    seed_bookings(2000)
+    db.session.execute(Ticket.__table__.insert(), [
+        {'id': i, 'user_id': 2 + i % 100, 'title': 'ticket %d' % i, 'description': 'water', 'status': 'pending'}
+        for i in range(1, 1001)
+    ])
+    db.session.execute(TicketReplies.__table__.insert(), [
+        {'ticket_id': i, 'user_id': 1, 'description': 'fixed'} for i in range(1, 1001)
+    ])
+    db.session.commit()
+    db.session.execute(db.text('ANALYZE'))
+
+
+def full_scans(statement, parameters):
+    """Return the indexed tables a filtered statement scans without an index."""
+    if ' WHERE ' not in statement:
+        return []
+    plan = db.session.execute(db.text('EXPLAIN QUERY PLAN ' + statement.replace('?', ':p%d') % tuple(range(len(parameters)))),
+                              {'p%d' % i: value for i, value in enumerate(parameters)}).fetchall()
+    scans = []
+    for row in plan:
+        match = re.match(r'SCAN (\w+)(?: AS \w+)?$', row[-1])
+        if match and match.group(1) in INDEXED_TABLES:
+            scans.append(match.group(1))
+    return scans
+
+
+def main():
+    app = make_app()
+    client = app.test_client()
+    captured = []
+    with app.app_context():
+        seed()
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            captured.append((statement, parameters))
+
+    failures = 0
+    for user_id, url in PAGES:
+        login(client, user_id)
+        del captured[:]
+        assert client.get(url).status_code == 200, url
+        statements = list(captured)
+        for statement, parameters in statements:
+            with app.app_context():
+                scans = full_scans(statement, parameters)
+            if scans:
+                failures += 1
+                print('FAIL %s scans %s:\n    %s' % (url, ', '.join(scans), ' '.join(statement.split())))
+        print('ok   %s (%d statements)' % (url, len(statements)))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""Read replica routing, on two SQLite files.
+
+Seeds a primary database and copies it to a replica file with SQLite's
+backup API, which stands in for replication: the replica only changes when
+sync() runs, so a change that has not been synced shows which database a
+page was read from. Checks that
+  - every @read_only page reads only from the replica, and the replica only
+    ever sees SELECTs
+  - a user who commits reads their own writes from the primary for
+    REPLICA_STICKY_SECONDS, while other users still read the replica
+  - cached pages are filled from the primary, so they are never staler
+    than their cache tags
+  - a read-only request that writes reads from the primary afterwards
+and reports how long the pages take with and without the replica.
+
+Usage: python benchmarks/check_replicas.py
+"""
+import os
+import re
+import sqlite3
+import statistics
+import tempfile
+import time
+
+from utils import login, make_app
+
+from sqlalchemy import event
+from pghr.database import db
+from pghr.models import Announcements, Ticket
+from pghr.replicas import REPLICA
+from seed import seed
+
+STICKY_SECONDS = 2
+PAGES = [
+    '/dashboard', '/ticket', '/announcement', '/booking', '/api/v1/rooms', '/api/v1/rooms/search',
+    '/api/v1/rooms/1', '/api/v1/rooms/1/availability', '/api/v1/mess', '/api/v1/mess/1', '/api/v1/bookings/room',
+    '/api/v1/bookings/mess', '/api/v1/tickets', '/api/v1/announcements', '/api/v1/search?q=ticket',
+]
+ADMIN_PAGES = [
+    '/admin/dashboard', '/admin/ticket', '/admin/announcement', '/admin/search?q=ticket', '/admin/booking',
+    '/admin/booking?status=pending', '/admin/billing', '/admin/data/rooms.csv', '/admin/charges',
+]
+WRITE = re.compile(r'^\s*(INSERT|UPDATE|DELETE|REPLACE|CREATE|DROP|ALTER)\b', re.I)
+
+
+def sync(primary, replica):
+    """Copy the primary's committed state over the replica."""
+    db.engines['replica1'].dispose()
+    source, target = sqlite3.connect(primary), sqlite3.connect(replica)
+    source.backup(target)
+    source.close()
+    target.close()
+
+
+class Statements():
+    """Statements run on each engine since the last take()."""
+    def __init__(self):
+        self.seen = {'primary': [], 'replica': []}
+        for key, engine in db.engines.items():
+            event.listen(engine, 'before_cursor_execute', self.recorder('primary' if key is None else 'replica'))
+
+    def recorder(self, name):
+        def record(conn, cursor, statement, parameters, context, executemany):
+            self.seen[name].append(statement)
+        return record
+
+    def take(self):
+        seen = {name: list(statements) for name, statements in self.seen.items()}
+        for statements in self.seen.values():
+            statements.clear()
+        return seen
+
+
+def get(client, url):
+    response = client.get(url)
+    assert response.status_code == 200, (url, response.status_code)
+    return response.get_data(as_text=True)
+
+
+def timed(client, urls, repeat=20):
+    times = []
+    for url in urls:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            get(client, url)
+            times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    primary, replica = os.path.join(directory, 'primary.db'), os.path.join(directory, 'replica.db')
+    app = make_app(primary, SQLALCHEMY_REPLICA_URIS=['sqlite:///' + replica], REPLICA_STICKY_SECONDS=STICKY_SECONDS)
+    with app.app_context():
+        seed(users=300, rooms=30, messes=3, bookings=150, tickets=600, replies=200, announcements=30)
+        db.session.commit()
+        sync(primary, replica)
+        statements = Statements()
+
+    resident, admin, other = app.test_client(), app.test_client(), app.test_client()
+    login(resident, 2)
+    login(admin, 1)
+    login(other, 3)
+
+    # warm the identity cache and the in-process indexes, which read the primary
+    for url in PAGES:
+        get(resident, url)
+    for url in ADMIN_PAGES:
+        get(admin, url)
+    statements.take()
+    replica_reads = 0
+    for client, urls in ((resident, PAGES), (admin, ADMIN_PAGES)):
+        for url in urls:
+            get(client, url)
+            seen = statements.take()
+            # room search is answered from the availability index alone
+            assert not seen['primary'], (url, seen)
+            replica_reads += bool(seen['replica'])
+    print('%d read-only pages read only from the replica, %d of them ran SQL' % (len(PAGES) + len(ADMIN_PAGES), replica_reads))
+
+    # a change nobody synced yet, made outside any request
+    with app.app_context():
+        db.session.add(Announcements(title='unsynced', description='written to the primary'))
+        db.session.commit()
+    assert 'unsynced' not in get(other, '/announcement'), 'read from the primary'
+    # the feed is cached, so it is filled from the primary and has it already
+    assert 'unsynced' in get(other, '/announcement/feed'), 'cached page filled from the replica'
+
+    response = resident.post('/ticket', data={'title': 'mine', 'description': 'read your writes'})
+    assert response.status_code == 302
+    assert 'read your writes' in get(resident, '/ticket'), 'own write not visible'
+    assert 'read your writes' in get(resident, '/api/v1/tickets'), 'own write not visible'
+    assert 'read your writes' not in get(admin, '/admin/ticket'), "another user's page read from the primary"
+    time.sleep(STICKY_SECONDS + 0.1)
+    assert 'read your writes' not in get(resident, '/ticket'), 'still on the primary after the sticky window'
+    with app.app_context():
+        sync(primary, replica)
+    assert 'read your writes' in get(resident, '/ticket') and 'read your writes' in get(admin, '/admin/ticket')
+    print('own writes read back for %ds, other users and later reads served by the replica until it syncs' % STICKY_SECONDS)
+
+    # a read-only request that writes reads from the primary from then on
+    statements.take()
+    with app.test_request_context('/ticket'):
+        db.session.info['reads'] = REPLICA
+        before = db.session.query(db.func.count(Ticket.id)).scalar()
+        db.session.add(Ticket(user_id=2, title='flushed', description='flushed', status='pending'))
+        db.session.flush()
+        after = db.session.query(db.func.count(Ticket.id)).scalar()
+        db.session.rollback()
+        assert after == before + 1
+        seen = statements.take()
+        assert len(seen['replica']) == 1 and any(WRITE.match(statement) for statement in seen['primary']), seen
+        db.session.remove()
+
+    statements.take()
+    for client, urls in ((resident, PAGES), (admin, ADMIN_PAGES)):
+        for url in urls:
+            get(client, url)
+    writes = [statement for statement in statements.take()['replica'] if WRITE.match(statement)]
+    assert not writes, writes
+    print('read-only requests that write go to the primary; the replica saw only SELECTs')
+
+    on_replica = timed(admin, ADMIN_PAGES)
+    app.config['SQLALCHEMY_REPLICA_URIS'] = []
+    on_primary = timed(admin, ADMIN_PAGES)
+    print('admin pages: median %.2f ms reading the replica, %.2f ms reading the primary' % (on_replica, on_primary))
+
+
+if __name__ == '__main__':
+    main()
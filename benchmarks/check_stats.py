@@ -0,0 +1,124 @@
+"""Check the incremental dashboard statistics against a full recount.
+
+Seeds a database, then drives random writes through the routes: bookings,
+cancellations, single and bulk approvals and rejections (inline and queued),
+tickets, replies and deletions, plus room and mess edits. Afterwards every
+counter in the statistic table must equal what pghr.stats.compute_stats()
+derives from the base tables, and the dashboard's full rooms must be the rooms
+whose live bookings fill their beds. Also times the dashboard against a
+recount.
+
+Usage: python benchmarks/check_stats.py [operations]
+"""
+import contextlib
+import io
+import random
+import sys
+import time
+
+from utils import make_app, login, time_get
+
+from pghr.database import db
+from pghr.jobs import Worker
+from pghr.models import User, Room, Mess, RoomBookings, MessBookings, Ticket, Statistic
+from pghr.stats import add, compute_stats, full_rooms
+from seed import seed
+
+USERS = 400
+
+
+def counters():
+    return {name: value for name, value in db.session.query(Statistic.name, Statistic.value) if value}
+
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rng = random.Random(11)
+    app = make_app()
+    with app.app_context():
+        seed(users=USERS, rooms=40, messes=3, bookings=200, tickets=60, replies=80, announcements=0, rng=rng)
+        usernames = dict(db.session.query(User.id, User.username))
+        db.session.remove()
+
+    admin, resident = app.test_client(), app.test_client()
+    login(admin, 1)
+    worker = Worker(app, threads=1, poll_interval=0.1, visibility_timeout=60, retry_delay=0)
+
+    def as_resident(user_id, path, data=None):
+        login(resident, user_id)
+        return resident.post(path, data=data)
+
+    def bulk(kind, action):
+        model = RoomBookings if kind == 'room' else MessBookings
+        with app.app_context():
+            ids = [id for id, in db.session.query(model.id).order_by(db.func.random()).limit(rng.choice((5, 60)))]
+            db.session.remove()
+        admin.post('/admin/booking/bulk', json={'kind': kind, 'action': action, 'booking_ids': ids})
+
+    def edit(model, **values):
+        with app.app_context():
+            item = db.session.query(model).order_by(db.func.random()).first()
+            for name, value in values.items():
+                setattr(item, name, value)
+            db.session.commit()
+
+    actions = [
+        lambda: as_resident(rng.randint(2, USERS), '/booking/%d/room' % rng.randint(1, 40)),
+        lambda: as_resident(rng.randint(2, USERS), '/booking/%d/mess' % rng.randint(1, 3)),
+        lambda: as_resident(rng.randint(2, USERS), '/booking/room/delete'),
+        lambda: as_resident(rng.randint(2, USERS), '/booking/mess/delete'),
+        lambda: admin.post('/admin/booking/%s/%s/%s' % (rng.choice(('room', 'mess')), usernames[rng.randint(2, USERS)], rng.choice(('approve', 'reject')))),
+        lambda: bulk(rng.choice(('room', 'mess')), rng.choice(('approve', 'reject'))),
+        lambda: as_resident(rng.randint(2, USERS), '/ticket', {'title': 'leak', 'description': 'tap leaking'}),
+        lambda: admin.post('/admin/ticket', data={'ticket_id': str(rng.randint(1, 99)), 'description': 'fixed it'}),
+        lambda: admin.get('/admin/ticket/%d/delete' % rng.randint(1, 99)),
+        lambda: edit(Room, price=rng.randint(30, 60) * 100),
+        lambda: edit(Room, status=rng.choice(('A', 'NA')), size=rng.randint(4, 8)),
+        lambda: edit(Mess, price=rng.randint(20, 40) * 100),
+    ]
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        for _ in range(operations):
+            try:
+                rng.choice(actions)()
+            except Exception:
+                # deleting a missing ticket and the like fail in the views; the counters must still agree
+                pass
+        with app.app_context():
+            worker.run_pending()
+    print('%d random writes in %.2fs' % (operations, time.perf_counter() - start))
+
+    with app.app_context():
+        kept = counters()
+        start = time.perf_counter()
+        recount = {name: value for name, value in compute_stats(db.session).items() if value}
+        recount_ms = (time.perf_counter() - start) * 1000
+        print('%d tickets, %d room and %d mess bookings' % (Ticket.query.count(), RoomBookings.query.count(), MessBookings.query.count()))
+        wrong = {name: (kept.get(name), recount.get(name)) for name in set(kept) | set(recount) if kept.get(name) != recount.get(name)}
+        for name, (have, want) in sorted(wrong.items()):
+            print('MISMATCH %s: kept %s, recount %s' % (name, have, want))
+        for room in Room.query.order_by(Room.id).limit(5):
+            room.size = 1
+        db.session.commit()
+        held = dict(db.session.query(RoomBookings.room_id, db.func.count(RoomBookings.id))
+                    .filter(RoomBookings.status.in_(('pending', 'approved'))).group_by(RoomBookings.room_id))
+        full = sorted(room.name for room in Room.query if held.get(room.id, 0) >= room.size)
+        count, listed = full_rooms(limit=len(full) + 1)
+        assert count == len(full) and sorted(name for name, occupancy, size in listed) == full, (count, listed, full)
+        print('%d full rooms listed on the dashboard' % count)
+        # a counter's first write creates its row; a second one adds to it
+        add({'check:new': 2})
+        add({'check:new': 3})
+        assert db.session.query(Statistic.value).filter_by(name='check:new').scalar() == 5
+        db.session.rollback()
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        dashboard_ms = time_get(admin, '/admin/dashboard')
+    print('dashboard %.1fms, full recount %.1fms' % (dashboard_ms, recount_ms))
+    if wrong:
+        sys.exit(1)
+    print('all %d counters match a recount' % len(kept))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""Bulk data generator for benchmarks.
+
+Rows are built as plain dicts and written with executemany-style Core
+inserts in chunks, which loads hundreds of thousands of rows in seconds.
+Every user shares one precomputed password hash (PASSWORD) so logins work
+without paying for a hash per row.
+
+User 1 is the admin. Users 2 .. bookings+1 hold a room and a mess booking;
+the remaining users hold none and are free to book.
+"""
+import math
+import random
+
+from werkzeug.security import generate_password_hash
+
+from pghr.database import db
+from pghr.models import User, Room, Mess, RoomBookings, MessBookings, Ticket, TicketReplies, Announcements
+from pghr.bookings import rebuild_occupancy
+from pghr.events import snapshot
+from pghr.stats import backfill_first_replies, rebuild_stats
+from pghr.search import rebuild_search_index
+
+PASSWORD = 'benchmark-password'
+STATUSES = ('pending', 'approved', 'cancelled')
+CHUNK = 5000
+
+SCALES = {
+    'small': {'users': 200, 'rooms': 20, 'messes': 3, 'bookings': 150, 'tickets': 300, 'replies': 200, 'announcements': 50},
+    'medium': {'users': 5000, 'rooms': 500, 'messes': 5, 'bookings': 4000, 'tickets': 10000, 'replies': 8000, 'announcements': 500},
+    'large': {'users': 100000, 'rooms': 10000, 'messes': 10, 'bookings': 90000, 'tickets': 200000, 'replies': 150000, 'announcements': 5000},
+}
+
+
+def insert(model, rows):
+    rows = iter(rows)
+    while True:
+        chunk = [row for _, row in zip(range(CHUNK), rows)]
+        if not chunk:
+            break
+        db.session.execute(model.__table__.insert(), chunk)
+
+
+def seed(users, rooms, messes, bookings, tickets, replies, announcements, rng=None):
+    """Fill an empty database. Returns the scale actually used."""
+    rng = rng or random.Random(42)
+    bookings = min(bookings, users - 1)
+    password = generate_password_hash(PASSWORD, method='sha256')
+    insert(User, ({'id': i, 'username': 'user%d' % i, 'email': 'user%d@pghr.local' % i, 'password': password, 'admin': i == 1}
+                  for i in range(1, users + 1)))
+    # enough beds for every booking plus a spare per room
+    size = math.ceil(bookings / rooms) + 1
+    insert(Room, ({'id': i, 'name': 'room %d' % i, 'size': size, 'attached_bathroom': i % 2 == 0, 'status': 'A',
+                   'price': 4000 + 100 * (i % 20), 'description': 'room %d' % i} for i in range(1, rooms + 1)))
+    insert(Mess, ({'id': i, 'name': 'mess %d' % i, 'description': 'mess %d' % i, 'status': 'A', 'price': 3000 + 250 * i}
+                  for i in range(1, messes + 1)))
+    insert(RoomBookings, ({'user_id': i, 'room_id': 1 + i % rooms, 'status': STATUSES[rng.randrange(3)]}
+                          for i in range(2, bookings + 2)))
+    insert(MessBookings, ({'user_id': i, 'mess_id': 1 + i % messes, 'status': STATUSES[rng.randrange(3)]}
+                          for i in range(2, bookings + 2)))
+    insert(Ticket, ({'id': i, 'user_id': 2 + i % (users - 1), 'title': 'ticket %d' % i, 'description': rng.choice(('water', 'cleaning', 'wifi', 'power')),
+                     'status': 'pending'} for i in range(1, tickets + 1)))
+    insert(TicketReplies, ({'ticket_id': 1 + i % tickets, 'user_id': 1, 'description': 'on it'} for i in range(replies if tickets else 0)))
+    insert(Announcements, ({'title': 'announcement %d' % i, 'description': 'notice %d' % i} for i in range(1, announcements + 1)))
+    backfill_first_replies(db.session)
+    snapshot(db.session.connection())
+    db.session.commit()
+    rebuild_occupancy()
+    rebuild_stats()
+    rebuild_search_index()
+    return {'users': users, 'rooms': rooms, 'messes': messes, 'bookings': bookings, 'tickets': tickets, 'replies': replies, 'announcements': announcements}
@@ -0,0 +1,375 @@
+"""Benchmark suite for every route.
+
+    python benchmarks/suite.py run [--scale small|medium|large] [--iterations N]
+                                   [--http-seconds S] [--concurrency C] [--output FILE]
+    python benchmarks/suite.py compare BASELINE.json CURRENT.json [--threshold 0.2]
+
+`run` seeds a fresh SQLite database (see seed.py) and drives every endpoint in
+pghr.controllers and pghr.api through the Flask test client, then drives the
+read-only pages through a threaded local HTTP server with concurrent clients.
+Per endpoint it reports p50/p95/p99 latency, throughput, SQL statements per
+request (from pghr.profiling) and peak Python memory allocated while serving
+one request (tracemalloc, measured in a separate pass). Results are written
+as JSON.
+
+`compare` lines up two result files and exits non-zero when an endpoint's p95
+latency grew by more than the threshold or it runs more SQL statements.
+"""
+import argparse
+import contextlib
+import http.cookiejar
+import io
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import urllib.request
+
+from utils import ROOT, make_app, login
+
+from werkzeug.serving import make_server
+
+from pghr import assets, profiling
+from pghr.database import db
+from pghr.models import User, Ticket, Announcements, RoomBookings, MenuItem
+from seed import seed, SCALES, PASSWORD
+
+OK_STATUSES = (200, 201, 202, 302, 304)
+
+
+class Context():
+    """Users and ids the scenarios need, picked from the seeded data.
+
+    Scenarios run as one of three roles: 'admin', 'resident' (holds bookings)
+    and 'guest' (holds none, so it can book and cancel freely).
+    """
+
+    def __init__(self, app, scale):
+        self.app = app
+        self.counter = 0
+        self.users = {'admin': 1, 'resident': 2, 'guest': scale['bookings'] + 2}
+        with app.app_context():
+            self.usernames = {role: User.query.get(id).username for role, id in self.users.items()}
+            self.resident = self.usernames['resident']
+            self.ticket_id = Ticket.query.order_by(Ticket.id).first().id
+            self.booking_ids = [id for id, in db.session.query(RoomBookings.id).order_by(RoomBookings.id).limit(20)]
+
+        self.menu_item_id = self.create(MenuItem(mess_id=1, name='thali', price=80, status='A'))
+
+    def next(self):
+        self.counter += 1
+        return self.counter
+
+    def create(self, row):
+        with self.app.app_context():
+            db.session.add(row)
+            db.session.commit()
+            return row.id
+
+
+def scenarios(ctx):
+    """(endpoint, method, role, prepare) for every route; prepare() returns request kwargs."""
+    def get(url):
+        return lambda: {'path': url}
+
+    def new_ticket():
+        return ctx.create(Ticket(user_id=ctx.users['resident'], title='bench %d' % ctx.next(), description='bench', status='pending'))
+
+    def new_announcement():
+        return ctx.create(Announcements(title='bench %d' % ctx.next(), description='bench'))
+
+    return [
+        # public
+        ('index', 'GET', None, get('/')),
+        ('login', 'GET', None, get('/login')),
+        ('login', 'POST', None, lambda: {'path': '/login', 'data': {'username': ctx.resident, 'password': PASSWORD}}),
+        ('signup', 'GET', None, get('/signup')),
+        ('asset', 'GET', None, lambda: {'path': '/assets/' + assets.manifest['files']['app.css'], 'headers': {'Accept-Encoding': 'br, gzip'}}),
+        ('signup', 'POST', None, lambda: {'path': '/signup', 'data': {'username': 'bench%d' % ctx.next(), 'email': 'bench%d@example.com' % ctx.counter, 'password': PASSWORD}}),
+        ('logout', 'GET', 'resident', get('/logout')),
+        # resident
+        ('dashboard', 'GET', 'resident', get('/dashboard')),
+        ('booking', 'GET', 'resident', get('/booking')),
+        ('booking', 'GET', 'guest', get('/booking')),
+        ('booking', 'GET', 'guest', get('/booking?max_price=5000&order=-price')),
+        ('booking_room', 'POST', 'guest', get('/booking/1/room')),
+        ('booking_room_delete', 'POST', 'guest', get('/booking/room/delete')),
+        ('booking_mess', 'POST', 'guest', get('/booking/1/mess')),
+        ('booking_mess_delete', 'POST', 'guest', get('/booking/mess/delete')),
+        ('ticket', 'GET', 'resident', get('/ticket')),
+        ('ticket', 'POST', 'resident', lambda: {'path': '/ticket', 'data': {'title': 'bench %d' % ctx.next(), 'description': 'bench ticket'}}),
+        ('ticket_delete', 'GET', 'resident', lambda: {'path': '/ticket/%d/delete' % new_ticket()}),
+        ('announcement', 'GET', 'resident', get('/announcement')),
+        ('announcement_feed_json', 'GET', 'resident', get('/announcement/feed')),
+        ('announcement_delete', 'GET', 'resident', lambda: {'path': '/announcement/%d/delete' % new_announcement()}),
+        # admin
+        ('admin_dashboard', 'GET', 'admin', get('/admin/dashboard')),
+        ('admin_ticket', 'GET', 'admin', get('/admin/ticket')),
+        ('admin_ticket', 'POST', 'admin', lambda: {'path': '/admin/ticket', 'data': {'ticket_id': str(ctx.ticket_id), 'description': 'bench reply'}}),
+        ('admin_ticket_delete', 'GET', 'admin', lambda: {'path': '/admin/ticket/%d/delete' % new_ticket()}),
+        ('admin_announcement', 'GET', 'admin', get('/admin/announcement')),
+        ('admin_announcement', 'POST', 'admin', lambda: {'path': '/admin/announcement', 'data': {'title': 'bench %d' % ctx.next(), 'description': 'bench notice'}}),
+        ('admin_announcement_delete', 'GET', 'admin', lambda: {'path': '/admin/announcement/%d/delete' % new_announcement()}),
+        ('admin_search', 'GET', 'admin', get('/admin/search?q=water')),
+        ('admin_search', 'GET', 'admin', get('/admin/search?q=notice*&kind=announcement&page=2')),
+        ('admin_booking', 'GET', 'admin', get('/admin/booking')),
+        ('admin_booking', 'GET', 'admin', get('/admin/booking?status=pending')),
+        ('admin_booking_approve_room', 'POST', 'admin', get('/admin/booking/room/%s/approve' % ctx.resident)),
+        ('admin_booking_reject_room', 'POST', 'admin', get('/admin/booking/room/%s/reject' % ctx.resident)),
+        ('admin_booking_approve_mess', 'POST', 'admin', get('/admin/booking/mess/%s/approve' % ctx.resident)),
+        ('admin_booking_reject_mess', 'POST', 'admin', get('/admin/booking/mess/%s/reject' % ctx.resident)),
+        ('admin_booking_bulk', 'POST', 'admin', lambda: {'path': '/admin/booking/bulk', 'json': {'kind': 'room', 'action': 'approve', 'booking_ids': ctx.booking_ids}}),
+        ('admin_jobs', 'GET', 'admin', get('/admin/jobs')),
+        ('admin_ratelimits', 'GET', 'admin', get('/admin/ratelimits')),
+        ('admin_ratelimits_prometheus', 'GET', 'admin', get('/admin/ratelimits.txt')),
+        # job 1 is the notification queued by the first admin_ticket reply
+        ('admin_job', 'GET', 'admin', get('/admin/jobs/1')),
+        ('admin_billing', 'GET', 'admin', get('/admin/billing')),
+        ('admin_billing_orders', 'POST', 'admin', lambda: {'path': '/admin/billing/orders', 'json': {'orders': [
+            {'user_id': ctx.users['resident'], 'mess_id': 1, 'items': [{'menu_item_id': ctx.menu_item_id, 'quantity': 2}]} for _ in range(50)]}}),
+        ('admin_billing_invoices', 'POST', 'admin', lambda: {'path': '/admin/billing/invoices', 'data': {'period': '2026-%02d' % (1 + ctx.next() % 12)}}),
+        ('admin_charges', 'GET', 'admin', get('/admin/charges')),
+        ('admin_charges', 'POST', 'admin', lambda: {'path': '/admin/charges', 'data': {'period': '2026-%02d' % (1 + ctx.next() % 12)}}),
+        ('admin_data', 'GET', 'admin', get('/admin/data')),
+        ('admin_data_export', 'GET', 'admin', get('/admin/data/rooms.csv')),
+        ('admin_data_export', 'GET', 'admin', get('/admin/data/tickets.jsonl')),
+        ('admin_data_import', 'POST', 'admin', lambda: {'path': '/admin/data/import', 'headers': {'Accept': 'application/json'}, 'data': {
+            'table': 'tickets', 'file': (io.BytesIO(('user_id,title,description,status\n' + ''.join(
+                '%d,bench %d,imported ticket,pending\n' % (ctx.users['resident'], ctx.next()) for _ in range(50))).encode()), 'tickets.csv')}}),
+        ('admin_metrics', 'GET', 'admin', get('/admin/metrics')),
+        ('admin_metrics_json', 'GET', 'admin', get('/admin/metrics.json')),
+        ('admin_metrics_prometheus', 'GET', 'admin', get('/admin/metrics.txt')),
+        # JSON API
+        ('api_v1.rooms', 'GET', 'resident', get('/api/v1/rooms')),
+        ('api_v1.room_search', 'GET', 'resident', get('/api/v1/rooms/search?min_price=4500&bathroom=true')),
+        ('api_v1.room', 'GET', 'resident', get('/api/v1/rooms/1')),
+        ('api_v1.room_availability', 'GET', 'resident', get('/api/v1/rooms/1/availability')),
+        ('api_v1.messes', 'GET', 'resident', get('/api/v1/mess')),
+        ('api_v1.mess', 'GET', 'resident', get('/api/v1/mess/1')),
+        ('api_v1.room_bookings', 'GET', 'admin', get('/api/v1/bookings/room')),
+        ('api_v1.mess_bookings', 'GET', 'admin', get('/api/v1/bookings/mess')),
+        ('api_v1.tickets', 'GET', 'admin', get('/api/v1/tickets?fields=id,title,status')),
+        ('api_v1.announcements', 'GET', 'admin', get('/api/v1/announcements')),
+        ('api_v1.search', 'GET', 'admin', get('/api/v1/search?q=wifi&kind=ticket,reply')),
+        ('api_v1.search', 'GET', 'resident', get('/api/v1/search?q=water')),
+    ]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def summarize(latencies, elapsed):
+    return {
+        'requests': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+    }
+
+
+def label(endpoint, method, role, path):
+    query = path.partition('?')[2]
+    return '%s %s [%s]%s' % (method, endpoint, role or 'anonymous', '?' + query if query else '')
+
+
+def request(client, ctx, method, role, kwargs):
+    if role is not None:
+        login(client, ctx.users[role])
+    else:
+        with client.session_transaction() as session:
+            session.clear()
+    path = kwargs.pop('path')
+    start = time.perf_counter()
+    response = client.open(path, method=method, **kwargs)
+    elapsed = time.perf_counter() - start
+    if response.status_code not in OK_STATUSES:
+        raise RuntimeError('%s %s answered %d' % (method, path, response.status_code))
+    return elapsed
+
+
+def run_test_client(app, ctx, iterations, memory_iterations):
+    client = app.test_client()
+    results = {}
+    for endpoint, method, role, prepare in scenarios(ctx):
+        name = label(endpoint, method, role, prepare()['path'])
+        profiling.profiler.reset()
+        latencies = []
+        # some views print form errors; keep them out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            for _ in range(iterations):
+                latencies.append(request(client, ctx, method, role, prepare()))
+            elapsed = time.perf_counter() - started
+
+            tracemalloc.start()
+            peak = 0
+            for _ in range(memory_iterations):
+                kwargs = prepare()
+                if role is not None:
+                    login(client, ctx.users[role])
+                tracemalloc.reset_peak()
+                client.open(kwargs.pop('path'), method=method, **kwargs)
+                peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+        stats = profiling.profiler.snapshot()['endpoints'].get(endpoint)
+        result = summarize(latencies, elapsed)
+        result['queries_per_request'] = stats['queries'] / stats['requests'] if stats else 0.0
+        result['peak_memory_kib'] = peak / 1024.0
+        results[name] = result
+        print('%-52s p50 %7.2f  p95 %7.2f  p99 %7.2f ms  %7.1f req/s  %5.1f queries  %8.1f KiB' % (
+            name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['throughput_rps'], result['queries_per_request'], result['peak_memory_kib']))
+
+    covered = set(endpoint for endpoint, _, _, _ in scenarios(ctx))
+    missing = sorted(rule.endpoint for rule in app.url_map.iter_rules() if rule.endpoint != 'static' and rule.endpoint not in covered)
+    if missing:
+        print('not covered: %s' % ', '.join(missing))
+    return results
+
+
+def http_login(base, username):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    data = urllib.parse.urlencode({'username': username, 'password': PASSWORD}).encode()
+    opener.open(base + '/login', data).read()
+    return opener
+
+
+def load(url, openers, seconds):
+    """Request `url` in a loop from one thread per opener for `seconds`; returns the latencies."""
+    latencies = []
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def client(opener):
+        mine = []
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            opener.open(url).read()
+            mine.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(mine)
+
+    workers = [threading.Thread(target=client, args=(opener,)) for opener in openers]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return latencies
+
+
+def run_http(app, ctx, seconds, concurrency):
+    """Hammer the read-only pages over real HTTP with `concurrency` clients each."""
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:%d' % server.server_port
+    skipped = ('logout', 'ticket_delete', 'announcement_delete', 'admin_ticket_delete', 'admin_announcement_delete')
+    results = {}
+    out = sys.stdout
+    # server threads print too, so stdout is silenced for the whole pass
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            for endpoint, method, role, prepare in scenarios(ctx):
+                if method != 'GET' or endpoint in skipped:
+                    continue
+                path = prepare()['path']
+                openers = [http_login(base, ctx.usernames[role]) if role else urllib.request.build_opener() for _ in range(concurrency)]
+                started = time.perf_counter()
+                latencies = load(base + path, openers, seconds)
+                result = summarize(latencies, time.perf_counter() - started)
+                name = label(endpoint, method, role, path)
+                results[name] = result
+                print('%-52s p50 %7.2f  p95 %7.2f  p99 %7.2f ms  %7.1f req/s' % (
+                    name, result['p50_ms'], result['p95_ms'], result['p99_ms'], result['throughput_rps']), file=out)
+        finally:
+            server.shutdown()
+    return results
+
+
+def run(args):
+    scale = dict(SCALES[args.scale])
+    # bundles only; resizing the images would add seconds and no route
+    folder = tempfile.mkdtemp()
+    assets.build_assets(os.path.join(ROOT, 'static'), folder, images=False)
+    app = make_app(ASSETS_FOLDER=folder)
+    started = time.perf_counter()
+    with app.app_context():
+        scale = seed(**scale)
+    print('seeded %s in %.1fs' % (', '.join('%d %s' % (count, name) for name, count in scale.items()), time.perf_counter() - started))
+    ctx = Context(app, scale)
+
+    print('\ntest client, %d iterations per scenario' % args.iterations)
+    client_results = run_test_client(app, ctx, args.iterations, args.memory_iterations)
+    http_results = {}
+    if args.http_seconds > 0:
+        print('\nHTTP, %d concurrent clients for %.1fs per page' % (args.concurrency, args.http_seconds))
+        http_results = run_http(app, ctx, args.http_seconds, args.concurrency)
+
+    report = {
+        'meta': {
+            'scale': args.scale, 'rows': scale, 'iterations': args.iterations, 'concurrency': args.concurrency,
+            'python': platform.python_version(), 'platform': platform.platform(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'test_client': client_results,
+        'http': http_results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('\nresults written to %s' % args.output)
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = 0
+    for section in ('test_client', 'http'):
+        for name, new in sorted(current.get(section, {}).items()):
+            old = baseline.get(section, {}).get(name)
+            if old is None:
+                continue
+            change = (new['p95_ms'] - old['p95_ms']) / old['p95_ms'] if old['p95_ms'] else 0.0
+            flags = []
+            if change > args.threshold:
+                flags.append('p95 +%.0f%%' % (change * 100))
+            if new.get('queries_per_request', 0) > old.get('queries_per_request', 0) + 1e-9:
+                flags.append('queries %.1f -> %.1f' % (old['queries_per_request'], new['queries_per_request']))
+            regressions += bool(flags)
+            print('%-6s %-52s p95 %8.2f -> %8.2f ms  %s' % (section[:6], name, old['p95_ms'], new['p95_ms'], 'REGRESSION: ' + ', '.join(flags) if flags else 'ok'))
+    print('%d regression(s)' % regressions)
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run')
+    run_parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    run_parser.add_argument('--iterations', type=int, default=30)
+    run_parser.add_argument('--memory-iterations', type=int, default=3)
+    run_parser.add_argument('--http-seconds', type=float, default=2.0)
+    run_parser.add_argument('--concurrency', type=int, default=8)
+    run_parser.add_argument('--output', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.json'))
+    compare_parser = commands.add_parser('compare')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.2, help='allowed p95 growth, 0.2 = 20%%')
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+        return 0
+    return compare(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""Shared helpers for the benchmark scripts.
+
+The benchmarks build their own app with pghr.create_app(), pointed at a
+throwaway SQLite file so they never touch pghr/quantifiedself.db. Each app
+has its own page cache, rate limiter and identity cache, in
+app.extensions['pghr']. Seed data inside `with app.app_context():`.
+"""
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from pghr import create_app
+from pghr.config import Config
+from pghr.database import db
+from pghr.migrations import upgrade_db
+
+
+class BenchmarkConfig(Config):
+    SECRET_KEY = 'benchmark'
+    WTF_CSRF_ENABLED = False
+    PROFILING = True
+    # every benchmark client posts from 127.0.0.1
+    RATE_LIMITING = False
+
+
+def make_app(db_path=None, **settings):
+    if db_path is None:
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+    settings['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+    config = type('BenchmarkConfig', (BenchmarkConfig,), settings)
+    return create_app(config)
+
+
+def reset_db():
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    upgrade_db()
+
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+
+def time_get(client, url, repeat=5):
+    """Return the best wall time in milliseconds of `repeat` GETs."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        response = client.get(url)
+        elapsed = (time.perf_counter() - start) * 1000
+        assert response.status_code == 200, (url, response.status_code)
+        best = elapsed if best is None else min(best, elapsed)
+    return best
@@ -0,0 +1,11 @@
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get('WEB_THREADS', 2))
+# recycle workers now and then to cap memory growth
+max_requests = 1000
+max_requests_jitter = 100
+timeout = 30
+accesslog = '-'
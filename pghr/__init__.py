@@ -0,0 +1,63 @@
+"""Application factory.
+
+create_app() builds the Flask app for the config named by PGHR_CONFIG
+(development by default) or for the config class passed in. Each call
+returns an app with every route, so one process may build several. Every
+WSGI worker calls create_app(); the first to start migrates the schema and
+the others wait for it and find nothing to do.
+"""
+import os
+from flask import Flask
+from .config import config_from_env
+from .database import db, ma, engine_options, configure_sqlite
+from .replicas import replica_binds
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def create_app(config=None):
+    app = Flask('app', root_path=ROOT, template_folder='templates')
+    app.config.from_object(config or config_from_env())
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+    app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {}, **replica_binds(app))
+    db.init_app(app)
+    ma.init_app(app)
+
+    from .migrations import migrate_schema, upgrade_db_command
+    from .profiling import init_profiling
+    from .bookings import rebuild_occupancy_command
+    from .jobs import init_jobs, run_jobs_command, purge_jobs_command
+    from .billing import generate_invoices_command, rebuild_accounts_command
+    from .charges import run_charges_command
+    from .stats import rebuild_stats_command
+    from .search import rebuild_search_index_command
+    from .transfer import export_data_command, import_data_command
+    from .assets import init_assets, build_assets_command
+    from .events import event_report_command
+    from .controllers import init_controllers
+    init_profiling(app)
+    init_assets(app)
+    with app.app_context():
+        for engine in db.engines.values():
+            configure_sqlite(engine, app.config['SQLITE_WAL'], app.config['SQLITE_BUSY_TIMEOUT'])
+        migrate_schema()
+        db.session.remove()
+        from .api import api
+        from . import notifications  # noqa: F401 - registers the notification jobs
+    init_controllers(app)
+    app.register_blueprint(api)
+    app.cli.add_command(upgrade_db_command)
+    app.cli.add_command(rebuild_occupancy_command)
+    app.cli.add_command(run_jobs_command)
+    app.cli.add_command(purge_jobs_command)
+    app.cli.add_command(generate_invoices_command)
+    app.cli.add_command(rebuild_accounts_command)
+    app.cli.add_command(run_charges_command)
+    app.cli.add_command(rebuild_stats_command)
+    app.cli.add_command(rebuild_search_index_command)
+    app.cli.add_command(export_data_command)
+    app.cli.add_command(import_data_command)
+    app.cli.add_command(build_assets_command)
+    app.cli.add_command(event_report_command)
+    init_jobs(app)
+    return app
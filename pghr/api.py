@@ -0,0 +1,238 @@
+"""JSON API, version 1.
+
+List endpoints return {"data": [...], "next": cursor} pages, newest first,
+keyed on the primary key: pass ?cursor=<next> for the following page and
+?limit= (at most API_MAX_PAGE_SIZE) for the page size. ?fields=a,b selects
+columns from the resource's marshmallow schema; only those columns are
+queried and rows are dumped straight from the result tuples, skipping ORM
+objects. Residents see their own bookings and tickets, admins see everyone's.
+"""
+from datetime import date, datetime
+from functools import wraps
+from flask import Blueprint, current_app as app, jsonify, request
+from flask_login import current_user
+from .availability import AVAILABLE, FIELDS as SEARCH_FIELDS, SearchError, search_args, search_rooms
+from .reservations import ReservationError, book, check_stay, parse_day, stay_days
+from .search import QueryError, search as search_documents
+from .database import db
+from .replicas import read_only
+from .models import (
+    Room, room_schema, rooms_schema,
+    Mess, mess_schema, messes_schema,
+    RoomBookings, room_bookings_schema,
+    MessBookings, mess_bookings_schema,
+    Announcements, announcements_schema,
+    Ticket, tickets_schema,
+)
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api.errorhandler(ApiError)
+def handle_api_error(error):
+    return jsonify({'error': error.message}), error.status
+
+
+def api_login_required(view):
+    """Like login_required, but answers 401 instead of redirecting to the login page."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            raise ApiError('authentication required', 401)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def selected_fields(schema):
+    allowed = schema.opts.fields
+    fields = request.args.get('fields')
+    if not fields:
+        return allowed
+    fields = tuple(field.strip() for field in fields.split(',') if field.strip())
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ApiError('unknown fields: %s' % ', '.join(unknown))
+    return fields
+
+
+def int_arg(name, default=None):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise ApiError('%s must be an integer' % name)
+
+
+def dump_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def dump_rows(fields, rows):
+    return [{field: dump_value(value) for field, value in zip(fields, row)} for row in rows]
+
+
+def list_response(model, schema, *filters):
+    """Query one keyset page of `model` with only the selected columns and dump it."""
+    fields = selected_fields(schema)
+    limit = int_arg('limit', app.config['API_PAGE_SIZE'])
+    limit = max(1, min(limit, app.config['API_MAX_PAGE_SIZE']))
+    cursor = int_arg('cursor')
+
+    # the id column is always fetched last to build the next cursor
+    query = db.session.query(*[getattr(model, field) for field in fields], model.id).filter(*filters)
+    if cursor is not None:
+        query = query.filter(model.id < cursor)
+    rows = query.order_by(model.id.desc()).limit(limit + 1).all()
+    next_cursor = rows[limit - 1][-1] if len(rows) > limit else None
+    return jsonify({'data': dump_rows(fields, rows[:limit]), 'next': next_cursor})
+
+
+def owner_filters(model):
+    """Limit residents to their own rows; let admins filter by ?user_id=."""
+    if not current_user.admin:
+        return [model.user_id == current_user.id]
+    user_id = int_arg('user_id')
+    return [model.user_id == user_id] if user_id is not None else []
+
+
+def status_filters(model):
+    status = request.args.get('status')
+    return [model.status == status] if status else []
+
+
+@api.route('/rooms')
+@read_only
+@api_login_required
+def rooms():
+    return list_response(Room, rooms_schema, *status_filters(Room))
+
+
+@api.route('/rooms/search')
+@read_only
+@api_login_required
+def room_search():
+    """Available rooms with free beds, cheapest first (?order=-price for dearest first).
+
+    Filters: min_price, max_price, size, bathroom (true/false), min_free, and
+    starts_on/ends_on (YYYY-MM-DD) for the stay, today onwards by default.
+    """
+    limit = max(1, min(int_arg('limit', app.config['API_PAGE_SIZE']), app.config['API_MAX_PAGE_SIZE']))
+    try:
+        rooms, next_cursor = search_rooms(limit=limit, **search_args(request.args))
+    except SearchError as error:
+        raise ApiError(str(error))
+    return jsonify({'data': dump_rows(SEARCH_FIELDS, rooms), 'next': next_cursor})
+
+
+@api.route('/rooms/<int:id>')
+@read_only
+@api_login_required
+def room(id):
+    room = Room.query.get(id)
+    if room is None:
+        raise ApiError('room not found', 404)
+    return jsonify(room_schema.dump(room))
+
+
+@api.route('/rooms/<int:id>/availability')
+@read_only
+@api_login_required
+def room_availability(id):
+    """Whether the room has a bed free on every day of ?starts_on= to ?ends_on= (exclusive)."""
+    room = Room.query.get(id)
+    if room is None:
+        raise ApiError('room not found', 404)
+    try:
+        starts_on, ends_on = check_stay(parse_day(request.args.get('starts_on'), 'starts_on'), parse_day(request.args.get('ends_on'), 'ends_on'))
+    except ReservationError as error:
+        raise ApiError(str(error))
+    book.refresh(app.config['AVAILABILITY_MAX_AGE'])
+    taken = book.taken(room.id, *stay_days(starts_on, ends_on))
+    return jsonify({'room_id': room.id, 'starts_on': dump_value(starts_on), 'ends_on': dump_value(ends_on),
+                    'beds': room.size, 'taken': taken, 'free': room.status in AVAILABLE and taken < room.size})
+
+
+@api.route('/mess')
+@read_only
+@api_login_required
+def messes():
+    return list_response(Mess, messes_schema, *status_filters(Mess))
+
+
+@api.route('/mess/<int:id>')
+@read_only
+@api_login_required
+def mess(id):
+    mess = Mess.query.get(id)
+    if mess is None:
+        raise ApiError('mess not found', 404)
+    return jsonify(mess_schema.dump(mess))
+
+
+@api.route('/bookings/room')
+@read_only
+@api_login_required
+def room_bookings():
+    filters = owner_filters(RoomBookings) + status_filters(RoomBookings)
+    room_id = int_arg('room_id')
+    if room_id is not None:
+        filters.append(RoomBookings.room_id == room_id)
+    return list_response(RoomBookings, room_bookings_schema, *filters)
+
+
+@api.route('/bookings/mess')
+@read_only
+@api_login_required
+def mess_bookings():
+    filters = owner_filters(MessBookings) + status_filters(MessBookings)
+    mess_id = int_arg('mess_id')
+    if mess_id is not None:
+        filters.append(MessBookings.mess_id == mess_id)
+    return list_response(MessBookings, mess_bookings_schema, *filters)
+
+
+@api.route('/tickets')
+@read_only
+@api_login_required
+def tickets():
+    return list_response(Ticket, tickets_schema, *(owner_filters(Ticket) + status_filters(Ticket)))
+
+
+@api.route('/announcements')
+@read_only
+@api_login_required
+def announcements():
+    return list_response(Announcements, announcements_schema)
+
+
+@api.route('/search')
+@read_only
+@api_login_required
+def search():
+    """Tickets, replies and announcements matching every word of ?q=, best first.
+
+    ?kind=ticket,reply,announcement narrows the kinds; pages are numbered
+    (?page=, "next" is the following page number). title and snippet are
+    HTML with the matching words in <mark>. Residents find announcements and
+    their own tickets and replies.
+    """
+    limit = max(1, min(int_arg('limit', app.config['SEARCH_RESULTS_PER_PAGE']), app.config['API_MAX_PAGE_SIZE']))
+    page = int_arg('page', 1)
+    kinds = [kind.strip() for kind in request.args.get('kind', '').split(',') if kind.strip()]
+    try:
+        results, has_next = search_documents(request.args.get('q', ''), kinds, None if current_user.admin else current_user.id, page, limit)
+    except QueryError as error:
+        raise ApiError(str(error))
+    return jsonify({'data': [{name: dump_value(value) for name, value in result.items()} for result in results],
+                    'next': page + 1 if has_next else None})
@@ -0,0 +1,297 @@
+"""Self-hosted static assets with fingerprinted names.
+
+The base templates used to pull Bootstrap, jQuery, Popper, Font Awesome and
+Roboto from public CDNs. Those files are now vendored under static/vendor
+(see its README), and `flask build-assets` writes into ASSETS_FOLDER
+(static/dist by default):
+    app.<hash>.css  - the BUNDLES sources concatenated, with every url() in
+                      them pointing at a fingerprinted copy of the font
+    app.<hash>.js   - jQuery followed by Bootstrap's bundle (with Popper)
+    images/...      - each image under static/images re-encoded at the
+                      IMAGE_WIDTHS narrower than it, for <img srcset>
+    .gz / .br       - precompressed copies of the text files; brotli needs
+                      the optional `brotli` package
+    manifest.json   - logical name -> fingerprinted name
+Resizing needs the optional `Pillow` package; without it the images are
+only fingerprinted at full size.
+
+A file's name changes whenever its content does, so /assets/ responses are
+marked immutable and cached for ASSET_MAX_AGE; a browser never revalidates
+them and picks up a new build through the new names in the page. Builds
+leave older files in place for pages still holding their names.
+
+Templates call asset_urls('app.css'), asset_url('images/hero.jpg') and
+srcset('images/hero.jpg'). Until build-assets has run they fall back to the
+unbundled files under /static, so development needs no build step; run it
+again after changing a static file.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import math
+import mimetypes
+import os
+import re
+import shutil
+import click
+from flask import current_app, request, send_from_directory, url_for
+from flask.cli import with_appcontext
+
+log = logging.getLogger(__name__)
+
+BUNDLES = {
+    'app.css': ('vendor/bootstrap/bootstrap.min.css', 'vendor/font-awesome/css/font-awesome.min.css',
+                'vendor/roboto/roboto.css', 'css/index.css'),
+    'app.js': ('vendor/jquery/jquery.min.js', 'vendor/bootstrap/bootstrap.bundle.min.js'),
+}
+IMAGES = 'images'
+IMAGE_WIDTHS = (480, 960, 1600)
+IMAGE_QUALITY = 80
+EXIF_ORIENTATION = 0x0112
+# worth compressing; fonts in woff/woff2 and images already are
+COMPRESSED_TYPES = ('.css', '.js', '.svg', '.eot', '.ttf', '.json')
+# Content-Encoding and file suffix of the precompressed copies, preferred first
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+SOURCE_MAP = re.compile(r'\n?(//# sourceMappingURL=\S+|/\*# sourceMappingURL=\S+ \*/)\s*$')
+
+# set by init_assets(); the names the templates link to
+manifest = {'files': {}, 'srcsets': {}}
+
+
+class AssetError(Exception):
+    pass
+
+
+def fingerprint(name, data):
+    """'css/app.css' -> 'css/app.<hash>.css' for the given content."""
+    root, extension = os.path.splitext(name)
+    return '%s.%s%s' % (root, hashlib.sha256(data).hexdigest()[:12], extension)
+
+
+class Build():
+    def __init__(self, static, output):
+        self.static = static
+        self.output = output
+        self.files = {}
+        self.srcsets = {}
+        self.sizes = {}
+
+    def write(self, name, data):
+        """Store data under its fingerprinted name, with compressed copies."""
+        path = os.path.join(self.output, name)
+        # the name says what is in the file, so one left by an earlier build is kept
+        if not os.path.isfile(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if name.endswith(COMPRESSED_TYPES):
+                with open(path + '.gz', 'wb') as f:
+                    f.write(gzip.compress(data, 9, mtime=0))
+                try:
+                    import brotli
+                    with open(path + '.br', 'wb') as f:
+                        f.write(brotli.compress(data))
+                except ImportError:
+                    pass
+            # written last: its presence means the copies are complete
+            with open(path, 'wb') as f:
+                f.write(data)
+        self.sizes[name] = {'raw': len(data)}
+        for encoding, suffix in ENCODINGS:
+            if os.path.isfile(path + suffix):
+                self.sizes[name][encoding] = os.path.getsize(path + suffix)
+
+    def publish(self, name, data):
+        if name not in self.files:
+            self.files[name] = fingerprint(name, data)
+            self.write(self.files[name], data)
+        return self.files[name]
+
+    def read(self, name):
+        path = os.path.join(self.static, name)
+        if not os.path.isfile(path):
+            raise AssetError('%s not found in %s' % (name, self.static))
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def css(self, name):
+        """A stylesheet with its url()s pointing at published copies of their files."""
+        text = SOURCE_MAP.sub('', self.read(name).decode('utf-8'))
+
+        def rewrite(match):
+            reference = match.group(2)
+            if reference.startswith(('data:', 'http:', 'https:', '//', '/', '#')):
+                return match.group(0)
+            path, query = re.match(r'([^?#]*)(.*)', reference).groups()
+            target = os.path.normpath(os.path.join(os.path.dirname(name), path)).replace(os.sep, '/')
+            try:
+                data = self.read(target)
+            except AssetError:
+                raise AssetError('%s refers to %s, which is not in %s' % (name, path, self.static))
+            return "url('%s%s')" % (self.publish(target, data), query)
+        return CSS_URL.sub(rewrite, text)
+
+    def bundle(self, name, sources):
+        if name.endswith('.css'):
+            parts = [self.css(source) for source in sources]
+        else:
+            parts = [SOURCE_MAP.sub('', self.read(source).decode('utf-8')) for source in sources]
+        # `;` keeps one script's last statement from running into the next
+        data = ('\n' if name.endswith('.css') else ';\n').join(parts).encode('utf-8')
+        self.files[name] = fingerprint(name, data)
+        self.write(self.files[name], data)
+
+    def images(self):
+        try:
+            from PIL import Image, ImageOps
+        except ImportError:
+            Image = None
+            log.warning('Pillow is not installed; images are published at full size only')
+        for directory, _, files in sorted(os.walk(os.path.join(self.static, IMAGES))):
+            for file in sorted(files):
+                if not file.lower().endswith(('.jpg', '.jpeg', '.png')):
+                    continue
+                name = os.path.relpath(os.path.join(directory, file), self.static).replace(os.sep, '/')
+                if Image is None:
+                    self.publish(name, self.read(name))
+                else:
+                    self.resize(name, Image, ImageOps)
+
+    def resize(self, name, Image, ImageOps):
+        # named after the source's hash, so an unchanged image is not encoded again
+        root, extension = os.path.splitext(fingerprint(name, self.read(name)))
+        with Image.open(os.path.join(self.static, name)) as image:
+            width, height = image.size
+            if image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+                width, height = height, width
+            sizes = [size for size in IMAGE_WIDTHS if size < width] or [width]
+            # lets the JPEG decoder scale down by up to 8 while it reads
+            scale = sizes[-1] / width
+            image.draft('RGB', (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+            upright = None
+            variants = []
+            for size in sizes:
+                variant = '%s.%d%s' % (root, size, extension)
+                path = os.path.join(self.output, variant)
+                if not os.path.isfile(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    if upright is None:
+                        upright = ImageOps.exif_transpose(image)
+                    resized = upright.resize((size, round(height * size / width)), Image.LANCZOS)
+                    if extension.lower() == '.png':
+                        resized.save(path, optimize=True)
+                    else:
+                        resized.convert('RGB').save(path, quality=IMAGE_QUALITY, optimize=True, progressive=True)
+                self.sizes[variant] = {'raw': os.path.getsize(path)}
+                variants.append([size, variant])
+        self.srcsets[name] = variants
+        # for browsers without srcset, and for asset_url()
+        self.files[name] = variants[-1][1]
+
+    def manifest(self):
+        data = json.dumps({'files': self.files, 'srcsets': self.srcsets}, indent=1, sort_keys=True).encode('utf-8')
+        path = os.path.join(self.output, 'manifest.json')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        # replaced in one step, so a starting worker never reads half of it
+        os.replace(path + '.tmp', path)
+
+
+def build_assets(static, output, images=True):
+    """Bundle, fingerprint and compress the static files into output; returns the Build."""
+    os.makedirs(output, exist_ok=True)
+    build = Build(static, output)
+    for name, sources in BUNDLES.items():
+        build.bundle(name, sources)
+    if images:
+        build.images()
+    build.manifest()
+    return build
+
+
+def sources(static):
+    """Every file a build reads, for telling whether the manifest is out of date."""
+    names = [source for bundle in BUNDLES.values() for source in bundle]
+    for directory, _, files in os.walk(os.path.join(static, 'vendor')):
+        names.extend(os.path.relpath(os.path.join(directory, file), static) for file in files)
+    for directory, _, files in os.walk(os.path.join(static, IMAGES)):
+        names.extend(os.path.relpath(os.path.join(directory, file), static) for file in files)
+    return [os.path.join(static, name) for name in names]
+
+
+def load_manifest(app):
+    path = os.path.join(app.config['ASSETS_FOLDER'], 'manifest.json')
+    if not os.path.isfile(path):
+        return {'files': {}, 'srcsets': {}}
+    with open(path, encoding='utf-8') as f:
+        loaded = json.load(f)
+    built = os.path.getmtime(path)
+    if any(os.path.getmtime(source) > built for source in sources(app.static_folder) if os.path.isfile(source)):
+        log.warning('static files changed since the last `flask build-assets`; the pages still link to the old build')
+    return loaded
+
+
+def asset_urls(name):
+    """URLs of a bundle: the built file, or its sources before build-assets has run."""
+    built = manifest['files'].get(name)
+    if built:
+        return [url_for('asset', filename=built)]
+    return [url_for('static', filename=source) for source in BUNDLES[name]]
+
+
+def asset_url(name):
+    built = manifest['files'].get(name)
+    return url_for('asset', filename=built) if built else url_for('static', filename=name)
+
+
+def srcset(name):
+    """'<url> 480w, <url> 960w, ...' for an image's resized copies; empty before a build."""
+    return ', '.join('%s %dw' % (url_for('asset', filename=variant), width) for width, variant in manifest['srcsets'].get(name, ()))
+
+
+def send_asset(filename):
+    folder = current_app.config['ASSETS_FOLDER']
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for encoding, suffix in ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.isfile(os.path.join(folder, filename + suffix)):
+            response = send_from_directory(folder, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(folder, filename, mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['ASSET_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
+
+
+def init_assets(app):
+    global manifest
+    manifest = load_manifest(app)
+    app.add_url_rule('/assets/<path:filename>', 'asset', send_asset)
+    app.jinja_env.globals.update(asset_urls=asset_urls, asset_url=asset_url, srcset=srcset)
+
+
+def kilobytes(size):
+    return '%.1f kB' % (size / 1000)
+
+
+@click.command('build-assets')
+@click.option('--clean', is_flag=True, help='Delete earlier builds first; cached pages may still link to them.')
+@with_appcontext
+def build_assets_command(clean):
+    """Bundle, fingerprint and precompress the static files for /assets."""
+    output = current_app.config['ASSETS_FOLDER']
+    if clean and os.path.isdir(output):
+        shutil.rmtree(output)
+    build = build_assets(current_app.static_folder, output)
+    for name in BUNDLES:
+        sizes = build.sizes[build.files[name]]
+        click.echo('%-8s %s, %s' % (name, kilobytes(sizes['raw']), ', '.join(
+            '%s %s' % (kilobytes(size), encoding) for encoding, size in sizes.items() if encoding != 'raw')))
+    for name, variants in build.srcsets.items():
+        original = os.path.getsize(os.path.join(current_app.static_folder, name))
+        click.echo('%s %s -> %s' % (name, kilobytes(original), ', '.join(
+            '%s at %dw' % (kilobytes(build.sizes[variant]['raw']), width) for width, variant in variants)))
+    click.echo('Assets written to %s.' % output)
@@ -0,0 +1,219 @@
+"""In-process room availability index for searches.
+
+The index holds one small tuple per available room (price, size, attached
+bathroom, name) from the room table. Free beds for the requested stay come
+from the reservation book (pghr.reservations) in O(log days) per room, so a
+search never reads the bookings table. Rooms are bucketed by (size,
+attached_bathroom), each bucket sorted by (price, id), so a search merges
+the buckets its filters allow from the start of the price range and stops as
+soon as it has a page.
+
+Writes keep both current: claiming or releasing a bed and editing a room
+record the room id in the session, and after the commit those rooms are
+marked stale; the next search reloads just them. Changes committed by other
+processes are picked up by a full reload every AVAILABILITY_MAX_AGE seconds.
+"""
+import heapq
+import threading
+import time
+from bisect import bisect_left, bisect_right, insort
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from .database import db
+from .replicas import primary_reads
+from .models import Room
+from .reservations import ReservationError, book, check_stay, parse_day, stay_days
+
+# Room.status values for a room open to bookings; older rows spell it out
+AVAILABLE = ('A', 'available')
+
+ORDERS = ('price', '-price')
+
+# columns of a search result row
+FIELDS = ('id', 'name', 'price', 'size', 'attached_bathroom', 'free')
+
+
+class SearchError(Exception):
+    pass
+
+
+class AvailabilityIndex():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}    # id -> (price, size, attached_bathroom, name)
+        self.buckets = {}  # (size, attached_bathroom) -> sorted [(price, id)]
+        self.stale = set()
+        self.loaded_at = None
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def mark_stale(self, ids):
+        with self.lock:
+            self.stale.update(ids)
+
+    def expire(self):
+        """Reload every room on the next search."""
+        with self.lock:
+            self.loaded_at = None
+
+    def put(self, id, name, price, size, bathroom, status):
+        self.remove(id)
+        if status in AVAILABLE:
+            self.rooms[id] = (price, size, bool(bathroom), name)
+            insort(self.buckets.setdefault((size, bool(bathroom)), []), (price, id))
+
+    def remove(self, id):
+        room = self.rooms.pop(id, None)
+        if room is not None:
+            bucket = self.buckets[room[1], room[2]]
+            del bucket[bisect_left(bucket, (room[0], id))]
+
+    def refresh(self, max_age):
+        """Reload stale rooms, or everything once the index is older than `max_age` seconds."""
+        with self.lock:
+            full = self.loaded_at is None or time.monotonic() - self.loaded_at > max_age
+            ids, self.stale = self.stale, set()
+        if not full and not ids:
+            return
+        query = db.session.query(Room.id, Room.name, Room.price, Room.size, Room.attached_bathroom, Room.status)
+        if full:
+            started = time.monotonic()
+            rooms, buckets = {}, {}
+            # from the primary, so a lagging replica cannot undo a refresh
+            with primary_reads():
+                available = query.filter(Room.status.in_(AVAILABLE)).all()
+            for id, name, price, size, bathroom, status in available:
+                rooms[id] = (price, size, bool(bathroom), name)
+                buckets.setdefault((size, bool(bathroom)), []).append((price, id))
+            for bucket in buckets.values():
+                bucket.sort()
+            with self.lock:
+                self.rooms, self.buckets, self.loaded_at = rooms, buckets, started
+            return
+        with primary_reads():
+            rows = query.filter(Room.id.in_(ids)).all()
+        with self.lock:
+            for id in ids:
+                self.remove(id)
+            for row in rows:
+                self.put(*row)
+
+    def search(self, min_price=None, max_price=None, size=None, bathroom=None, min_free=1, order='price', after=None, limit=20, days=(0, 1)):
+        """Rooms matching the filters as [(id, name, price, size, attached_bathroom, free)].
+
+        `free` is the fewest beds free on any day of `days`, a [start, end)
+        range of day numbers; rooms with fewer than `min_free` are skipped.
+        Sorted by price (`order` 'price' or '-price'), then id; `after` is the
+        (price, id) of the last room on the previous page. Returns limit + 1
+        rooms at most, so the caller can tell whether there is another page.
+        """
+        descending = order == '-price'
+        low = (min_price if min_price is not None else float('-inf'), 0)
+        high = (max_price if max_price is not None else float('inf'), float('inf'))
+        if after is not None:
+            if descending:
+                high = min(high, after)
+            else:
+                low = max(low, after)
+        with self.lock:
+            slices = []
+            for (bucket_size, bucket_bathroom), bucket in self.buckets.items():
+                if (size is not None and bucket_size != size) or (bathroom is not None and bucket_bathroom != bathroom):
+                    continue
+                # ids start at 1 and are never infinite, so both bounds exclude `after` itself
+                matched = bucket[bisect_right(bucket, low):bisect_left(bucket, high)]
+                slices.append(reversed(matched) if descending else matched)
+            found = []
+            for price, id in heapq.merge(*slices, reverse=descending):
+                room = self.rooms[id]
+                free = room[1] - book.taken(id, *days)
+                if free >= min_free:
+                    found.append((id, room[3], price, room[1], room[2], free))
+                    if len(found) > limit:
+                        break
+            return found
+
+
+index = AvailabilityIndex()
+
+
+def search_rooms(min_price=None, max_price=None, size=None, bathroom=None, min_free=1, order='price', cursor=None, limit=20, starts_on=None, ends_on=None):
+    """One page of rooms free for [starts_on, ends_on) and the cursor of the next page (None on the last).
+
+    The stay starts today and is open-ended by default.
+    """
+    try:
+        days = stay_days(*check_stay(starts_on, ends_on))
+    except ReservationError as error:
+        raise SearchError(str(error))
+    if order not in ORDERS:
+        raise SearchError('order must be one of: %s' % ', '.join(ORDERS))
+    if min_free < 1:
+        raise SearchError('free beds must be at least 1')
+    after = None
+    if cursor:
+        try:
+            price, id = cursor.split(':')
+            after = (int(price), int(id))
+        except ValueError:
+            raise SearchError('invalid cursor')
+    index.refresh(current_app.config['AVAILABILITY_MAX_AGE'])
+    book.refresh(current_app.config['AVAILABILITY_MAX_AGE'])
+    rooms = index.search(min_price, max_price, size, bathroom, min_free, order, after, limit, days)
+    if len(rooms) > limit:
+        return rooms[:limit], '%d:%d' % (rooms[limit - 1][2], rooms[limit - 1][0])
+    return rooms, None
+
+
+def search_args(args):
+    """search_rooms() keyword arguments from query string parameters."""
+    kwargs = {}
+    for name in ('min_price', 'max_price', 'size', 'min_free'):
+        value = args.get(name, '').strip()
+        if value:
+            try:
+                kwargs[name] = int(value)
+            except ValueError:
+                raise SearchError('%s must be a whole number' % name.replace('_', ' '))
+    bathroom = args.get('bathroom', '').strip().lower()
+    if bathroom:
+        if bathroom not in ('true', 'false', '1', '0', 'yes', 'no'):
+            raise SearchError('bathroom must be true or false')
+        kwargs['bathroom'] = bathroom in ('true', '1', 'yes')
+    for name in ('order', 'cursor'):
+        if args.get(name):
+            kwargs[name] = args[name]
+    try:
+        for name in ('starts_on', 'ends_on'):
+            kwargs[name] = parse_day(args.get(name), name.replace('_', ' '))
+    except ReservationError as error:
+        raise SearchError(str(error))
+    return kwargs
+
+
+def room_changed(*ids, session=None):
+    """Refresh these rooms in the index once the current transaction commits."""
+    (session or db.session).info.setdefault('rooms_changed', set()).update(ids)
+
+
+def record_room(mapper, connection, target):
+    room_changed(target.id, session=Session.object_session(target))
+
+
+for event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Room, event_name, record_room)
+
+
+@event.listens_for(Session, 'after_commit')
+def refresh_after_commit(session):
+    changed = session.info.pop('rooms_changed', None)
+    if changed:
+        index.mark_stale(changed)
+        book.mark_stale(changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_after_rollback(session):
+    session.info.pop('rooms_changed', None)
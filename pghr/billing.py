@@ -0,0 +1,273 @@
+"""Restaurant billing: menu items, orders and invoices.
+
+Orders arrive in batches through ingest_orders(). A batch is validated
+against the menu in memory, then orders and their line items are written
+with executemany inserts, a chunk at a time. Every order carries a unique
+reference (the till's receipt number, or a generated one), so a batch that
+is sent twice only creates its orders once.
+
+Each resident has a BillingAccount row with running totals: everything
+ordered and everything invoiced so far. Ingestion adds to the order totals;
+generate_invoices() bills the orders that are not on an invoice yet and were
+made before the period ends, found through the invoice_id index, so
+month-end billing never rescans old orders and orders placed after a month
+never go on its invoice. There is at most one invoice per resident and
+period, so running it twice for a month changes nothing.
+"""
+import uuid
+from datetime import date, datetime, time
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, func, update
+from .database import db
+from .models import User, Mess, MenuItem, Order, OrderItem, Invoice, BillingAccount
+
+# rows per executemany / IN list
+CHUNK = 1000
+MAX_QUANTITY = 1000
+
+
+class BillingError(Exception):
+    pass
+
+
+def chunked(values, size=CHUNK):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def existing_ids(column, ids):
+    found = set()
+    for chunk in chunked(ids):
+        found.update(id for id, in db.session.query(column).filter(column.in_(chunk)))
+    return found
+
+
+def parse_time(value):
+    if value is None:
+        return datetime.utcnow()
+    if isinstance(value, datetime):
+        return value
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        raise BillingError('created_at must be an ISO 8601 timestamp')
+
+
+def as_int(value, name):
+    if isinstance(value, bool):
+        raise BillingError('%s must be an integer' % name)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise BillingError('%s must be an integer' % name)
+
+
+def check_order(order, menu, users, messes):
+    """Return (reference, user_id, mess_id, created_at, lines) or raise BillingError."""
+    if not isinstance(order, dict):
+        raise BillingError('order must be an object')
+    user_id = as_int(order.get('user_id'), 'user_id')
+    mess_id = as_int(order.get('mess_id'), 'mess_id')
+    if user_id not in users:
+        raise BillingError('no such user %d' % user_id)
+    if mess_id not in messes:
+        raise BillingError('no such mess %d' % mess_id)
+    items = order.get('items')
+    if not items or not isinstance(items, list):
+        raise BillingError('an order needs at least one item')
+    lines = []
+    for item in items:
+        if not isinstance(item, dict):
+            raise BillingError('item must be an object')
+        menu_item_id = as_int(item.get('menu_item_id'), 'menu_item_id')
+        quantity = as_int(item.get('quantity', 1), 'quantity')
+        if menu_item_id not in menu:
+            raise BillingError('no such menu item %d' % menu_item_id)
+        item_mess_id, price, status = menu[menu_item_id]
+        if item_mess_id != mess_id:
+            raise BillingError('menu item %d is not served by mess %d' % (menu_item_id, mess_id))
+        if status != 'A':
+            raise BillingError('menu item %d is not available' % menu_item_id)
+        if not 0 < quantity <= MAX_QUANTITY:
+            raise BillingError('quantity must be between 1 and %d' % MAX_QUANTITY)
+        lines.append((menu_item_id, quantity, price, price * quantity))
+    reference = str(order.get('reference') or uuid.uuid4().hex)[:40]
+    return reference, user_id, mess_id, parse_time(order.get('created_at')), lines
+
+
+def ingest_orders(orders):
+    """Validate and insert a batch of order dicts. The caller commits.
+
+    An order is {"user_id", "mess_id", "items": [{"menu_item_id", "quantity"}],
+    "reference" (optional), "created_at" (optional, ISO 8601)}. Invalid orders
+    are skipped and reported; the rest are inserted. Returns
+    {"created": n, "duplicates": n, "errors": [{"index": i, "error": message}]}.
+    """
+    def ids(values):
+        found = set()
+        for value in values:
+            try:
+                found.add(as_int(value, 'id'))
+            except BillingError:
+                pass
+        return found
+
+    orders = [order if isinstance(order, dict) else None for order in orders]
+    items = [item for order in orders if order and isinstance(order.get('items'), list)
+             for item in order['items'] if isinstance(item, dict)]
+    menu_item_ids = ids(item.get('menu_item_id') for item in items)
+    menu = {}
+    for chunk in chunked(menu_item_ids):
+        menu.update((id, (mess_id, price, status)) for id, mess_id, price, status in
+                    db.session.query(MenuItem.id, MenuItem.mess_id, MenuItem.price, MenuItem.status).filter(MenuItem.id.in_(chunk)))
+    users = existing_ids(User.id, ids(order.get('user_id') for order in orders if order))
+    messes = existing_ids(Mess.id, ids(order.get('mess_id') for order in orders if order))
+
+    errors = []
+    valid = {}
+    for index, order in enumerate(orders):
+        try:
+            checked = check_order(order, menu, users, messes)
+        except BillingError as error:
+            errors.append({'index': index, 'error': str(error)})
+            continue
+        if checked[0] in valid:
+            errors.append({'index': index, 'error': 'reference %s appears twice in the batch' % checked[0]})
+            continue
+        valid[checked[0]] = checked
+
+    duplicates = existing_ids(Order.reference, valid)
+    accounts = {}
+    created = 0
+    for chunk in chunked(reference for reference in valid if reference not in duplicates):
+        db.session.execute(Order.__table__.insert(), [
+            {'reference': reference, 'user_id': user_id, 'mess_id': mess_id, 'created_at': created_at,
+             'total': sum(line[3] for line in lines)}
+            for reference, user_id, mess_id, created_at, lines in (valid[reference] for reference in chunk)])
+        order_ids = dict(db.session.query(Order.reference, Order.id).filter(Order.reference.in_(chunk)))
+        line_rows = []
+        for reference in chunk:
+            _, user_id, _, _, lines = valid[reference]
+            line_rows.extend({'order_id': order_ids[reference], 'menu_item_id': menu_item_id, 'quantity': quantity,
+                              'unit_price': price, 'amount': amount} for menu_item_id, quantity, price, amount in lines)
+            total, count = accounts.get(user_id, (0, 0))
+            accounts[user_id] = (total + sum(line[3] for line in lines), count + 1)
+        db.session.execute(OrderItem.__table__.insert(), line_rows)
+        created += len(chunk)
+    add_to_accounts(accounts)
+    return {'created': created, 'duplicates': len(duplicates), 'errors': errors}
+
+
+def add_to_accounts(orders=None, invoiced=None):
+    """Add {user_id: (amount, count)} to the residents' order or invoiced running totals."""
+    table = BillingAccount.__table__
+    for column, changes in (('order', orders), ('invoiced', invoiced)):
+        if not changes:
+            continue
+        known = existing_ids(BillingAccount.user_id, changes)
+        new = [{'user_id': user_id, 'order_total': 0, 'order_count': 0, 'invoiced_total': 0, 'invoiced_count': 0,
+                column + '_total': amount, column + '_count': count}
+               for user_id, (amount, count) in changes.items() if user_id not in known]
+        if new:
+            db.session.execute(table.insert(), new)
+        statement = table.update().where(table.c.user_id == bindparam('account')).values({
+            column + '_total': table.c[column + '_total'] + bindparam('amount'),
+            column + '_count': table.c[column + '_count'] + bindparam('count'),
+        })
+        old = [{'account': user_id, 'amount': amount, 'count': count} for user_id, (amount, count) in changes.items() if user_id in known]
+        if old:
+            db.session.execute(statement, old)
+
+
+def current_period():
+    return date.today().strftime('%Y-%m')
+
+
+def check_period(period):
+    try:
+        datetime.strptime(period, '%Y-%m')
+    except (TypeError, ValueError):
+        raise BillingError('period must look like YYYY-MM')
+    return period
+
+
+def period_bounds(period):
+    """The first day of `period` and the first day of the month after it."""
+    first = datetime.strptime(check_period(period), '%Y-%m').date()
+    following = date(first.year + first.month // 12, first.month % 12 + 1, 1)
+    return first, following
+
+
+def generate_invoices(period):
+    """Invoice every resident's uninvoiced orders made before `period` (YYYY-MM) ends, and commit.
+
+    Orders made after the period wait for a later one. Residents who already
+    have an invoice for the period are left alone; their newer orders go on
+    the next period's invoice. Returns the number of invoices.
+    """
+    end = datetime.combine(period_bounds(period)[1], time.min)
+    owes = BillingAccount.order_count > BillingAccount.invoiced_count
+    # SQLite ignores FOR UPDATE; a no-op write takes its lock first, so a concurrent run waits and then finds these invoices
+    db.session.execute(update(BillingAccount).where(owes).values(order_count=BillingAccount.order_count).execution_options(synchronize_session=False))
+    # lock the accounts with something to bill, then total their orders up to the period's end
+    owing = db.session.query(BillingAccount.user_id).filter(owes).with_for_update().all()
+    due = []
+    for chunk in chunked(user_id for user_id, in owing):
+        due.extend(db.session.query(Order.user_id, func.sum(Order.total), func.count(Order.id))
+                   .filter(Order.invoice_id == None, Order.user_id.in_(chunk), Order.created_at < end).group_by(Order.user_id))  # noqa: E711
+    invoiced = set()
+    for chunk in chunked([user_id for user_id, _, _ in due]):
+        invoiced.update(user_id for user_id, in db.session.query(Invoice.user_id).filter(Invoice.period == period, Invoice.user_id.in_(chunk)))
+    due = [(user_id, total, count) for user_id, total, count in due if user_id not in invoiced]
+    now = datetime.utcnow()
+    for chunk in chunked(due):
+        db.session.execute(Invoice.__table__.insert(), [
+            {'user_id': user_id, 'period': period, 'total': total, 'orders': count, 'created_at': now}
+            for user_id, total, count in chunk])
+        # attach exactly the orders totalled above: this resident's uninvoiced ones up to the period's end
+        invoice_id = db.session.query(Invoice.id).filter(Invoice.user_id == Order.user_id, Invoice.period == period).scalar_subquery()
+        db.session.query(Order).filter(Order.invoice_id == None, Order.user_id.in_([user_id for user_id, _, _ in chunk]), Order.created_at < end) \
+            .update({Order.invoice_id: invoice_id}, synchronize_session=False)  # noqa: E711
+    add_to_accounts(invoiced={user_id: (total, count) for user_id, total, count in due})
+    db.session.commit()
+    return len(due)
+
+
+def rebuild_accounts():
+    """Recount every BillingAccount from the orders and invoices tables."""
+    table = BillingAccount.__table__
+    db.session.execute(table.delete())
+    totals = {}
+    for user_id, total, count in db.session.query(Order.user_id, func.sum(Order.total), func.count(Order.id)).group_by(Order.user_id):
+        totals[user_id] = [total, count, 0, 0]
+    for user_id, total, count in db.session.query(Invoice.user_id, func.sum(Invoice.total), func.sum(Invoice.orders)).group_by(Invoice.user_id):
+        totals.setdefault(user_id, [0, 0, 0, 0])[2:] = [total, count]
+    for chunk in chunked(totals.items()):
+        db.session.execute(table.insert(), [
+            {'user_id': user_id, 'order_total': order_total, 'order_count': order_count,
+             'invoiced_total': invoiced_total, 'invoiced_count': invoiced_count}
+            for user_id, (order_total, order_count, invoiced_total, invoiced_count) in chunk])
+    db.session.commit()
+
+
+@click.command('generate-invoices')
+@click.option('--period', default=None, help='Billing month as YYYY-MM, the current month by default.')
+@with_appcontext
+def generate_invoices_command(period):
+    """Invoice residents for their uninvoiced restaurant orders."""
+    period = period or current_period()
+    try:
+        count = generate_invoices(period)
+    except BillingError as error:
+        raise click.BadParameter(str(error), param_hint='--period')
+    click.echo('Created %d invoices for %s.' % (count, period))
+
+
+@click.command('rebuild-billing-accounts')
+@with_appcontext
+def rebuild_accounts_command():
+    """Recount residents' running billing totals from orders and invoices."""
+    rebuild_accounts()
+    click.echo('Billing accounts rebuilt.')
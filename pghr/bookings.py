@@ -0,0 +1,249 @@
+"""Booking engine for rooms and mess.
+
+A resident holds at most one room booking and one mess booking, enforced by
+unique indexes on user_id so concurrent submissions cannot both succeed.
+
+A room booking reserves a bed for a range of days (see pghr.reservations).
+Room.occupancy counts the pending or approved bookings for the room. A bed
+is claimed by first incrementing occupancy, which locks the room's row, and
+then checking the stay against the room's overlapping bookings in the same
+transaction, so a room can never be over-booked no matter how many requests
+race for its last bed. The booking insert runs in the same transaction, so a
+rejected insert also returns the bed.
+
+Functions that change a booking's status or delete it only adjust occupancy;
+the caller commits, so several changes can share one transaction. Single and
+bulk status changes follow the same TRANSITIONS: only a pending booking can
+be approved, and only a pending or approved one cancelled.
+"""
+from datetime import date
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import case, func, update
+from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from . import events, stats
+from .availability import index as availability_index, room_changed
+from .reservations import HOLDING_STATUSES, ReservationError, beds_taken, book as reservation_book, check_stay
+from .database import db
+from .jobs import job, enqueue
+from .models import Room, Mess, RoomBookings, MessBookings
+
+BOOKING_MODELS = {'room': RoomBookings, 'mess': MessBookings}
+
+# status: the statuses a booking can be changed to it from
+TRANSITIONS = {'approved': ('pending',), 'cancelled': HOLDING_STATUSES}
+
+
+class BookingError(Exception):
+    pass
+
+
+def claim_bed(room_id, starts_on=None, ends_on=None):
+    """Take one bed in the room for [starts_on, ends_on), from today and open-ended by default.
+
+    Returns False when there is no such room or no bed is free on every day of the stay.
+    """
+    # the UPDATE locks the room's row, so claims on one room are checked one at a time
+    statement = update(Room).where(Room.id == room_id).values(occupancy=Room.occupancy + 1)
+    if db.session.execute(statement.execution_options(synchronize_session=False)).rowcount != 1:
+        return False
+    size = db.session.query(Room.size).filter(Room.id == room_id).scalar()
+    # days already past cannot be double-booked any more
+    if beds_taken(room_id, max(starts_on or date.today(), date.today()), ends_on) >= size:
+        release_bed(room_id)
+        return False
+    room_changed(room_id)
+    return True
+
+
+def release_bed(room_id):
+    statement = update(Room).where(Room.id == room_id, Room.occupancy > 0).values(occupancy=Room.occupancy - 1)
+    db.session.execute(statement.execution_options(synchronize_session=False))
+    room_changed(room_id)
+
+
+def book_room(user_id, room_id, starts_on=None, ends_on=None):
+    """Reserve a bed for [starts_on, ends_on); from today and open-ended by default."""
+    try:
+        starts_on, ends_on = check_stay(starts_on, ends_on)
+    except ReservationError as error:
+        raise BookingError(str(error))
+    if RoomBookings.query.filter_by(user_id=user_id).first():
+        raise BookingError('You already have a room booking.')
+    if not claim_bed(room_id, starts_on, ends_on):
+        db.session.rollback()
+        if Room.query.get(room_id) is None:
+            raise BookingError('No such room.')
+        raise BookingError('This room is full.' if ends_on is None else 'This room has no free bed for those dates.')
+    booking = RoomBookings(user_id=user_id, room_id=room_id, status='pending', starts_on=starts_on, ends_on=ends_on)
+    db.session.add(booking)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # another request booked for this user first; the rollback returns the bed
+        db.session.rollback()
+        raise BookingError('You already have a room booking.')
+    return booking
+
+
+def book_mess(user_id, mess_id):
+    if MessBookings.query.filter_by(user_id=user_id).first():
+        raise BookingError('You already have a mess booking.')
+    if Mess.query.get(mess_id) is None:
+        raise BookingError('No such mess.')
+    booking = MessBookings(user_id=user_id, mess_id=mess_id, status='pending')
+    db.session.add(booking)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        raise BookingError('You already have a mess booking.')
+    return booking
+
+
+def lock_booking(booking):
+    """Lock the booking's row and reload it, so its status is read inside this transaction.
+
+    Raises BookingError when there is no booking or it was deleted meanwhile.
+    """
+    if booking is None:
+        raise BookingError('There is no booking to change.')
+    # as in bulk_set_status: SQLite only starts the transaction at the first write
+    model = type(booking)
+    db.session.execute(update(model).where(model.id == booking.id).values(status=model.status).execution_options(synchronize_session=False))
+    try:
+        db.session.refresh(booking)
+    except InvalidRequestError:
+        # the row is gone (ObjectDeletedError is one of these)
+        raise BookingError('This booking no longer exists.')
+
+
+def refused_transition(current, status):
+    """Why a booking that is `current` cannot become `status`, or None when it can."""
+    if current == status:
+        return 'already %s' % status
+    if current not in TRANSITIONS.get(status, ()):
+        return 'cannot change a %s booking' % current
+    return None
+
+
+def check_transition(booking, status):
+    if booking.status == status:
+        raise BookingError('This booking is already %s.' % status)
+    if refused_transition(booking.status, status):
+        raise BookingError('A %s booking cannot be %s.' % (booking.status, status))
+
+
+def set_room_booking_status(booking, status):
+    """Change a room booking's status, claiming or releasing its bed as needed."""
+    lock_booking(booking)
+    check_transition(booking, status)
+    holds = booking.status in HOLDING_STATUSES
+    will_hold = status in HOLDING_STATUSES
+    if will_hold and not holds and not claim_bed(booking.room_id, booking.starts_on, booking.ends_on):
+        raise BookingError('This room is full.')
+    if holds and not will_hold:
+        release_bed(booking.room_id)
+    stamp_check_out(booking, status)
+    booking.status = status
+
+
+def set_mess_booking_status(booking, status):
+    lock_booking(booking)
+    check_transition(booking, status)
+    stamp_check_out(booking, status)
+    booking.status = status
+
+
+def stamp_check_out(booking, status):
+    # cancelling an approved booking means the resident moved out
+    if booking.status == 'approved' and status == 'cancelled':
+        booking.check_out = func.now()
+
+
+def delete_room_booking(booking):
+    lock_booking(booking)
+    if booking.status in HOLDING_STATUSES:
+        release_bed(booking.room_id)
+    db.session.delete(booking)
+
+
+def delete_mess_booking(booking):
+    lock_booking(booking)
+    db.session.delete(booking)
+
+
+def bulk_set_status(model, ids, status, actor_id=None):
+    """Approve or reject many bookings with one set-based UPDATE.
+
+    TRANSITIONS decide which bookings can change, as for single changes.
+    Returns {id: result} with 'approved'/'cancelled' for changed bookings
+    and a reason for the ones left alone. The changes are recorded
+    in the event history as made by `actor_id`, the logged-in user by
+    default. The caller commits.
+    """
+    # SQLite ignores FOR UPDATE; a no-op write takes its lock before the statuses are read
+    db.session.execute(update(model).where(model.id.in_(ids)).values(status=model.status).execution_options(synchronize_session=False))
+    current = dict(db.session.query(model.id, model.status).filter(model.id.in_(ids)).with_for_update().all())
+    results = {}
+    for id in ids:
+        if id not in current:
+            results[id] = 'not found'
+        else:
+            results[id] = refused_transition(current[id], status) or status
+    changed = [id for id in ids if results[id] == status]
+    if not changed:
+        return results
+
+    if model is RoomBookings and status not in HOLDING_STATUSES:
+        # hand back one bed per released booking, grouped by room
+        released = db.session.query(func.count(RoomBookings.id)).filter(RoomBookings.room_id == Room.id, RoomBookings.id.in_(changed)).scalar_subquery()
+        room_ids = [room_id for room_id, in db.session.query(RoomBookings.room_id).filter(RoomBookings.id.in_(changed)).distinct()]
+        db.session.execute(update(Room).where(Room.id.in_(room_ids)).values(occupancy=Room.occupancy - released).execution_options(synchronize_session=False))
+        room_changed(*room_ids)
+    values = {'status': status}
+    if status == 'cancelled':
+        values['check_out'] = case((model.status == 'approved', func.now()), else_=model.check_out)
+    db.session.execute(update(model).where(model.id.in_(changed)).values(**values).execution_options(synchronize_session=False))
+    # a Core UPDATE skips the ORM events that keep the dashboard counters and the history
+    kind, item, item_id = stats.BOOKINGS[model]
+    rows = db.session.query(model.id, model.user_id, item_id, item.price).join(item, item_id == item.id).filter(model.id.in_(changed)).all()
+    stats.add(stats.booking_changes(kind, [(current[id], status, price) for id, user_id, booked_id, price in rows]))
+    actor_id = actor_id if actor_id is not None else events.current_actor()
+    events.add([events.entry(model, 'status', id, user_id, status, item_id=booked_id, old_status=current[id], actor_id=actor_id)
+                for id, user_id, booked_id, price in rows])
+    return results
+
+
+def notify_status(kind, user_ids, status):
+    """Queue a notification to the residents whose `kind` booking became `status`."""
+    if user_ids:
+        enqueue('notify', user_ids=list(user_ids), subject='Your %s booking was %s' % (kind, status),
+                body='Your %s booking is now %s.' % (kind, status))
+
+
+@job('bulk_set_status')
+def bulk_set_status_job(kind, ids, status, actor_id=None):
+    model = BOOKING_MODELS[kind]
+    results = bulk_set_status(model, ids, status, actor_id)
+    changed = [id for id in ids if results[id] == status]
+    notify_status(kind, [user_id for user_id, in db.session.query(model.user_id).filter(model.id.in_(changed))], status)
+    return {str(id): result for id, result in results.items()}
+
+
+def rebuild_occupancy():
+    """Recount Room.occupancy from the bookings table."""
+    held = db.session.query(func.count(RoomBookings.id)).filter(RoomBookings.room_id == Room.id, RoomBookings.status.in_(HOLDING_STATUSES)).scalar_subquery()
+    db.session.execute(update(Room).values(occupancy=held).execution_options(synchronize_session=False))
+    db.session.commit()
+    availability_index.expire()
+    reservation_book.expire()
+
+
+@click.command('rebuild-occupancy')
+@with_appcontext
+def rebuild_occupancy_command():
+    """Recount room occupancy from the bookings table."""
+    rebuild_occupancy()
+    click.echo('Room occupancy rebuilt.')
+
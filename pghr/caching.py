@@ -0,0 +1,198 @@
+"""Response and fragment cache with tag-based invalidation.
+
+Cached values are stored under a key that includes the current version of
+every tag they depend on ('room', 'mess', 'announcements'). Committing a
+change to a watched model bumps its tag's version, so every entry built from
+the old data stops being found and ages out of the backend; nothing has to
+enumerate and delete keys.
+
+Two backends are available, chosen by CACHE_BACKEND:
+    'lru'   - in-process LRU (default); tag versions are per process too, so
+              with several workers only the one that made a change sees it
+              at once, and the others rebuild their entries once they are
+              CACHE_MAX_AGE seconds old
+    'redis' - any Redis-compatible server at CACHE_REDIS_URL, shared by all
+              workers; needs the optional `redis` package
+"""
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request, make_response
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from .replicas import primary_reads
+
+
+class LRUBackend():
+    def __init__(self, maxsize=512, max_age=60):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # key: (value, expires)
+        self.entries = OrderedDict()
+        # tag counters live outside the LRU so they are never evicted
+        self.counters = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                # other workers' changes are not seen here, so entries only live this long
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.max_age)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def counter(self, key):
+        return self.counters.get(key, 0)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class RedisBackend():
+    def __init__(self, url, ttl=86400):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND = 'redis' needs the redis package: pip install redis")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def get(self, key):
+        value = self.client.get(key)
+        return None if value is None else pickle.loads(value)
+
+    def set(self, key, value):
+        self.client.set(key, pickle.dumps(value), ex=self.ttl)
+
+    def counter(self, key):
+        return int(self.client.get(key) or 0)
+
+    def incr(self, key):
+        return self.client.incr(key)
+
+    def clear(self):
+        self.client.flushdb()
+
+
+class CachedPage():
+    __slots__ = ('body', 'mimetype', 'etag', 'last_modified')
+
+    def __init__(self, body, mimetype, etag, last_modified):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = etag
+        self.last_modified = last_modified
+
+
+class Cache():
+    def __init__(self, backend, prefix='pghr'):
+        self.backend = backend
+        self.prefix = prefix
+
+    def version(self, tag):
+        return self.backend.counter('%s:tag:%s' % (self.prefix, tag))
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.backend.incr('%s:tag:%s' % (self.prefix, tag))
+
+    def key(self, name, tags):
+        versions = ','.join('%s=%d' % (tag, self.version(tag)) for tag in tags)
+        return '%s:%s:%s' % (self.prefix, name, versions)
+
+    def memoize(self, name, tags, produce):
+        """Return the cached value of `produce()` for `name`, computing it on a miss."""
+        key = self.key(name, tags)
+        value = self.backend.get(key)
+        if value is None:
+            # not from a replica, which may be older than the tag versions
+            with primary_reads():
+                value = produce()
+            self.backend.set(key, value)
+        return value
+
+    def response(self, *tags):
+        """Cache a GET view's response body and answer conditional GETs from it.
+
+        Only for views whose output is the same for every visitor.
+        """
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                return self.respond(tags, view, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def respond(self, tags, view, *args, **kwargs):
+        """The response of `view`, from the cache when nothing tagged `tags` has changed since it was stored."""
+        if request.method != 'GET':
+            return view(*args, **kwargs)
+        key = self.key('page:' + request.full_path, tags)
+        page = self.backend.get(key)
+        if page is None:
+            with primary_reads():
+                response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            page = CachedPage(body, response.mimetype, hashlib.sha1(body).hexdigest(), time.time())
+            self.backend.set(key, page)
+        response = make_response(page.body)
+        response.mimetype = page.mimetype
+        response.set_etag(page.etag)
+        response.last_modified = page.last_modified
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+def create_cache(config):
+    if config['CACHE_BACKEND'] == 'redis':
+        return Cache(RedisBackend(config['CACHE_REDIS_URL']))
+    return Cache(LRUBackend(config['CACHE_SIZE'], config['CACHE_MAX_AGE']))
+
+
+def tags_changed(session, *tags):
+    """Invalidate these tags once the session commits, for writes made without the ORM."""
+    session.info.setdefault('cache_tags', set()).update(tags)
+
+
+def watch_models(cache, tags):
+    """Invalidate the tag of each model in `tags` once a change to it is committed."""
+    def record(mapper, connection, target):
+        session = Session.object_session(target)
+        if session is not None:
+            tags_changed(session, tags[type(target)])
+
+    for model in tags:
+        for name in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(model, name, record)
+
+    @event.listens_for(Session, 'after_commit')
+    def after_commit(session):
+        changed = session.info.pop('cache_tags', None)
+        if changed:
+            cache.invalidate(*changed)
+
+    @event.listens_for(Session, 'after_rollback')
+    def after_rollback(session):
+        session.info.pop('cache_tags', None)
@@ -0,0 +1,97 @@
+"""Monthly rent and mess charges.
+
+run_charges('2026-10') bills every booking that was active during the month:
+approved bookings, and approved bookings cancelled since (their check_out is
+the move-out time). The stay runs from check_in, or a room booking's
+starts_on, to the earlier of check_out and ends_on; it is clipped to the
+month and the monthly price prorated by days:
+
+    amount = price * days in the month stayed / days in the month, rounded half up
+
+Each kind of booking is charged with one INSERT ... SELECT, so the database
+does the whole computation. A run replaces the month's charges in a single
+transaction, so running a period again gives the same result and picks up
+bookings that changed since.
+"""
+import time
+from datetime import date
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import Date, Integer, and_, case, cast, func, insert, literal, or_, select
+from .billing import BillingError, check_period, current_period, period_bounds
+from .database import db
+from .models import Room, Mess, RoomBookings, MessBookings, Charge, ChargeRun
+
+KINDS = {
+    'room': (RoomBookings, RoomBookings.room_id, Room),
+    'mess': (MessBookings, MessBookings.mess_id, Mess),
+}
+
+
+def day(value):
+    """SQL expression for the day number (days since 1970-01-01) of a date or datetime."""
+    if db.engine.dialect.name == 'sqlite':
+        return func.julianday(func.date(value)) - 2440587.5
+    return cast(value, Date) - cast(literal(date(1970, 1, 1)), Date)
+
+
+def greatest(a, b):
+    return case((a > b, a), else_=b)
+
+
+def least(a, b):
+    return case((a < b, a), else_=b)
+
+
+def charges_query(period, kind):
+    """SELECT producing one Charge row per booking of `kind` active in `period`."""
+    booking, item_id, item = KINDS[kind]
+    first, following = period_bounds(period)
+    month_start, month_end = day(literal(first)), day(literal(following))
+    check_in, check_out = day(booking.check_in), func.coalesce(day(booking.check_out), month_end)
+    if booking is RoomBookings:
+        # reserved stays start and end on their dates
+        check_in = func.coalesce(day(booking.starts_on), check_in)
+        check_out = least(check_out, func.coalesce(day(booking.ends_on), month_end))
+    stay_start = greatest(func.coalesce(check_in, month_start), month_start)
+    stay_end = least(check_out, month_end)
+    days = cast(stay_end - stay_start, Integer)
+    # integer arithmetic rounds half up the same way on every database
+    month_days = (following - first).days
+    amount = (2 * item.price * days + month_days) / (2 * month_days)
+    return select(literal(period), literal(kind), booking.id, booking.user_id, item.id, item.price, days, amount) \
+        .select_from(booking).join(item, item_id == item.id) \
+        .where(or_(booking.status == 'approved', and_(booking.status == 'cancelled', booking.check_out != None)), days > 0)  # noqa: E711
+
+
+def run_charges(period):
+    """Compute and store every charge for `period` (YYYY-MM) and commit. Returns the ChargeRun."""
+    check_period(period)
+    started = time.perf_counter()
+    columns = ['period', 'kind', 'booking_id', 'user_id', 'item_id', 'price', 'days', 'amount']
+    db.session.query(Charge).filter(Charge.period == period).delete(synchronize_session=False)
+    for kind in KINDS:
+        db.session.execute(insert(Charge).from_select(columns, charges_query(period, kind)))
+    count, total = db.session.query(func.count(Charge.id), func.coalesce(func.sum(Charge.amount), 0)).filter(Charge.period == period).one()
+    run = db.session.merge(ChargeRun(period=period, charges=count, total=total, seconds=time.perf_counter() - started))
+    db.session.commit()
+    return run
+
+
+def charge_summary(period):
+    """[(kind, charges, days, amount)] for a period."""
+    return db.session.query(Charge.kind, func.count(Charge.id), func.sum(Charge.days), func.sum(Charge.amount)) \
+        .filter(Charge.period == period).group_by(Charge.kind).order_by(Charge.kind).all()
+
+
+@click.command('run-charges')
+@click.option('--period', default=None, help='Month to charge as YYYY-MM, the current month by default.')
+@with_appcontext
+def run_charges_command(period):
+    """Charge residents rent and mess fees for a month."""
+    period = period or current_period()
+    try:
+        run = run_charges(period)
+    except BillingError as error:
+        raise click.BadParameter(str(error), param_hint='--period')
+    click.echo('%s: %d charges totalling %d in %.2fs.' % (period, run.charges, run.total, run.seconds))
@@ -1,5 +1,6 @@
 
 import os
+import tempfile
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 class Config():
@@ -8,6 +9,72 @@ class Config():
     SQLALCHEMY_DATABASE_URI = None
     SECRET_KEY = None 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    BOOKINGS_PER_PAGE = 50
+    ANNOUNCEMENTS_PER_PAGE = 20
+    TICKETS_PER_PAGE = 50
+    API_PAGE_SIZE = 50
+    API_MAX_PAGE_SIZE = 500
+    ROOMS_PER_PAGE = 20
+    AVAILABILITY_MAX_AGE = 60 # seconds before the room search index is reloaded in full
+    # full-text search over tickets, replies and announcements (pghr.search)
+    SEARCH_BACKEND = 'auto' # auto (FTS5 when the SQLite build has it), memory
+    SEARCH_RESULTS_PER_PAGE = 20
+    SEARCH_CANDIDATES = 100 # matches of each kind ranked together; later pages rank older windows
+    SEARCH_MAX_AGE = 300 # seconds before the in-process search index is reloaded in full
+    IMPORT_ERRORS_SHOWN = 100 # rejected rows listed in an import's response
+    # `flask build-assets` output, served from /assets (pghr.assets)
+    ASSETS_FOLDER = os.path.join(basedir, '..', 'static', 'dist')
+    ASSET_MAX_AGE = 365 * 24 * 3600 # seconds; fingerprinted names never change content
+    PROFILING = False
+    PROFILING_SLOW_QUERIES = 10
+    QUERY_BUDGETS = {}
+    QUERY_BUDGET_ENFORCE = False
+    IDENTITY_CACHE_SIZE = 1024
+    IDENTITY_CACHE_TTL = 300
+    CACHE_BACKEND = 'lru' # lru, redis
+    CACHE_SIZE = 512
+    CACHE_MAX_AGE = 60 # seconds an lru entry is served; other workers' changes show up within this
+    CACHE_REDIS_URL = 'redis://localhost:6379/0'
+    # connection pool for server databases (PostgreSQL); SQLite ignores these
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+    DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800)) # seconds
+    DB_POOL_PRE_PING = True
+    # read replicas (pghr.replicas), e.g. DATABASE_REPLICA_URLS=postgresql://replica1/pghr,postgresql://replica2/pghr
+    SQLALCHEMY_REPLICA_URIS = [uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',') if uri]
+    REPLICA_STICKY_SECONDS = 10 # a user's reads stay on the primary this long after they commit
+    # single-node SQLite: write-ahead log so readers don't block the writer
+    SQLITE_WAL = True
+    SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000)) # ms
+    # password hashing pool; older hashes are upgraded to this method on login
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:260000'
+    PASSWORD_HASH_POOL = 'thread' # thread, process
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', 4))
+    PASSWORD_HASH_QUEUE = 32 # jobs allowed to wait before logins get 503
+    PASSWORD_HASH_TIMEOUT = 5 # seconds
+    # rate limits per group of routes and scope (pghr.ratelimit)
+    RATE_LIMITING = True
+    RATE_LIMITS = {
+        'login': {'ip': '20/minute', 'account': '5/minute', 'username': '50/hour'},
+        'signup': {'ip': '5/minute'},
+        'booking': {'ip': '30/minute', 'account': '10/minute'},
+        'ticket': {'ip': '30/minute', 'account': '10/minute'},
+    }
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory') # memory, sqlite (shared by the workers on one host)
+    RATE_LIMIT_SQLITE_PATH = os.environ.get('RATE_LIMIT_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'pghr-ratelimit.db'))
+    RATE_LIMIT_MAX_KEYS = 100000 # buckets kept by the memory backend
+    RATE_LIMIT_PROXIES = int(os.environ.get('RATE_LIMIT_PROXIES', 0)) # trusted proxies setting X-Forwarded-For
+    # background jobs; set JOBS_WORKERS = 0 when running `flask run-jobs` separately
+    JOBS_WORKERS = int(os.environ.get('JOBS_WORKERS', 1)) # threads per web process
+    JOBS_POLL_INTERVAL = 1.0 # seconds
+    JOBS_VISIBILITY_TIMEOUT = 300 # seconds a worker may hold a job before it is retried
+    JOBS_RETRY_DELAY = 10 # seconds before the first retry, doubled after each failure
+    JOBS_MAX_ATTEMPTS = 5
+    BULK_INLINE_LIMIT = 50 # larger bulk booking changes run as a background job
+    # notifications are only logged unless a mail server is set
+    MAIL_SERVER = os.environ.get('MAIL_SERVER')
+    MAIL_PORT = int(os.environ.get('MAIL_PORT', 25))
+    MAIL_SENDER = os.environ.get('MAIL_SENDER', 'pghr@localhost')
     
 class LocalDevelopmentConfig(Config): 
     current_dir = os.path.abspath(os.path.dirname(__file__))       
@@ -16,6 +83,18 @@ class LocalDevelopmentConfig(Config):
     DEBUG = True
 
 class ProductionConfig(Config):
-    SQLALCHEMY_DATABASE_URI = 'postgresql://user@localhost/foo'
-    SECRET_KEY = 'Ww2GaTsdrQYLuBmn3ABCEmZrdBe4Xj'
-    DEBUG = False
\ No newline at end of file
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgresql://user@localhost/foo')
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'Ww2GaTsdrQYLuBmn3ABCEmZrdBe4Xj')
+    DEBUG = False
+
+# selected with the PGHR_CONFIG environment variable
+configs = {
+    'development': LocalDevelopmentConfig,
+    'production': ProductionConfig,
+}
+
+def config_from_env():
+    name = os.environ.get('PGHR_CONFIG', 'development')
+    if name not in configs:
+        raise RuntimeError('PGHR_CONFIG must be one of: %s' % ', '.join(configs))
+    return configs[name]
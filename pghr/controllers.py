@@ -1,30 +1,137 @@
-from flask import render_template, redirect, request, url_for
+from flask import render_template, redirect, request, url_for, jsonify, Response, flash, stream_with_context
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, BooleanField
 from wtforms.validators import InputRequired, Email, Length
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
 from flask import current_app as app
+from werkzeug.local import LocalProxy
 from pghr.models import (
     User, user_schema, users_schema,
     Room, room_schema, rooms_schema,
     RoomBookings, room_booking_schema, room_bookings_schema,
     Mess, mess_schema, messes_schema,
     MessBookings, mess_booking_schema, mess_bookings_schema,
-    Announcements, announcement_schema, announcement_schema,
+    Announcements, announcement_schema, announcements_schema,
     Ticket, ticket_schema, tickets_schema,
-    TicketReplies, ticket_reply_schema, ticket_replies_schema
+    TicketReplies, ticket_reply_schema, ticket_replies_schema,
+    Job, MenuItem, Invoice, BillingAccount, Charge, ChargeRun
 )
 from .database import db
+from . import profiling
+from .identity import Principal, IdentityCache, watch_user_changes
+from .caching import create_cache, watch_models
+from .replicas import read_only, primary_reads
+from .passwords import PasswordHasher, HasherBusy
+from .ratelimit import RateLimiter
+from .bookings import BookingError, BOOKING_MODELS, book_room, book_mess, set_room_booking_status, set_mess_booking_status, delete_room_booking, delete_mess_booking, bulk_set_status, notify_status
+from .jobs import enqueue, queue_stats
+from .billing import BillingError, ingest_orders, generate_invoices, current_period, check_period
+from .charges import run_charges, charge_summary
+from .stats import dashboard_stats
+from .availability import FIELDS as SEARCH_FIELDS, SearchError, search_args, search_rooms
+from .reservations import ReservationError, parse_day
+from .search import KINDS as SEARCH_KINDS, QueryError, search
+from .transfer import FORMATS as TRANSFER_FORMATS, TABLES as TRANSFER_TABLES, TransferError, export_rows, format_of, import_rows, read_rows
 from functools import wraps
+import io
+import json
+from sqlalchemy import and_, or_, String
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+BOOKING_STATUSES = ('pending', 'approved', 'cancelled')
+# query string parameter holding each admin booking list's keyset cursor
+BOOKING_CURSORS = {
+    'room_pending': 'room_pending_cursor', 'room_approved': 'room_approved_cursor', 'room_bookings': 'room_cursor',
+    'mess_pending': 'mess_pending_cursor', 'mess_approved': 'mess_approved_cursor', 'mess_bookings': 'mess_cursor',
+}
+
+# (rule, view, options) for every view below; init_controllers() adds them to each app
+routes = []
+# rate limit groups the views use, checked against RATE_LIMITS when an app is set up
+rate_limited_groups = set()
+
+def route(rule, **options):
+    """Record a view like @app.route does, for the apps init_controllers() is called with."""
+    def decorator(view):
+        routes.append((rule, view, options))
+        return view
+    return decorator
+
+def init_controllers(app):
+    """Add the routes to `app`, with its own identity cache, password hasher, rate limiter and page cache."""
+    state = {
+        'identity_cache': IdentityCache(app.config['IDENTITY_CACHE_SIZE'], app.config['IDENTITY_CACHE_TTL']),
+        'password_hasher': PasswordHasher.from_config(app.config),
+        'rate_limiter': RateLimiter.from_config(app.config),
+        'page_cache': create_cache(app.config),
+    }
+    for group in rate_limited_groups:
+        state['rate_limiter'].limit(group)  # raises LimitError for a group missing from RATE_LIMITS
+    watch_user_changes(state['identity_cache'])
+    watch_models(state['page_cache'], {Room: 'room', Mess: 'mess', Announcements: 'announcements'})
+    app.extensions['pghr'] = state
+    login_manager.init_app(app)
+    for rule, view, options in routes:
+        app.add_url_rule(rule, view_func=view, **options)
+
+def app_state(name):
+    return LocalProxy(lambda: app.extensions['pghr'][name])
+
+# the serving app's objects, as built by init_controllers()
+identity_cache = app_state('identity_cache')
+password_hasher = app_state('password_hasher')
+rate_limiter = app_state('rate_limiter')
+page_cache = app_state('page_cache')
+
+def rate_limited(group):
+    """The serving app's @rate_limited(group). Place right below @route."""
+    rate_limited_groups.add(group)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            return rate_limiter.call(group, view, *args, **kwargs)
+        return wrapper
+    return decorator
+
+def cached_response(*tags):
+    """The serving app's @cached_response(*tags)."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            return page_cache.respond(tags, view, *args, **kwargs)
+        return wrapper
+    return decorator
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    principal = identity_cache.get(user_id)
+    if principal is None:
+        # cached for IDENTITY_CACHE_TTL, so never from a lagging replica
+        with primary_reads():
+            row = db.session.query(User.id, User.username, User.email, User.admin).filter(User.id==user_id).first()
+        if row is None:
+            return None
+        principal = Principal(*row)
+        identity_cache.put(principal)
+    return principal
+
+def hasher_busy():
+    return Response('<h1>Too many sign-ins right now, please try again in a moment</h1>', 503, {'Retry-After': '1'})
+
+def admin_required(view):
+    """Send non-admin users to their dashboard. Use below @login_required."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.admin:
+            return redirect(url_for('dashboard'))
+        return view(*args, **kwargs)
+    return wrapper
 
 class LoginForm(FlaskForm):
     username = StringField('username', validators=[InputRequired(), Length(min=4, max=15)])
@@ -65,13 +172,19 @@ class TicketForm(FlaskForm):
     title = StringField('title', validators=[InputRequired(), Length(min=4, max=15)])
     description = StringField('description', validators=[InputRequired(), Length(min=4, max=120)])
     
+class MenuItemForm(FlaskForm):
+    mess_id = StringField('mess_id', validators=[InputRequired(), Length(min=1, max=5)])
+    name = StringField('name', validators=[InputRequired(), Length(min=2, max=80)])
+    price = StringField('price', validators=[InputRequired(), Length(min=1, max=5)])
+
 class TicketReplyForm(FlaskForm):
     ticket_id = StringField('ticket_id', validators=[InputRequired(), Length(min=1, max=2)])
     description = StringField('description', validators=[InputRequired(), Length(min=4, max=120)])
      
 """INDEX PAGE
 /LANDING PAGE"""
-@app.route('/')
+@route('/')
+@cached_response('room', 'mess', 'announcements')
 def index():
     return render_template('index/index.html')
 
@@ -79,18 +192,29 @@ def index():
 Parameters: username, password
 Return Templates: login.html, index.html
 """
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
+@rate_limited('login')
 def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
         if user:
-            if check_password_hash(user.password, form.password.data):
+            try:
+                valid = password_hasher.verify(user.password, form.password.data)
+            except HasherBusy:
+                return hasher_busy()
+            if valid:
+                if password_hasher.needs_rehash(user.password):
+                    # upgrade legacy hashes while the plain password is at hand
+                    try:
+                        user.password = password_hasher.hash(form.password.data)
+                        db.session.commit()
+                    except HasherBusy:
+                        pass
                 login_user(user, remember=form.remember.data)
+                identity_cache.put(Principal.from_user(user))
                 # check if admin or user
-                user = user_schema.dump(user)
-                admin = user['admin']
-                if admin:
+                if user.admin:
                     return redirect(url_for('admin_dashboard'))
                 else:
                     return redirect(url_for('dashboard'))
@@ -103,13 +227,17 @@ def login():
 Parameters: email, username, password, name, admin
 Return Templates: signup.html, index.html
 """
-@app.route('/signup', methods=['GET', 'POST'])
+@route('/signup', methods=['GET', 'POST'])
+@rate_limited('signup')
 def signup():
     form = RegisterForm()
     print("\n\n\n\n\n\n\n Hello", form.validate_on_submit())
     
     if form.validate_on_submit():
-        hashed_password = generate_password_hash(form.password.data, method='sha256')
+        try:
+            hashed_password = password_hasher.hash(form.password.data)
+        except HasherBusy:
+            return hasher_busy()
         print("\n\n\n\n\n\n\n Hello")
         new_user = User(email=form.email.data, username=form.username.data, password=hashed_password, admin=False)
         print("\n\n\n\n\n\n\n Hello")
@@ -125,7 +253,7 @@ def signup():
 Parameters: None
 Return Templates: index.html
 """
-@app.route('/logout')
+@route('/logout')
 @login_required
 def logout():
     logout_user()
@@ -135,7 +263,8 @@ def logout():
 Parameters: None
 Return Templates: dashboard.html
 """
-@app.route('/dashboard')
+@route('/dashboard')
+@read_only
 @login_required
 def dashboard():
     room_booked = RoomBookings.query.filter_by(user_id=current_user.id).first()
@@ -150,13 +279,20 @@ def dashboard():
     else:
         mess = None
         
-    return render_template('customer/dashboard.html', user=current_user, room=room, mess=mess, room_booked=room_booked, mess_booked=mess_booked)
+    latest = page_cache.memoize('announcements:latest', ('announcements',), latest_announcements)
+    return render_template('customer/dashboard.html', user=current_user, room=room, mess=mess, room_booked=room_booked, mess_booked=mess_booked, announcements=latest['announcements'], announcements_since=latest['since'])
+
+def latest_announcements(count=5):
+    announcements = announcement_feed()[0][:count]
+    return {'announcements': announcements_schema.dump(announcements), 'since': announcements[0].cursor if announcements else ''}
 
 """TICKET PAGE - CUSTOMER
 Parameters: None
 Return Templates: ticket.html
 """
-@app.route('/ticket', methods=['GET', 'POST'])
+@route('/ticket', methods=['GET', 'POST'])
+@rate_limited('ticket')
+@read_only
 @login_required
 def ticket():
     form = TicketForm()
@@ -167,12 +303,11 @@ def ticket():
         return redirect(url_for('ticket'))
     else:
         print(form.errors)
-    # get tickets and map it to the ticket reply
-    tickets = Ticket.query.filter_by(user_id=current_user.id).all()
-    ticket_replies = TicketReplies.query.all()
-    return render_template('customer/ticket.html', user=current_user, tickets=tickets, ticket_replies=ticket_replies, form=form)
+    # get tickets with their replies loaded in one extra query
+    tickets = Ticket.query.filter_by(user_id=current_user.id).options(selectinload(Ticket.replies)).all()
+    return render_template('customer/ticket.html', user=current_user, tickets=tickets, form=form)
 
-@app.route('/ticket/<id>/delete')
+@route('/ticket/<id>/delete')
 @login_required
 def ticket_delete(id):
     ticket_reply = TicketReplies.query.filter_by(ticket_id=id).first()
@@ -187,13 +322,58 @@ def ticket_delete(id):
 Parameters: None
 Return Templates: announcement.html
 """
-@app.route('/announcement')
+@route('/announcement')
+@read_only
 @login_required
 def announcement():
-    announcements = Announcements.query.all()
-    return render_template('customer/announcement.html', user=current_user, announcements=announcements)
+    announcements, next_cursor = announcement_feed(before=request.args.get('cursor'))
+    return render_template('customer/announcement.html', user=current_user, announcements=announcements, next_cursor=next_cursor)
 
-@app.route('/announcement/<id>/delete')
+"""ANNOUNCEMENT FEED - JSON
+Parameters: cursor (older page) or since (newer items only)
+Return: {announcements, next, since}
+"""
+@route('/announcement/feed')
+@login_required
+@cached_response('announcements')
+def announcement_feed_json():
+    since = request.args.get('since')
+    if since:
+        announcements, next_cursor = announcement_feed(since=since)
+    else:
+        announcements, next_cursor = announcement_feed(before=request.args.get('cursor'))
+    # the newest cursor the client has seen, to poll with next time
+    latest = announcements[0].cursor if announcements else since
+    return jsonify({'announcements': announcements_schema.dump(announcements), 'next': next_cursor, 'since': latest})
+
+def announcement_feed(before=None, since=None):
+    """Return a newest-first page of announcements and the cursor of the next (older) page.
+
+    Cursors are '<created_at>_<id>' with created_at exactly as the database
+    returns it as text, so SQLite compares it against the stored string.
+    `since` returns only the announcements newer than that cursor.
+    """
+    per_page = app.config['ANNOUNCEMENTS_PER_PAGE']
+    created_at_text = db.cast(Announcements.created_at, String)
+    query = db.session.query(Announcements.id, Announcements.title, Announcements.description, Announcements.created_at, (created_at_text + '_' + db.cast(Announcements.id, String)).label('cursor'))
+    if since:
+        created_at, id = split_cursor(since)
+        # oldest first so a client far behind catches up page by page without gaps
+        rows = query.filter(or_(Announcements.created_at > created_at, and_(created_at_text == created_at, Announcements.id > id))).order_by(Announcements.created_at, Announcements.id).limit(per_page).all()
+        return rows[::-1], None
+    if before:
+        created_at, id = split_cursor(before)
+        query = query.filter(or_(Announcements.created_at < created_at, and_(created_at_text == created_at, Announcements.id < id)))
+    rows = query.order_by(Announcements.created_at.desc(), Announcements.id.desc()).limit(per_page + 1).all()
+    if len(rows) > per_page:
+        return rows[:per_page], rows[per_page - 1].cursor
+    return rows, None
+
+def split_cursor(cursor):
+    created_at, _, id = cursor.rpartition('_')
+    return db.literal(created_at, String), int(id) if id.isdigit() else 0
+
+@route('/announcement/<id>/delete')
 @login_required
 def announcement_delete(id):
     announcement = Announcements.query.get(id)
@@ -202,14 +382,15 @@ def announcement_delete(id):
     return redirect(url_for('announcement'))
 
 """BOOKING PAGE - CUSTOMER
-Parameters: None
+Parameters: min_price, max_price, size, bathroom, min_free, order, cursor (room search)
 Return Templates: booking.html
 """
-@app.route('/booking', methods=['GET', 'POST'])
+@route('/booking', methods=['GET', 'POST'])
+@read_only
 @login_required
 def booking():
-    rooms = Room.query.all()
-    messes = Mess.query.all()
+    # the mess catalog is the same for everyone and only changes on admin edits
+    messes = page_cache.memoize('messes', ('mess',), lambda: messes_schema.dump(Mess.query.all()))
     
     room_booked = RoomBookings.query.filter_by(user_id=current_user.id).first()
     mess_booked = MessBookings.query.filter_by(user_id=current_user.id).first()
@@ -217,55 +398,70 @@ def booking():
     dont_show_room = False if not room_booked else True
     dont_show_mess = False if not mess_booked else True
     
+    rooms, next_cursor = [], None
     if room_booked:
         room = Room.query.filter_by(id=room_booked.room_id).first()
     else:
         room = None
+        # rooms with free beds from the in-memory availability index
+        try:
+            rooms, next_cursor = search_rooms(limit=app.config['ROOMS_PER_PAGE'], **search_args(request.args))
+        except SearchError as error:
+            flash(str(error))
+        rooms = [dict(zip(SEARCH_FIELDS, record)) for record in rooms]
+    filters = {name: value for name, value in request.args.items() if name != 'cursor'}
     if mess_booked:
         mess = Mess.query.filter_by(id=mess_booked.mess_id).first()
     else:
         mess = None
     
-    return render_template('customer/booking.html', user=current_user, rooms=rooms, messes=messes, room=room, mess=mess, room_booked=room_booked, mess_booked=mess_booked, dont_show_room=dont_show_room, dont_show_mess=dont_show_mess)
+    return render_template('customer/booking.html', user=current_user, rooms=rooms, messes=messes, room=room, mess=mess, room_booked=room_booked, mess_booked=mess_booked, dont_show_room=dont_show_room, dont_show_mess=dont_show_mess, filters=filters, next_cursor=next_cursor)
     
-@app.route('/booking/<id>/room', methods=['POST'])
+@route('/booking/<id>/room', methods=['POST'])
+@rate_limited('booking')
 @login_required
 def booking_room(id):
-    room = Room.query.get(id)
-    room_booked = RoomBookings.query.filter_by(user_id=current_user.id).first()
-    if room_booked:
-        return redirect(url_for('booking'))
-    new_room_booking = RoomBookings(user_id=current_user.id, room_id=room.id, status='pending')
-    db.session.add(new_room_booking)
-    db.session.commit()
+    # optional stay dates; without them the stay starts today and is open-ended
+    try:
+        book_room(current_user.id, int(id), parse_day(request.form.get('starts_on'), 'start date'), parse_day(request.form.get('ends_on'), 'end date'))
+    except (BookingError, ReservationError) as error:
+        flash(str(error))
     return redirect(url_for('booking'))
 
-@app.route('/booking/<id>/mess', methods=['POST'])
+@route('/booking/<id>/mess', methods=['POST'])
+@rate_limited('booking')
 @login_required
 def booking_mess(id):
-    mess = Mess.query.get(id)
-    mess_booked = MessBookings.query.filter_by(user_id=current_user.id).first()
-    if mess_booked:
-        return redirect(url_for('booking'))
-    new_mess_booking = MessBookings(user_id=current_user.id, mess_id=mess.id, status='pending')
-    db.session.add(new_mess_booking)
-    db.session.commit()
+    try:
+        book_mess(current_user.id, int(id))
+    except BookingError as error:
+        flash(str(error))
     return redirect(url_for('booking'))
 
-@app.route('/booking/room/delete', methods=['POST'])
+@route('/booking/room/delete', methods=['POST'])
 @login_required
 def booking_room_delete():
     room_booked = RoomBookings.query.filter_by(user_id=current_user.id).first()
-    db.session.delete(room_booked)
-    db.session.commit()
+    if room_booked:
+        try:
+            delete_room_booking(room_booked)
+            db.session.commit()
+        except BookingError as error:
+            db.session.rollback()
+            flash(str(error))
     return redirect(url_for('booking'))
 
-@app.route('/booking/mess/delete', methods=['POST'])
+@route('/booking/mess/delete', methods=['POST'])
 @login_required
 def booking_mess_delete():
     mess_booked = MessBookings.query.filter_by(user_id=current_user.id).first()
-    db.session.delete(mess_booked)
-    db.session.commit()
+    if mess_booked:
+        try:
+            delete_mess_booking(mess_booked)
+            db.session.commit()
+        except BookingError as error:
+            db.session.rollback()
+            flash(str(error))
     return redirect(url_for('booking'))
 
 """ADMIN SECTION
@@ -275,48 +471,51 @@ def booking_mess_delete():
 Parameters: None
 Return Templates: dashboard.html
 """
-@app.route('/admin/dashboard')
+@route('/admin/dashboard')
+@read_only
 @login_required
+@admin_required
 def admin_dashboard():
-    if not user_schema.dump(current_user)['admin']:
-        return redirect(url_for('dashboard'))
-    
-    return render_template('admin/dashboard.html', user=current_user)
+    # running totals kept by pghr.stats, a few rows however large the tables get
+    return render_template('admin/dashboard.html', user=current_user, stats=dashboard_stats())
 
 """TICKET PAGE - ADMIN
 Parameters: None
 Return Templates: ticket.html
 """
-@app.route('/admin/ticket', methods=['GET', 'POST'])
+@route('/admin/ticket', methods=['GET', 'POST'])
+@read_only
 @login_required
+@admin_required
 def admin_ticket():
-    if not user_schema.dump(current_user)['admin']:
-        return redirect(url_for('dashboard'))
-    
     form = TicketReplyForm()
     if form.validate_on_submit():
         ticket = Ticket.query.filter_by(id=form.ticket_id.data).first()
         ticket.status = 'closed'
-        db.session.commit()
         
         new_ticket_reply = TicketReplies(description=form.description.data, ticket_id=form.ticket_id.data, user_id=current_user.id)
 
         db.session.add(new_ticket_reply)
+        enqueue('notify', user_ids=[ticket.user_id], subject='Reply to your ticket: %s' % ticket.title, body=form.description.data)
+        # reply, status change and notification commit together
         db.session.commit()
         return redirect(url_for('admin_ticket'))
     else:
         print("\n\n\n\n\n\n\n", form.errors)
-    # get tickets and map it to the ticket reply
-    tickets = Ticket.query.all()
-    ticket_replies = TicketReplies.query.all()
-    return render_template('admin/ticket.html', user=current_user, tickets=tickets, ticket_replies=ticket_replies, form=form)
+    # one page of tickets, newest first, with the replies to that page loaded in one extra query
+    cursor = request.args.get('cursor', type=int)
+    tickets, next_cursor = keyset_page(Ticket.query.options(selectinload(Ticket.replies)), Ticket.id, cursor,
+                                       app.config['TICKETS_PER_PAGE'], key='id')
+    page = {
+        'first': url_for('admin_ticket') if cursor is not None else None,
+        'next': url_for('admin_ticket', cursor=next_cursor) if next_cursor is not None else None,
+    }
+    return render_template('admin/ticket.html', user=current_user, tickets=tickets, page=page, form=form)
 
-@app.route('/admin/ticket/<id>/delete')
+@route('/admin/ticket/<id>/delete')
 @login_required
+@admin_required
 def admin_ticket_delete(id):
-    if not user_schema.dump(current_user)['admin']:
-        return redirect(url_for('dashboard'))
-    
     # delete ticket and ticket replies
     ticket_reply= TicketReplies.query.filter_by(ticket_id=id).first()
     if ticket_reply:
@@ -331,118 +530,476 @@ def admin_ticket_delete(id):
 Parameters: None
 Return Templates: announcement.html
 """
-@app.route('/admin/announcement', methods=['GET', 'POST'])
+@route('/admin/announcement', methods=['GET', 'POST'])
+@read_only
 @login_required
+@admin_required
 def admin_announcement():
-    if not user_schema.dump(current_user)['admin']:
-        return redirect(url_for('dashboard'))
-    
     form = AnnouncementForm()
     if form.validate_on_submit():
         new_announcement = Announcements(title=form.title.data, description=form.description.data)
         db.session.add(new_announcement)
+        db.session.flush()
+        enqueue('announce', announcement_id=new_announcement.id)
         db.session.commit()
         return redirect(url_for('admin_announcement'))
     else:
         print("\n\n\n\n\n\n\n", form.errors)
-    announcements = Announcements.query.all()
-    return render_template('admin/announcement.html', user=current_user, announcements=announcements, form=form)
+    announcements, next_cursor = announcement_feed(before=request.args.get('cursor'))
+    return render_template('admin/announcement.html', user=current_user, announcements=announcements, next_cursor=next_cursor, form=form)
 
-@app.route('/admin/announcement/<id>/delete')
+@route('/admin/announcement/<id>/delete')
 @login_required
+@admin_required
 def admin_announcement_delete(id):
-    if not user_schema.dump(current_user)['admin']:
-        return redirect(url_for('dashboard'))
-    
     announcement = Announcements.query.get(id)
     db.session.delete(announcement)
     db.session.commit()
     return redirect(url_for('admin_announcement'))
 
+"""SEARCH PAGE - ADMIN
+Parameters: q (words to find), kind (ticket, reply or announcement; all by default), page
+Return Templates: search.html
+"""
+@route('/admin/search')
+@read_only
+@login_required
+@admin_required
+def admin_search():
+    query = request.args.get('q', '').strip()
+    kind = request.args.get('kind', '')
+    page = request.args.get('page', 1, type=int)
+    results, has_next = [], False
+    if query:
+        try:
+            results, has_next = search(query, [kind] if kind else None, page=page)
+        except QueryError as error:
+            flash(str(error))
+    return render_template('admin/search.html', user=current_user, query=query, kind=kind, kinds=SEARCH_KINDS,
+                           page=page, results=results, has_next=has_next)
+
 """BOOKING PAGE - ADMIN
 Parameters: None
 Return Templates: booking.html
 """
-@app.route('/admin/booking', methods=['GET', 'POST'])
+@route('/admin/booking', methods=['GET', 'POST'])
+@read_only
 @login_required
+@admin_required
 def admin_booking():
-    if not user_schema.dump(current_user)['admin']:
-        return redirect(url_for('dashboard'))
-    
-    # query rooms with status=pending
-    room_pending = RoomBookings.query.join(Room, RoomBookings.room_id==Room.id).join(User, RoomBookings.user_id==User.id).add_columns(Room.id, Room.name, Room.size, Room.attached_bathroom, Room.price, RoomBookings.id, RoomBookings.status, User.id, User.username).filter(RoomBookings.status=='pending').all()
-    mess_pending = MessBookings.query.join(Mess, MessBookings.mess_id==Mess.id).join(User, MessBookings.user_id==User.id).add_columns(Mess.id, Mess.name, Mess.description, Mess.price, MessBookings.id, MessBookings.status, User.id, User.username).filter(MessBookings.status=='pending').all()
-    
-    # query rooms with status=approved
-    room_approved = RoomBookings.query.join(Room, RoomBookings.room_id==Room.id).join(User, RoomBookings.user_id==User.id).add_columns(Room.id, Room.name, Room.size, Room.attached_bathroom, Room.price, RoomBookings.id, RoomBookings.status, User.id, User.username).filter(RoomBookings.status=='approved').all()
-    mess_approved = MessBookings.query.join(Mess, MessBookings.mess_id==Mess.id).join(User, MessBookings.user_id==User.id).add_columns(Mess.id, Mess.name, Mess.description, Mess.price, MessBookings.id, MessBookings.status, User.id, User.username).filter(MessBookings.status=='approved').all()
-    
-    # query all rooms joined users on room bookings
-    room_bookings = RoomBookings.query.join(Room, RoomBookings.room_id==Room.id).join(User, RoomBookings.user_id==User.id).add_columns(Room.id, Room.name, Room.size, Room.attached_bathroom, Room.price, RoomBookings.id, RoomBookings.status, User.id, User.username).all()
-    mess_bookings = MessBookings.query.join(Mess, MessBookings.mess_id==Mess.id).join(User, MessBookings.user_id==User.id).add_columns(Mess.id, Mess.name, Mess.description, Mess.price, MessBookings.id, MessBookings.status, User.id, User.username).all()
-    
-    return render_template('admin/booking.html', user=current_user, room_pending=room_pending, mess_pending=mess_pending, room_approved=room_approved, mess_approved=mess_approved, room_bookings=room_bookings, mess_bookings=mess_bookings)
+    filters = booking_filters()
+    per_page = app.config['BOOKINGS_PER_PAGE']
+
+    # room bookings joined with rooms and users, newest first
+    room_query = db.session.query(Room.id, Room.name, Room.size, Room.attached_bathroom, Room.price, RoomBookings.id.label('booking_id'), RoomBookings.status, User.id.label('user_id'), User.username).join(Room, RoomBookings.room_id==Room.id).join(User, RoomBookings.user_id==User.id)
+    if 'room' in filters:
+        room_query = room_query.filter(RoomBookings.room_id==filters['room'])
+    room_query = filter_bookings(room_query, RoomBookings, filters)
+
+    # mess bookings joined with messes and users, newest first
+    mess_query = db.session.query(Mess.id, Mess.name, Mess.description, Mess.price, MessBookings.id.label('booking_id'), MessBookings.status, User.id.label('user_id'), User.username).join(Mess, MessBookings.mess_id==Mess.id).join(User, MessBookings.user_id==User.id)
+    if 'mess' in filters:
+        mess_query = mess_query.filter(MessBookings.mess_id==filters['mess'])
+    mess_query = filter_bookings(mess_query, MessBookings, filters)
+
+    # every list pages on its own: the pending and approved ones are queried by status
+    # (ix_*_status_id), so a pending booking never drops off behind newer ones
+    lists = {
+        'room_pending': (room_query.filter(RoomBookings.status=='pending'), RoomBookings.id),
+        'room_approved': (room_query.filter(RoomBookings.status=='approved'), RoomBookings.id),
+        'room_bookings': (room_query, RoomBookings.id),
+        'mess_pending': (mess_query.filter(MessBookings.status=='pending'), MessBookings.id),
+        'mess_approved': (mess_query.filter(MessBookings.status=='approved'), MessBookings.id),
+        'mess_bookings': (mess_query, MessBookings.id),
+    }
+    cursors = {name: request.args.get(BOOKING_CURSORS[name], type=int) for name in lists}
+    records, pages = {}, {}
+    for name, (query, id_column) in lists.items():
+        records[name], next_cursor = keyset_page(query, id_column, cursors[name], per_page)
+        pages[name] = booking_page_links(name, cursors, next_cursor, filters)
+
+    return render_template('admin/booking.html', user=current_user, filters=filters, pages=pages, **records)
+
+def booking_page_links(name, cursors, next_cursor, filters):
+    """URLs of the first and next page of one booking list, keeping the other lists where they are."""
+    others = {BOOKING_CURSORS[other]: cursor for other, cursor in cursors.items() if other != name and cursor is not None}
+    return {
+        'first': url_for('admin_booking', **others, **filters) if cursors[name] is not None else None,
+        'next': url_for('admin_booking', **others, **{BOOKING_CURSORS[name]: next_cursor}, **filters) if next_cursor is not None else None,
+    }
+
+def booking_filters():
+    """Read the booking console filters from the query string, dropping empty ones."""
+    filters = {}
+    status = request.args.get('status', '')
+    if status in BOOKING_STATUSES:
+        filters['status'] = status
+    username = request.args.get('user', '').strip()
+    if username:
+        filters['user'] = username
+    for key in ('room', 'mess'):
+        value = request.args.get(key, type=int)
+        if value is not None:
+            filters[key] = value
+    return filters
+
+def filter_bookings(query, model, filters):
+    if 'status' in filters:
+        query = query.filter(model.status==filters['status'])
+    if 'user' in filters:
+        query = query.filter(User.username==filters['user'])
+    return query
+
+def keyset_page(query, id_column, cursor, per_page, key='booking_id'):
+    """Return the rows with id below `cursor`, newest first, and the cursor of the next page.
+    Fetches one extra row to know whether a next page exists; `key` is the id's name on a row.
+    """
+    if cursor is not None:
+        query = query.filter(id_column < cursor)
+    rows = query.order_by(id_column.desc()).limit(per_page + 1).all()
+    if len(rows) > per_page:
+        return rows[:per_page], getattr(rows[per_page - 1], key)
+    return rows, None
     
-@app.route('/admin/booking/room/<username>/approve', methods=['POST'])
+@route('/admin/booking/room/<username>/approve', methods=['POST'])
 @login_required
+@admin_required
 def admin_booking_approve_room(username):
-    if not user_schema.dump(current_user)['admin']:
-        return redirect(url_for('dashboard'))
-    
     # get id 
-    user = User.query.filter_by(username=username).first()
-    user_id = user_schema.dump(user)['id']
+    user_id = User.query.filter_by(username=username).first_or_404().id
 
     # get booking
     room_booking = RoomBookings.query.filter_by(user_id=user_id).first()
-    room_booking.status = 'approved'
-    db.session.commit()
+    try:
+        set_room_booking_status(room_booking, 'approved')
+        notify_status('room', [user_id], 'approved')
+        db.session.commit()
+    except BookingError as error:
+        db.session.rollback()
+        flash(str(error))
     return redirect(url_for('admin_booking'))
 
-@app.route('/admin/booking/room/<username>/reject', methods=['POST'])
+@route('/admin/booking/room/<username>/reject', methods=['POST'])
 @login_required
+@admin_required
 def admin_booking_reject_room(username):
-    if not user_schema.dump(current_user)['admin']:
-        return redirect(url_for('dashboard'))
-    
     # get id 
-    user = User.query.filter_by(username=username).first()
-    user_id = user_schema.dump(user)['id']
+    user_id = User.query.filter_by(username=username).first_or_404().id
 
     # get booking
     room_booking = RoomBookings.query.filter_by(user_id=user_id).first()
-    room_booking.status = 'cancelled'
-    db.session.commit()
+    try:
+        set_room_booking_status(room_booking, 'cancelled')
+        notify_status('room', [user_id], 'cancelled')
+        db.session.commit()
+    except BookingError as error:
+        db.session.rollback()
+        flash(str(error))
     return redirect(url_for('admin_booking'))
 
-@app.route('/admin/booking/mess/<username>/approve', methods=['POST'])
+@route('/admin/booking/mess/<username>/approve', methods=['POST'])
 @login_required
+@admin_required
 def admin_booking_approve_mess(username):
-    if not user_schema.dump(current_user)['admin']:
-        return redirect(url_for('dashboard'))
-    
     # get id 
-    user = User.query.filter_by(username=username).first()
-    user_id = user_schema.dump(user)['id']
+    user_id = User.query.filter_by(username=username).first_or_404().id
 
     # get booking
     mess_booking = MessBookings.query.filter_by(user_id=user_id).first()
-    mess_booking.status = 'approved'
-    db.session.commit()
+    try:
+        set_mess_booking_status(mess_booking, 'approved')
+        notify_status('mess', [user_id], 'approved')
+        db.session.commit()
+    except BookingError as error:
+        db.session.rollback()
+        flash(str(error))
     return redirect(url_for('admin_booking'))
 
-@app.route('/admin/booking/mess/<username>/reject', methods=['POST'])
+@route('/admin/booking/mess/<username>/reject', methods=['POST'])
 @login_required
+@admin_required
 def admin_booking_reject_mess(username):
-    if not user_schema.dump(current_user)['admin']:
-        return redirect(url_for('dashboard'))
-    
     # get id 
-    user = User.query.filter_by(username=username).first()
-    user_id = user_schema.dump(user)['id']
+    user_id = User.query.filter_by(username=username).first_or_404().id
 
     # get booking
     mess_booking = MessBookings.query.filter_by(user_id=user_id).first()
-    mess_booking.status = 'cancelled'
+    try:
+        set_mess_booking_status(mess_booking, 'cancelled')
+        notify_status('mess', [user_id], 'cancelled')
+        db.session.commit()
+    except BookingError as error:
+        db.session.rollback()
+        flash(str(error))
+    return redirect(url_for('admin_booking'))
+
+"""BULK BOOKING ACTIONS - ADMIN
+Parameters: kind (room, mess), action (approve, reject), booking_ids
+Return: booking.html with a summary, or JSON {id: result} for JSON requests;
+selections over BULK_INLINE_LIMIT are queued as a job (202 with its status URL)
+"""
+@route('/admin/booking/bulk', methods=['POST'])
+@login_required
+@admin_required
+def admin_booking_bulk():
+    data = request.get_json(silent=True) or {}
+    kind = data.get('kind', request.form.get('kind'))
+    action = data.get('action', request.form.get('action'))
+    ids = data.get('booking_ids', request.form.getlist('booking_ids'))
+    model = BOOKING_MODELS.get(kind)
+    status = {'approve': 'approved', 'reject': 'cancelled'}.get(action)
+    try:
+        ids = list(dict.fromkeys(int(id) for id in ids))
+    except (TypeError, ValueError):
+        ids = None
+    if model is None or status is None or ids is None:
+        if request.is_json:
+            return jsonify({'error': 'kind, action and booking_ids are required'}), 400
+        flash('Choose bookings and an action.')
+        return redirect(url_for('admin_booking'))
+
+    if len(ids) > app.config['BULK_INLINE_LIMIT']:
+        job = enqueue('bulk_set_status', kind=kind, ids=ids, status=status, actor_id=current_user.id)
+        db.session.commit()
+        if request.is_json:
+            return jsonify({'job': job.id, 'status_url': url_for('admin_job', id=job.id)}), 202
+        flash('%d %s bookings queued to be %s (job %d).' % (len(ids), kind, status, job.id))
+        return redirect(url_for('admin_booking'))
+
+    results = bulk_set_status(model, ids, status) if ids else {}
+    changed = [id for id in ids if results[id] == status]
+    notify_status(kind, [user_id for user_id, in db.session.query(model.user_id).filter(model.id.in_(changed))] if changed else [], status)
     db.session.commit()
-    return redirect(url_for('admin_booking'))
\ No newline at end of file
+    if request.is_json:
+        return jsonify({'results': {str(id): result for id, result in results.items()}})
+    changed = sum(1 for result in results.values() if result == status)
+    flash('%d of %d %s bookings %s.' % (changed, len(results), kind, status))
+    for id, result in results.items():
+        if result != status:
+            flash('Booking %d: %s.' % (id, result))
+    return redirect(url_for('admin_booking'))
+
+"""METRICS PAGE - ADMIN
+Parameters: None
+Return Templates: metrics.html
+"""
+@route('/admin/metrics')
+@login_required
+@admin_required
+def admin_metrics():
+    metrics = profiling.profiler.snapshot() if profiling.profiler else None
+    return render_template('admin/metrics.html', user=current_user, metrics=metrics)
+
+@route('/admin/metrics.json')
+@login_required
+@admin_required
+def admin_metrics_json():
+    if not profiling.profiler:
+        return jsonify({'error': 'profiling is disabled'}), 404
+    return jsonify(profiling.profiler.snapshot())
+
+@route('/admin/metrics.txt')
+@login_required
+@admin_required
+def admin_metrics_prometheus():
+    if not profiling.profiler:
+        return Response('profiling is disabled\n', status=404, mimetype='text/plain')
+    return Response(profiling.profiler.prometheus(), mimetype='text/plain; version=0.0.4')
+
+"""RATE LIMITS - ADMIN
+Parameters: None
+Return: JSON checks allowed and rejected per route group and scope, or the same as Prometheus text
+"""
+@route('/admin/ratelimits')
+@login_required
+@admin_required
+def admin_ratelimits():
+    return jsonify(rate_limiter.stats())
+
+@route('/admin/ratelimits.txt')
+@login_required
+@admin_required
+def admin_ratelimits_prometheus():
+    return Response(rate_limiter.prometheus(), mimetype='text/plain; version=0.0.4')
+
+"""BACKGROUND JOBS - ADMIN
+Parameters: None
+Return: JSON queue counts, or one job's status and result
+"""
+@route('/admin/jobs')
+@login_required
+@admin_required
+def admin_jobs():
+    return jsonify(queue_stats())
+
+@route('/admin/jobs/<int:id>')
+@login_required
+@admin_required
+def admin_job(id):
+    job = Job.query.get(id)
+    if job is None:
+        return jsonify({'error': 'job not found'}), 404
+    return jsonify({
+        'id': job.id, 'name': job.name, 'status': job.status, 'attempts': job.attempts,
+        'result': json.loads(job.result) if job.result else None, 'error': job.last_error,
+    })
+
+"""RESTAURANT BILLING - ADMIN
+Parameters: mess_id, name, price (new menu item); period, account_cursor
+Return Templates: billing.html
+"""
+@route('/admin/billing', methods=['GET', 'POST'])
+@read_only
+@login_required
+@admin_required
+def admin_billing():
+    form = MenuItemForm()
+    if form.validate_on_submit():
+        if not form.mess_id.data.isdigit() or not form.price.data.isdigit() or Mess.query.get(int(form.mess_id.data)) is None:
+            flash('Enter an existing mess id and a whole-number price.')
+        else:
+            db.session.add(MenuItem(mess_id=int(form.mess_id.data), name=form.name.data, price=int(form.price.data), status='A'))
+            db.session.commit()
+        return redirect(url_for('admin_billing'))
+    menu_items = db.session.query(MenuItem.id, MenuItem.name, MenuItem.price, MenuItem.status, Mess.name.label('mess_name')).join(Mess, MenuItem.mess_id==Mess.id).order_by(Mess.id, MenuItem.name).all()
+
+    # one page of running totals, newest residents first
+    per_page = app.config['BOOKINGS_PER_PAGE']
+    account_cursor = request.args.get('account_cursor', type=int)
+    accounts = db.session.query(BillingAccount.user_id, User.username, BillingAccount.order_total, BillingAccount.order_count, BillingAccount.invoiced_total).join(User, BillingAccount.user_id==User.id)
+    if account_cursor is not None:
+        accounts = accounts.filter(BillingAccount.user_id < account_cursor)
+    accounts = accounts.order_by(BillingAccount.user_id.desc()).limit(per_page + 1).all()
+    account_next = accounts[per_page - 1].user_id if len(accounts) > per_page else None
+
+    period = request.args.get('period') or current_period()
+    invoices = db.session.query(Invoice.id, User.username, Invoice.total, Invoice.orders, Invoice.created_at).join(User, Invoice.user_id==User.id).filter(Invoice.period==period).order_by(Invoice.id.desc()).limit(per_page).all()
+    return render_template('admin/billing.html', user=current_user, form=form, menu_items=menu_items, accounts=accounts[:per_page], account_cursor=account_cursor, account_next=account_next, period=period, invoices=invoices)
+
+@route('/admin/billing/invoices', methods=['POST'])
+@login_required
+@admin_required
+def admin_billing_invoices():
+    period = request.form.get('period') or current_period()
+    try:
+        count = generate_invoices(check_period(period))
+        flash('Created %d invoices for %s.' % (count, period))
+    except BillingError as error:
+        db.session.rollback()
+        flash(str(error))
+    except IntegrityError:
+        # ux_invoice_user_id_period: another run invoiced these residents for the period first
+        db.session.rollback()
+        flash('Residents were already invoiced for %s.' % period)
+    return redirect(url_for('admin_billing', period=period))
+
+"""ORDER INGESTION - ADMIN
+Parameters: JSON {"orders": [{"user_id", "mess_id", "items": [{"menu_item_id", "quantity"}], "reference"}]}
+Return: JSON {"created", "duplicates", "errors"}
+"""
+@route('/admin/billing/orders', methods=['POST'])
+@login_required
+@admin_required
+def admin_billing_orders():
+    data = request.get_json(silent=True) or {}
+    orders = data.get('orders')
+    if not isinstance(orders, list):
+        return jsonify({'error': 'orders must be a list'}), 400
+    for attempt in range(3):
+        try:
+            result = ingest_orders(orders)
+            db.session.commit()
+            break
+        except IntegrityError:
+            # a concurrent batch stored some of these references after they were checked;
+            # undo this batch and check again, which counts them as duplicates
+            db.session.rollback()
+    else:
+        return jsonify({'error': 'conflicting batches, please send this one again'}), 409
+    return jsonify(result), 201 if result['created'] else 200
+
+"""DATA EXPORT AND IMPORT - ADMIN
+Parameters: table, format (csv, jsonl); file (multipart upload to import)
+Return Templates: data.html; exports stream the table as a download; imports answer
+JSON {"rows", "imported", "rejected", "errors": [{"line", "error"}]} when JSON is accepted
+"""
+@route('/admin/data')
+@login_required
+@admin_required
+def admin_data():
+    return render_template('admin/data.html', user=current_user, tables=TRANSFER_TABLES, formats=TRANSFER_FORMATS)
+
+@route('/admin/data/<table>.<format>')
+@read_only
+@login_required
+@admin_required
+def admin_data_export(table, format):
+    if table not in TRANSFER_TABLES or format not in TRANSFER_FORMATS:
+        return Response('no such export\n', status=404, mimetype='text/plain')
+    # rows are fetched while the response is sent, a chunk at a time
+    return Response(stream_with_context(export_rows(table, format)), mimetype=TRANSFER_FORMATS[format],
+                    headers={'Content-Disposition': 'attachment; filename=%s.%s' % (table, format)})
+
+@route('/admin/data/import', methods=['POST'])
+@login_required
+@admin_required
+def admin_data_import():
+    wants_json = request.accept_mimetypes.best == 'application/json'
+    table = request.values.get('table')
+    upload = request.files.get('file')
+    if table not in TRANSFER_TABLES or upload is None:
+        if wants_json:
+            return jsonify({'error': 'a known table and a file are required'}), 400
+        flash('Choose a table and a file to import.')
+        return redirect(url_for('admin_data'))
+    errors = []
+    def rejected(line, row, reason):
+        if len(errors) < app.config['IMPORT_ERRORS_SHOWN']:
+            errors.append({'line': line, 'error': reason})
+    # batches before a failure stay committed, so a failed import reports what they loaded
+    report = {'rows': 0, 'imported': 0, 'rejected': 0}
+    def progress(batch_report):
+        report.update(batch_report)
+    stream = io.TextIOWrapper(upload.stream, encoding='utf-8', newline='')
+    try:
+        # hashing plain passwords is too slow for a request; `flask import-data` takes them
+        import_rows(table, read_rows(stream, request.form.get('format') or format_of(upload.filename)), rejected, progress, plain_passwords=False)
+    except (TransferError, UnicodeDecodeError) as error:
+        report['error'] = str(error)
+    if wants_json:
+        return jsonify(dict(report, errors=errors)), 400 if 'error' in report else 200
+    summary = '%s: %d rows, %d imported, %d rejected.' % (table, report['rows'], report['imported'], report['rejected'])
+    flash('%s Stopped after that: %s' % (summary, report['error']) if 'error' in report else summary)
+    for error in errors[:10]:
+        flash('Line %d: %s.' % (error['line'], error['error']))
+    return redirect(url_for('admin_data'))
+
+"""MONTHLY CHARGES - ADMIN
+Parameters: period, cursor; POST period runs the charges for that month
+Return Templates: charges.html
+"""
+@route('/admin/charges', methods=['GET', 'POST'])
+@read_only
+@login_required
+@admin_required
+def admin_charges():
+    period = request.values.get('period') or current_period()
+    try:
+        check_period(period)
+    except BillingError as error:
+        flash(str(error))
+        return redirect(url_for('admin_charges'))
+    if request.method == 'POST':
+        run = run_charges(period)
+        flash('%s: %d charges totalling %d in %.2fs.' % (period, run.charges, run.total, run.seconds))
+        return redirect(url_for('admin_charges', period=period))
+
+    per_page = app.config['BOOKINGS_PER_PAGE']
+    cursor = request.args.get('cursor', type=int)
+    charges = db.session.query(Charge.id, Charge.kind, Charge.booking_id, Charge.item_id, Charge.price, Charge.days, Charge.amount, User.username).join(User, Charge.user_id==User.id).filter(Charge.period==period)
+    if cursor is not None:
+        charges = charges.filter(Charge.id < cursor)
+    charges = charges.order_by(Charge.id.desc()).limit(per_page + 1).all()
+    next_cursor = charges[per_page - 1].id if len(charges) > per_page else None
+    runs = ChargeRun.query.order_by(ChargeRun.period.desc()).limit(12).all()
+    return render_template('admin/charges.html', user=current_user, period=period, summary=charge_summary(period), charges=charges[:per_page], cursor=cursor, next_cursor=next_cursor, runs=runs)
@@ -1,8 +1,36 @@
 from sqlalchemy.ext.declarative import declarative_base
 from flask_sqlalchemy import SQLAlchemy
 from flask_marshmallow import Marshmallow
+from sqlalchemy import event
+from .replicas import RoutingSession
 
 engine = None
 Base = declarative_base()
-db = SQLAlchemy()
-ma=Marshmallow()
\ No newline at end of file
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+ma=Marshmallow()
+
+def engine_options(config):
+    """SQLALCHEMY_ENGINE_OPTIONS for the configured database."""
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        # busy timeout in seconds for the sqlite3 driver
+        return {'connect_args': {'timeout': config['SQLITE_BUSY_TIMEOUT'] / 1000.0}}
+    return {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+    }
+
+def configure_sqlite(engine, wal=True, busy_timeout=5000):
+    """Turn on WAL and a busy timeout on every new SQLite connection."""
+    if engine.dialect.name != 'sqlite' or engine.url.database in (None, '', ':memory:'):
+        return
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(connection, record):
+        cursor = connection.cursor()
+        if wal:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=%d' % busy_timeout)
+        cursor.close()
@@ -0,0 +1,256 @@
+"""Append-only history of booking and ticket changes.
+
+Bookings and tickets keep only their current status. Every change to one
+also appends a row to the event table, in the same transaction as the
+change, so the history commits or rolls back with it:
+
+    created   a booking or ticket was made
+    status    its status changed, from old_status to status
+    deleted   it was deleted; status is the one it had
+    snapshot  it entered the history with this status without being made
+              here: rows that existed before the table did, and imports
+
+ORM writes are recorded through mapper events and inserted with one
+executemany when the session flushes, like pghr.stats' counters. Core
+statements bypass those events, so code that changes bookings in bulk
+(pghr.bookings.bulk_set_status, pghr.transfer's imports) calls add()
+itself. Events are never updated or deleted.
+
+Reports are projections: replay() streams the events in the order they were
+appended, CHUNK at a time through a server-side cursor, and folds them into
+a Projection without reading the bookings or tickets. Replaying up to a
+time rebuilds the state as it was then; `since` and `until` pick a window,
+found through the (entity, at) index.
+"""
+from collections import Counter, defaultdict
+from datetime import date, datetime, time, timedelta
+import click
+from flask import g, has_request_context
+from flask.cli import with_appcontext
+from sqlalchemy import event, func, literal, select
+from sqlalchemy.orm import Session
+from .database import db
+from .models import RoomBookings, MessBookings, Ticket, Event
+from .stats import previous
+
+table = Event.__table__
+
+# rows per fetch while replaying
+CHUNK = 1000
+
+# model: (entity, column holding the booked room or mess)
+ENTITIES = {
+    RoomBookings: ('room_booking', RoomBookings.room_id),
+    MessBookings: ('mess_booking', MessBookings.mess_id),
+    Ticket: ('ticket', None),
+}
+
+
+def current_actor():
+    """Id of the logged-in user making the change, if a request has loaded one."""
+    user = g.get('_login_user') if has_request_context() else None
+    return user.id if user is not None and user.is_authenticated else None
+
+
+def entry(model, action, entity_id, user_id, status, item_id=None, old_status=None, actor_id=None, at=None):
+    """One event row, for add()."""
+    return {
+        'entity': ENTITIES[model][0], 'entity_id': entity_id, 'action': action, 'old_status': old_status,
+        'status': status, 'user_id': user_id, 'item_id': item_id, 'actor_id': actor_id, 'at': at or datetime.utcnow(),
+    }
+
+
+def add(rows):
+    """Append event rows in the current transaction, for writes made without the ORM."""
+    if rows:
+        db.session.execute(table.insert(), rows)
+
+
+def watch(model):
+    entity, item_id = ENTITIES[model]
+
+    def record(target, action, old_status=None):
+        values = entry(model, action, target.id, target.user_id, target.status, item_id=getattr(target, item_id.key) if item_id is not None else None,
+                       old_status=old_status, actor_id=current_actor())
+        Session.object_session(target).info.setdefault('events', []).append(values)
+
+    @event.listens_for(model, 'after_insert')
+    def inserted(mapper, connection, target):
+        record(target, 'created')
+
+    @event.listens_for(model, 'after_update')
+    def updated(mapper, connection, target):
+        old = previous(target, 'status')
+        if old != target.status:
+            record(target, 'status', old)
+
+    @event.listens_for(model, 'after_delete')
+    def deleted(mapper, connection, target):
+        record(target, 'deleted')
+
+
+for model in ENTITIES:
+    watch(model)
+
+
+@event.listens_for(Session, 'after_flush')
+def write_pending(session, flush_context):
+    rows = session.info.pop('events', None)
+    if rows:
+        session.connection().execute(table.insert(), rows)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_pending(session):
+    session.info.pop('events', None)
+
+
+def snapshot(connection):
+    """Record every booking and ticket not in the history yet as a snapshot of its current status."""
+    for model, (entity, item_id) in ENTITIES.items():
+        created = model.check_in if model is not Ticket else model.created_at
+        if connection.dialect.name != 'sqlite':
+            # event times are UTC without a zone
+            created = func.timezone('UTC', created)
+        recorded = select(table.c.entity_id).where(table.c.entity == entity)
+        rows = select(literal(entity), model.id, literal('snapshot'), model.status, model.user_id,
+                      item_id if item_id is not None else literal(None), func.coalesce(created, func.now())) \
+            .where(model.id.not_in(recorded))
+        connection.execute(table.insert().from_select(['entity', 'entity_id', 'action', 'status', 'user_id', 'item_id', 'at'], rows))
+
+
+def moment(value, end=False):
+    """A datetime for a date or datetime bound; a date `until` includes that whole day."""
+    if isinstance(value, date) and not isinstance(value, datetime):
+        value = datetime.combine(value + timedelta(days=1) if end else value, time.min)
+    return value
+
+
+def stream(entities=None, since=None, until=None, session=None):
+    """Yield events in the order they were appended, at `since` or later and before `until`.
+
+    A date `until` includes that day. Only the event table is read.
+    """
+    query = select(table).order_by(table.c.id)
+    if entities:
+        query = query.where(table.c.entity.in_(entities))
+    if since is not None:
+        query = query.where(table.c.at >= moment(since))
+    if until is not None:
+        query = query.where(table.c.at < moment(until, end=True))
+    result = (session or db.session).execute(query.execution_options(stream_results=True, max_row_buffer=CHUNK))
+    for rows in result.partitions(CHUNK):
+        yield from rows
+
+
+class Projection():
+    """State folded from events one at a time; subclasses override apply() and result()."""
+    def apply(self, event):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+class CurrentStatus(Projection):
+    """{entity: {id: status}} of the bookings and tickets that exist."""
+    def __init__(self):
+        self.statuses = defaultdict(dict)
+
+    def apply(self, event):
+        if event.action == 'deleted':
+            self.statuses[event.entity].pop(event.entity_id, None)
+        else:
+            self.statuses[event.entity][event.entity_id] = event.status
+
+    def result(self):
+        return dict(self.statuses)
+
+
+class DailyTransitions(Projection):
+    """Counter of (entity, day, old status, new status); None stands for created or deleted."""
+    def __init__(self):
+        self.counts = Counter()
+
+    def apply(self, event):
+        if event.action == 'created':
+            change = (None, event.status)
+        elif event.action == 'status':
+            change = (event.old_status, event.status)
+        elif event.action == 'deleted':
+            change = (event.status, None)
+        else:
+            return
+        self.counts[(event.entity, event.at.date().isoformat()) + change] += 1
+
+    def result(self):
+        return self.counts
+
+
+class DecisionTimes(Projection):
+    """{entity: (decided, mean seconds)} from creation to leaving 'pending', for what was created in the window."""
+    def __init__(self):
+        self.waiting = {}
+        self.totals = defaultdict(lambda: [0, 0.0])
+
+    def apply(self, event):
+        key = (event.entity, event.entity_id)
+        if event.action == 'created' and event.status == 'pending':
+            self.waiting[key] = event.at
+        elif event.action == 'status' and event.old_status == 'pending' and key in self.waiting:
+            totals = self.totals[event.entity]
+            totals[0] += 1
+            totals[1] += (event.at - self.waiting.pop(key)).total_seconds()
+        elif event.action == 'deleted':
+            self.waiting.pop(key, None)
+
+    def result(self):
+        return {entity: (decided, seconds / decided) for entity, (decided, seconds) in self.totals.items()}
+
+
+def replay(projection, entities=None, since=None, until=None, session=None):
+    """Fold the events from stream() into `projection` and return its result."""
+    for row in stream(entities, since, until, session):
+        projection.apply(row)
+    return projection.result()
+
+
+def history(model, id):
+    """Every event of one booking or ticket, oldest first."""
+    entity = ENTITIES[model][0]
+    return db.session.execute(select(table).where(table.c.entity == entity, table.c.entity_id == id).order_by(table.c.id)).all()
+
+
+def verify(session=None):
+    """(entity, id, replayed status, live status) wherever replaying all events disagrees with the tables."""
+    session = session or db.session
+    replayed = replay(CurrentStatus(), session=session)
+    mismatches = []
+    for model, (entity, item_id) in ENTITIES.items():
+        live = dict(session.execute(select(model.id, model.status)).all())
+        statuses = replayed.get(entity, {})
+        for id in sorted(set(live) | set(statuses)):
+            if live.get(id) != statuses.get(id):
+                mismatches.append((entity, id, statuses.get(id), live.get(id)))
+    return mismatches
+
+
+@click.command('event-report')
+@click.option('--since', type=click.DateTime(['%Y-%m-%d']), help='First day, UTC.')
+@click.option('--until', type=click.DateTime(['%Y-%m-%d']), help='Last day, UTC; included.')
+@click.option('--entity', 'entities', multiple=True, type=click.Choice([entity for entity, item_id in ENTITIES.values()]))
+@click.option('--verify', 'check', is_flag=True, help='Also check that replaying every event gives the current statuses.')
+@with_appcontext
+def event_report_command(since, until, entities, check):
+    """Daily status changes and decision times, replayed from the event history."""
+    since = since.date() if since else None
+    until = until.date() if until else None
+    for (entity, day, old, new), count in sorted(replay(DailyTransitions(), entities, since, until).items(), key=lambda item: item[0][:2]):
+        click.echo('%s %-12s %9s -> %-9s %6d' % (day, entity, old or '(new)', new or '(deleted)', count))
+    for entity, (decided, seconds) in sorted(replay(DecisionTimes(), entities, since, until).items()):
+        click.echo('%-12s %d decided, %.1f hours pending on average' % (entity, decided, seconds / 3600))
+    if check:
+        mismatches = verify()
+        for entity, id, replayed, live in mismatches[:20]:
+            click.echo('%s %d: history says %s, table says %s' % (entity, id, replayed, live))
+        click.echo('%d mismatches between the history and the tables.' % len(mismatches))
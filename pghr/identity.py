@@ -0,0 +1,81 @@
+"""Cached identities for flask_login.
+
+load_user runs on every authenticated request. Instead of loading the full
+User row each time, it keeps a Principal (the few fields the views and
+templates read) in a bounded in-process cache with a time-to-live. Updating
+or deleting a User drops its entry; the TTL bounds how stale an entry can be
+in other worker processes, which do not see that invalidation.
+"""
+import threading
+import time
+from collections import OrderedDict
+from flask_login import UserMixin
+from sqlalchemy import event
+from .models import User
+
+
+class Principal(UserMixin):
+    __slots__ = ('id', 'username', 'email', 'admin')
+
+    def __init__(self, id, username, email, admin):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.admin = admin
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.email, user.admin)
+
+    def __repr__(self):
+        return '<Principal %r>' % self.username
+
+
+class IdentityCache():
+    """LRU cache of principals by user id whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None:
+                return None
+            principal, expires = entry
+            if expires < time.monotonic():
+                del self.entries[user_id]
+                return None
+            self.entries.move_to_end(user_id)
+            return principal
+
+    def put(self, principal):
+        if self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[principal.id] = (principal, time.monotonic() + self.ttl)
+            self.entries.move_to_end(principal.id)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def watch_user_changes(cache):
+    """Drop a user's cached principal whenever the User row is updated or deleted."""
+    def invalidate(mapper, connection, target):
+        cache.invalidate(target.id)
+    event.listen(User, 'after_update', invalidate)
+    event.listen(User, 'after_delete', invalidate)
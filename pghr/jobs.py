@@ -0,0 +1,235 @@
+"""Background jobs backed by the job table.
+
+enqueue() adds a row to the current session, so a job is only queued if the
+request that created it commits; nothing runs for a rolled back change. A
+handler is a function registered with @job('name') that takes the payload as
+keyword arguments and may return a JSON-serialisable result.
+
+Workers claim a job with a conditional UPDATE (only one worker can move a row
+from queued to running) and hold it for JOBS_VISIBILITY_TIMEOUT seconds. The
+handler's writes and the job's completion are committed together; if the
+worker dies, the lease runs out and another worker picks the job up again.
+A failing job is retried after JOBS_RETRY_DELAY seconds, doubling each time,
+until it has been tried max_attempts times and is marked failed.
+
+Each web process starts JOBS_WORKERS worker threads on its first request;
+set it to 0 and run `flask --app app run-jobs` to process jobs in separate
+processes instead. No broker is needed: the database is the queue.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import traceback
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import and_, event, func, or_, update
+from sqlalchemy.orm import Session
+from .database import db
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+# name -> handler function
+handlers = {}
+
+# set when a commit queued new jobs, so idle workers in this process wake up early
+wakeup = threading.Event()
+
+
+def job(name):
+    def decorator(function):
+        handlers[name] = function
+        return function
+    return decorator
+
+
+def enqueue(name, delay=0, max_attempts=None, **payload):
+    """Queue `name` with `payload`; it runs once the current session commits."""
+    if name not in handlers:
+        raise ValueError('unknown job %r' % name)
+    row = Job(name=name, payload=json.dumps(payload), status='queued', attempts=0,
+              max_attempts=max_attempts or current_app.config['JOBS_MAX_ATTEMPTS'],
+              run_at=datetime.utcnow() + timedelta(seconds=delay))
+    db.session.add(row)
+    db.session.info['jobs_enqueued'] = True
+    return row
+
+
+@event.listens_for(Session, 'after_commit')
+def wake_workers(session):
+    if session.info.pop('jobs_enqueued', False):
+        wakeup.set()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_enqueued(session):
+    session.info.pop('jobs_enqueued', None)
+
+
+def runnable(now):
+    # queued and due, or running on a lease that expired
+    return or_(and_(Job.status == 'queued', Job.run_at <= now), and_(Job.status == 'running', Job.locked_until < now))
+
+
+def claim(worker_id, visibility_timeout):
+    """Lease the next due job for `worker_id`, or return None."""
+    now = datetime.utcnow()
+    # look before writing so idle polling never takes the write lock
+    candidates = [id for id, in db.session.query(Job.id).filter(runnable(now)).order_by(Job.run_at, Job.id).limit(10)]
+    for id in candidates:
+        statement = update(Job).where(Job.id == id, runnable(now)).values(
+            status='running', attempts=Job.attempts + 1, locked_by=worker_id,
+            locked_until=now + timedelta(seconds=visibility_timeout))
+        if db.session.execute(statement.execution_options(synchronize_session=False)).rowcount == 1:
+            db.session.commit()
+            return Job.query.get(id)
+    db.session.rollback()
+    return None
+
+
+def finish(job_id, worker_id, **values):
+    """Update a job we hold the lease on; False if another worker took it over."""
+    statement = update(Job).where(Job.id == job_id, Job.locked_by == worker_id, Job.status == 'running').values(**values)
+    return db.session.execute(statement.execution_options(synchronize_session=False)).rowcount == 1
+
+
+def run_job(row, worker_id, retry_delay):
+    job_id, name, attempts, max_attempts = row.id, row.name, row.attempts, row.max_attempts
+    try:
+        if attempts > max_attempts:
+            raise RuntimeError('gave up after %d attempts' % max_attempts)
+        result = handlers[name](**json.loads(row.payload))
+        if finish(job_id, worker_id, status='done', result=json.dumps(result), finished_at=datetime.utcnow()):
+            db.session.commit()
+        else:
+            # the lease expired and someone else is running it; drop our writes
+            logger.warning('job %d (%s) lost its lease', job_id, name)
+            db.session.rollback()
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc()
+        logger.warning('job %d (%s) failed, attempt %d of %d:\n%s', job_id, name, attempts, max_attempts, error)
+        if attempts >= max_attempts:
+            finish(job_id, worker_id, status='failed', last_error=error, finished_at=datetime.utcnow())
+        else:
+            retry_at = datetime.utcnow() + timedelta(seconds=retry_delay * 2 ** (attempts - 1))
+            finish(job_id, worker_id, status='queued', last_error=error, run_at=retry_at, locked_by=None, locked_until=None)
+        db.session.commit()
+
+
+class Worker():
+    """Threads that claim and run jobs until stop() is called."""
+
+    def __init__(self, app, threads=1, poll_interval=1.0, visibility_timeout=60, retry_delay=10):
+        self.app = app
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+        self.retry_delay = retry_delay
+        self.name = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.stopping = threading.Event()
+        self.running = []
+
+    @classmethod
+    def from_config(cls, app, threads=None):
+        config = app.config
+        return cls(app, config['JOBS_WORKERS'] if threads is None else threads, config['JOBS_POLL_INTERVAL'],
+                   config['JOBS_VISIBILITY_TIMEOUT'], config['JOBS_RETRY_DELAY'])
+
+    def run_pending(self, worker_id=None):
+        """Run due jobs until none are left; returns how many ran. Needs an app context."""
+        worker_id = worker_id or self.name
+        count = 0
+        while not self.stopping.is_set():
+            row = claim(worker_id, self.visibility_timeout)
+            if row is None:
+                break
+            run_job(row, worker_id, self.retry_delay)
+            count += 1
+        db.session.remove()
+        return count
+
+    def loop(self, worker_id):
+        while not self.stopping.is_set():
+            try:
+                with self.app.app_context():
+                    ran = self.run_pending(worker_id)
+            except Exception:
+                logger.exception('job worker %s crashed, restarting', worker_id)
+                ran = 0
+            if not ran:
+                wakeup.wait(self.poll_interval)
+                wakeup.clear()
+
+    def start(self):
+        for index in range(self.threads):
+            thread = threading.Thread(target=self.loop, args=('%s:%d' % (self.name, index),), name='job-worker-%d' % index, daemon=True)
+            thread.start()
+            self.running.append(thread)
+        return self
+
+    def stop(self, timeout=None):
+        self.stopping.set()
+        wakeup.set()
+        for thread in self.running:
+            thread.join(timeout)
+        self.running = []
+
+
+def init_jobs(app):
+    """Start the in-process workers on the first request, so CLI commands don't."""
+    if not app.config['JOBS_WORKERS']:
+        return
+    lock = threading.Lock()
+
+    @app.before_request
+    def start_job_workers():
+        if 'jobs' not in app.extensions:
+            with lock:
+                if 'jobs' not in app.extensions:
+                    app.extensions['jobs'] = Worker.from_config(app).start()
+
+
+def queue_stats():
+    counts = dict(db.session.query(Job.status, func.count(Job.id)).group_by(Job.status).all())
+    return {status: counts.get(status, 0) for status in ('queued', 'running', 'done', 'failed')}
+
+
+def purge_jobs(days):
+    """Delete jobs that finished more than `days` days ago; returns the count."""
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    deleted = Job.query.filter(Job.status.in_(('done', 'failed')), Job.finished_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+@click.command('run-jobs')
+@click.option('--threads', default=2, show_default=True, help='Worker threads.')
+@click.option('--once', is_flag=True, help='Run the jobs that are due now and exit.')
+@with_appcontext
+def run_jobs_command(threads, once):
+    """Process background jobs."""
+    worker = Worker.from_config(current_app._get_current_object(), threads)
+    if once:
+        click.echo('Ran %d jobs.' % worker.run_pending())
+        return
+    click.echo('Running %d job worker threads as %s, Ctrl+C to stop.' % (threads, worker.name))
+    worker.start()
+    try:
+        while True:
+            worker.stopping.wait(60)
+    except KeyboardInterrupt:
+        click.echo('Stopping, waiting for running jobs to finish.')
+        worker.stop()
+
+
+@click.command('purge-jobs')
+@click.option('--days', default=7, show_default=True, help='Keep jobs that finished more recently than this.')
+@with_appcontext
+def purge_jobs_command(days):
+    """Delete old finished jobs."""
+    click.echo('Deleted %d jobs.' % purge_jobs(days))
@@ -0,0 +1,214 @@
+"""Versioned schema migrations.
+
+db.create_all() only creates missing tables, so anything added to an existing
+table (indexes, columns) goes here as a numbered migration. Applied versions
+are recorded in the schema_migration table; upgrade_db() runs every migration
+newer than the recorded version, each in its own transaction. Every process
+the app starts in calls migrate_schema(), which holds migration_lock() while
+it migrates so that concurrently starting workers take turns and all but the
+first find the schema already current.
+
+Migrations only use SQLAlchemy constructs or SQL that both SQLite and
+PostgreSQL accept, so the same list applies to either database.
+"""
+import fcntl
+import logging
+from contextlib import contextmanager
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import Date, cast, func, inspect
+from .database import db
+from .models import SchemaMigration, RoomBookings, Job, MenuItem, Invoice, Order, OrderItem, BillingAccount, Charge, ChargeRun, Statistic, Event
+from .stats import backfill_first_replies, store_stats
+from .search import build_fts, fts_available
+from .events import snapshot
+
+logger = logging.getLogger(__name__)
+
+# pg_advisory_lock key held while migrating
+MIGRATION_LOCK_KEY = 0x70676872
+
+
+def create_index(connection, table_name, name, *columns, unique=False):
+    # IF NOT EXISTS covers databases created by create_all() with the index already declared
+    connection.execute(db.text('CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)' % ('UNIQUE ' if unique else '', name, table_name, ', '.join(columns))))
+
+
+def add_column(connection, table_name, name, definition):
+    if name not in [column['name'] for column in inspect(connection).get_columns(table_name)]:
+        connection.execute(db.text('ALTER TABLE %s ADD COLUMN %s %s' % (table_name, name, definition)))
+
+
+def add_booking_and_ticket_indexes(connection):
+    create_index(connection, 'room_bookings', 'ix_room_bookings_user_id_status', 'user_id', 'status')
+    create_index(connection, 'room_bookings', 'ix_room_bookings_status_id', 'status', 'id')
+    create_index(connection, 'room_bookings', 'ix_room_bookings_room_id_status', 'room_id', 'status')
+    create_index(connection, 'mess_bookings', 'ix_mess_bookings_user_id_status', 'user_id', 'status')
+    create_index(connection, 'mess_bookings', 'ix_mess_bookings_status_id', 'status', 'id')
+    create_index(connection, 'mess_bookings', 'ix_mess_bookings_mess_id_status', 'mess_id', 'status')
+    create_index(connection, 'ticket', 'ix_ticket_user_id_status', 'user_id', 'status')
+    create_index(connection, 'ticket_replies', 'ix_ticket_replies_ticket_id_created_at', 'ticket_id', 'created_at')
+
+
+def add_announcement_feed_index(connection):
+    create_index(connection, 'announcements', 'ix_announcements_created_at_id', 'created_at', 'id')
+
+
+# the one booking of a user kept by migration 3: approved, else pending, else the oldest
+KEPT_BOOKING = ("(SELECT kept.id FROM {table} AS kept WHERE kept.user_id = {table}.user_id "
+                "ORDER BY CASE kept.status WHEN 'approved' THEN 0 WHEN 'pending' THEN 1 ELSE 2 END, kept.id LIMIT 1)")
+
+
+def add_booking_uniqueness_and_occupancy(connection):
+    # duplicates came from racing submissions; they are moved to <table>_duplicates, not lost
+    for table_name in ('room_bookings', 'mess_bookings'):
+        duplicates = 'SELECT * FROM {table} WHERE id != %s' % KEPT_BOOKING
+        rows = connection.execute(db.text(duplicates.format(table=table_name))).mappings().all()
+        if not rows:
+            continue
+        backup = '%s_duplicates' % table_name
+        if inspect(connection).has_table(backup):
+            connection.execute(db.text(('INSERT INTO %s ' % backup) + duplicates.format(table=table_name)))
+        else:
+            connection.execute(db.text(('CREATE TABLE %s AS ' % backup) + duplicates.format(table=table_name)))
+        for row in rows:
+            logger.warning('moved duplicate %s %d (user %d, %s) to %s', table_name, row['id'], row['user_id'], row['status'], backup)
+        connection.execute(db.text(('DELETE FROM {table} WHERE id != %s' % KEPT_BOOKING).format(table=table_name)))
+    create_index(connection, 'room_bookings', 'ux_room_bookings_user_id', 'user_id', unique=True)
+    create_index(connection, 'mess_bookings', 'ux_mess_bookings_user_id', 'user_id', unique=True)
+    add_column(connection, 'room', 'occupancy', 'INTEGER NOT NULL DEFAULT 0')
+    connection.execute(db.text("UPDATE room SET occupancy = (SELECT COUNT(*) FROM room_bookings WHERE room_bookings.room_id = room.id AND room_bookings.status IN ('pending', 'approved'))"))
+
+
+def add_job_table(connection):
+    Job.__table__.create(connection, checkfirst=True)
+
+
+def add_billing_tables(connection):
+    for model in (MenuItem, Invoice, Order, OrderItem, BillingAccount):
+        model.__table__.create(connection, checkfirst=True)
+
+
+def add_monthly_charges(connection):
+    # check_out used to be stamped on every update; keep it only as the move-out time of cancelled bookings
+    for table_name in ('room_bookings', 'mess_bookings'):
+        connection.execute(db.text("UPDATE %s SET check_out = NULL WHERE status != 'cancelled'" % table_name))
+    for model in (Charge, ChargeRun):
+        model.__table__.create(connection, checkfirst=True)
+
+
+def add_dashboard_statistics(connection):
+    add_column(connection, 'ticket', 'first_reply_at', 'TIMESTAMP')
+    backfill_first_replies(connection)
+    Statistic.__table__.create(connection, checkfirst=True)
+    store_stats(connection)
+
+
+def add_reservation_dates(connection):
+    add_column(connection, 'room_bookings', 'starts_on', 'DATE')
+    add_column(connection, 'room_bookings', 'ends_on', 'DATE')
+    # existing bookings are open-ended stays from the day they were made
+    table = RoomBookings.__table__
+    check_in_day = func.date(table.c.check_in) if connection.dialect.name == 'sqlite' else cast(table.c.check_in, Date)
+    connection.execute(table.update().where(table.c.starts_on == None).values(starts_on=check_in_day))  # noqa: E711
+
+
+def add_search_index(connection):
+    # FTS5 is SQLite only; other databases search with pghr.search's in-process index
+    if fts_available(connection):
+        build_fts(connection)
+
+
+def add_event_history(connection):
+    Event.__table__.create(connection, checkfirst=True)
+    # the history starts from each booking's and ticket's current status
+    snapshot(connection)
+
+
+# (version, description, function taking a connection); append only
+MIGRATIONS = [
+    (1, 'composite indexes on bookings and tickets', add_booking_and_ticket_indexes),
+    (2, 'announcement feed index', add_announcement_feed_index),
+    (3, 'one booking per user and room occupancy', add_booking_uniqueness_and_occupancy),
+    (4, 'background job queue', add_job_table),
+    (5, 'restaurant billing', add_billing_tables),
+    (6, 'monthly rent and mess charges', add_monthly_charges),
+    (7, 'admin dashboard statistics', add_dashboard_statistics),
+    (8, 'room reservation dates', add_reservation_dates),
+    (9, 'full-text search index', add_search_index),
+    (10, 'booking and ticket event history', add_event_history),
+]
+
+
+def current_version():
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    return db.session.query(db.func.max(SchemaMigration.version)).scalar() or 0
+
+
+def schema_is_current():
+    """True when every migration has been applied, so startup can skip create_all()."""
+    if not inspect(db.engine).has_table(SchemaMigration.__tablename__):
+        return False
+    return current_version() >= MIGRATIONS[-1][0]
+
+
+def upgrade_db():
+    """Apply pending migrations and return the versions that were applied."""
+    version = current_version()
+    db.session.remove()
+    applied = []
+    for number, description, migrate in MIGRATIONS:
+        if number <= version:
+            continue
+        with db.engine.begin() as connection:
+            migrate(connection)
+            connection.execute(SchemaMigration.__table__.insert(), {'version': number, 'description': description})
+        applied.append(number)
+    return applied
+
+
+@contextmanager
+def migration_lock():
+    """Wait until no other process is migrating this database, and keep it that way until the block exits."""
+    engine = db.engine
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as connection:
+            connection.execute(db.text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+            try:
+                yield
+            finally:
+                connection.execute(db.text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATION_LOCK_KEY})
+    elif engine.dialect.name == 'sqlite' and engine.url.database not in (None, '', ':memory:'):
+        # a lock file beside the database; a SQLite write lock would also block the migrations' own connections
+        with open(engine.url.database + '-migrate.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    else:
+        yield
+
+
+def migrate_schema():
+    """Create missing tables and apply pending migrations unless another process already has; returns the versions applied."""
+    if schema_is_current():
+        return []
+    with migration_lock():
+        # checked again: another worker may have migrated while this one waited for the lock
+        if schema_is_current():
+            return []
+        db.create_all()
+        return upgrade_db()
+
+
+@click.command('upgrade-db')
+@with_appcontext
+def upgrade_db_command():
+    """Apply pending schema migrations."""
+    with migration_lock():
+        applied = upgrade_db()
+    if applied:
+        click.echo('Applied migrations: %s' % ', '.join(str(number) for number in applied))
+    else:
+        click.echo('Database is up to date (version %d).' % current_version())
@@ -1,4 +1,6 @@
+from datetime import date
 from flask_login import UserMixin
+from werkzeug.security import check_password_hash
 from .database import db, ma
 from sqlalchemy.sql import func
 from sqlalchemy.sql import func 
@@ -16,7 +18,8 @@ class User(UserMixin, db.Model):
         return '<User %r>' % self.username
     
     def check_password(self, password):
-        return self.password == password
+        # synchronous; request handlers go through controllers.password_hasher
+        return check_password_hash(self.password, password)
     
 class UserSchema(ma.Schema):
     class Meta:
@@ -33,6 +36,7 @@ class Room(db.Model):
     status = db.Column(db.String(80), unique=False, nullable=False) # A, NA
     price = db.Column(db.Integer, unique=False, nullable=False)
     description = db.Column(db.String(120))
+    occupancy = db.Column(db.Integer, nullable=False, default=0, server_default='0') # pending + approved bookings, kept by pghr.bookings
     
     def __repr__(self):
         return '<Rooms %r>' % self.name
@@ -52,14 +56,22 @@ class RoomBookings(db.Model):
     room = db.relationship('Room', backref=db.backref('room', lazy=True))
     status = db.Column(db.String(80), unique=False, nullable=False) # pending, approved, cancelled
     check_in = db.Column(db.DateTime(timezone=True), server_default=func.now())
-    check_out = db.Column(db.DateTime(timezone=True), onupdate=func.now())
+    check_out = db.Column(db.DateTime(timezone=True)) # set when an approved booking is cancelled
+    starts_on = db.Column(db.Date, default=date.today) # reserved stay [starts_on, ends_on), see pghr.reservations
+    ends_on = db.Column(db.Date) # empty for an open-ended stay
+    __table_args__ = (
+        db.Index('ux_room_bookings_user_id', 'user_id', unique=True),
+        db.Index('ix_room_bookings_user_id_status', 'user_id', 'status'),
+        db.Index('ix_room_bookings_status_id', 'status', 'id'),
+        db.Index('ix_room_bookings_room_id_status', 'room_id', 'status'),
+    )
     
     def __repr__(self):
         return '<Bookings %r>' % self.user_id
 
 class RoomBookingsSchema(ma.Schema):
     class Meta:
-        fields = ('id', 'user_id', 'room_id', 'status', 'check_in', 'check_out')
+        fields = ('id', 'user_id', 'room_id', 'status', 'check_in', 'check_out', 'starts_on', 'ends_on')
 
 room_booking_schema = RoomBookingsSchema()
 room_bookings_schema = RoomBookingsSchema(many=True)
@@ -89,7 +101,13 @@ class MessBookings(db.Model):
     mess = db.relationship('Mess', backref=db.backref('mess', lazy=True))
     status = db.Column(db.String(80), unique=False, nullable=False) # pending, approved, cancelled
     check_in = db.Column(db.DateTime(timezone=True), server_default=func.now())
-    check_out = db.Column(db.DateTime(timezone=True), onupdate=func.now())
+    check_out = db.Column(db.DateTime(timezone=True)) # set when an approved booking is cancelled
+    __table_args__ = (
+        db.Index('ux_mess_bookings_user_id', 'user_id', unique=True),
+        db.Index('ix_mess_bookings_user_id_status', 'user_id', 'status'),
+        db.Index('ix_mess_bookings_status_id', 'status', 'id'),
+        db.Index('ix_mess_bookings_mess_id_status', 'mess_id', 'status'),
+    )
     
     def __repr__(self):
         return '<Bookings %r>' % self.user_id
@@ -106,9 +124,12 @@ class Announcements (db.Model):
     title = db.Column(db.String(80), unique=True, nullable=False)
     description = db.Column(db.String(120))
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    __table_args__ = (
+        db.Index('ix_announcements_created_at_id', 'created_at', 'id'),
+    )
     
     def __repr__(self):
-        return '<Announcements %r>' % self.name
+        return '<Announcements %r>' % self.title
     
 class AnnouncementsSchema(ma.Schema):
     class Meta:
@@ -125,6 +146,10 @@ class Ticket(db.Model):
     description = db.Column(db.String(120))
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
     status = db.Column(db.String(80), unique=False, nullable=False) # open, closed
+    first_reply_at = db.Column(db.DateTime) # UTC, set by pghr.stats on the first reply
+    __table_args__ = (
+        db.Index('ix_ticket_user_id_status', 'user_id', 'status'),
+    )
     
     def __repr__(self):
         return '<Ticket %r>' % self.user_id
@@ -144,6 +169,9 @@ class TicketReplies(db.Model):
     user = db.relationship('User', backref=db.backref('replies', lazy=True))
     description = db.Column(db.String(120))
     created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    __table_args__ = (
+        db.Index('ix_ticket_replies_ticket_id_created_at', 'ticket_id', 'created_at'),
+    )
     
     def __repr__(self):
         return '<TicketReplies %r>' % self.ticket_id
@@ -155,4 +183,190 @@ class TicketRepliesSchema(ma.Schema):
 ticket_reply_schema = TicketRepliesSchema()
 ticket_replies_schema = TicketRepliesSchema(many=True)
 
+class SchemaMigration(db.Model):
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    description = db.Column(db.String(120), nullable=False)
+    applied_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
 
+    def __repr__(self):
+        return '<SchemaMigration %r>' % self.version
+
+class Job(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)
+    payload = db.Column(db.Text, nullable=False) # JSON
+    status = db.Column(db.String(20), nullable=False, default='queued') # queued, running, done, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False) # UTC; not picked up before this
+    locked_until = db.Column(db.DateTime) # UTC; a running job past this is picked up again
+    locked_by = db.Column(db.String(80))
+    result = db.Column(db.Text) # JSON
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    finished_at = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+    def __repr__(self):
+        return '<Job %r %r>' % (self.id, self.name)
+
+class MenuItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    mess_id = db.Column(db.Integer, db.ForeignKey('mess.id'), nullable=False)
+    mess = db.relationship('Mess', backref=db.backref('menu_items', lazy=True))
+    name = db.Column(db.String(80), nullable=False)
+    price = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(80), nullable=False, default='A') # A, NA - Available, Not Available
+    __table_args__ = (
+        db.Index('ux_menu_item_mess_id_name', 'mess_id', 'name', unique=True),
+    )
+
+    def __repr__(self):
+        return '<MenuItem %r>' % self.name
+
+class MenuItemSchema(ma.Schema):
+    class Meta:
+        fields = ('id', 'mess_id', 'name', 'price', 'status')
+
+menu_item_schema = MenuItemSchema()
+menu_items_schema = MenuItemSchema(many=True)
+
+class Order(db.Model):
+    __tablename__ = 'orders'
+    id = db.Column(db.Integer, primary_key=True)
+    reference = db.Column(db.String(40), nullable=False) # unique per order, e.g. the till's receipt number
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    mess_id = db.Column(db.Integer, db.ForeignKey('mess.id'), nullable=False)
+    total = db.Column(db.Integer, nullable=False)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoice.id'))
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    items = db.relationship('OrderItem', backref='order', lazy=True)
+    __table_args__ = (
+        db.Index('ux_orders_reference', 'reference', unique=True),
+        db.Index('ix_orders_user_id_invoice_id', 'user_id', 'invoice_id'),
+        db.Index('ix_orders_invoice_id', 'invoice_id'),
+    )
+
+    def __repr__(self):
+        return '<Order %r>' % self.reference
+
+class OrderSchema(ma.Schema):
+    class Meta:
+        fields = ('id', 'reference', 'user_id', 'mess_id', 'total', 'invoice_id', 'created_at')
+
+order_schema = OrderSchema()
+orders_schema = OrderSchema(many=True)
+
+class OrderItem(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id'), nullable=False)
+    menu_item_id = db.Column(db.Integer, db.ForeignKey('menu_item.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    unit_price = db.Column(db.Integer, nullable=False) # menu price when ordered
+    amount = db.Column(db.Integer, nullable=False)
+    __table_args__ = (
+        db.Index('ix_order_item_order_id', 'order_id'),
+    )
+
+    def __repr__(self):
+        return '<OrderItem %r>' % self.order_id
+
+class Invoice(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    user = db.relationship('User', backref=db.backref('invoices', lazy=True))
+    period = db.Column(db.String(7), nullable=False) # YYYY-MM
+    total = db.Column(db.Integer, nullable=False)
+    orders = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())
+    __table_args__ = (
+        db.Index('ux_invoice_user_id_period', 'user_id', 'period', unique=True),
+        db.Index('ix_invoice_period', 'period'),
+    )
+
+    def __repr__(self):
+        return '<Invoice %r %r>' % (self.user_id, self.period)
+
+class InvoiceSchema(ma.Schema):
+    class Meta:
+        fields = ('id', 'user_id', 'period', 'total', 'orders', 'created_at')
+
+invoice_schema = InvoiceSchema()
+invoices_schema = InvoiceSchema(many=True)
+
+class BillingAccount(db.Model):
+    # running totals per resident, kept by pghr.billing on every order and invoice
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True, autoincrement=False)
+    order_total = db.Column(db.Integer, nullable=False, default=0)
+    order_count = db.Column(db.Integer, nullable=False, default=0)
+    invoiced_total = db.Column(db.Integer, nullable=False, default=0)
+    invoiced_count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<BillingAccount %r>' % self.user_id
+
+class Charge(db.Model):
+    # one month's rent or mess charge for a booking, written by pghr.charges
+    id = db.Column(db.Integer, primary_key=True)
+    period = db.Column(db.String(7), nullable=False) # YYYY-MM
+    kind = db.Column(db.String(10), nullable=False) # room, mess
+    booking_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    item_id = db.Column(db.Integer, nullable=False) # room or mess id
+    price = db.Column(db.Integer, nullable=False) # monthly price
+    days = db.Column(db.Integer, nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    __table_args__ = (
+        db.Index('ux_charge_period_kind_booking_id', 'period', 'kind', 'booking_id', unique=True),
+        db.Index('ix_charge_user_id_period', 'user_id', 'period'),
+    )
+
+    def __repr__(self):
+        return '<Charge %r %r %r>' % (self.period, self.kind, self.booking_id)
+
+class ChargeSchema(ma.Schema):
+    class Meta:
+        fields = ('id', 'period', 'kind', 'booking_id', 'user_id', 'item_id', 'price', 'days', 'amount')
+
+charge_schema = ChargeSchema()
+charges_schema = ChargeSchema(many=True)
+
+class ChargeRun(db.Model):
+    period = db.Column(db.String(7), primary_key=True) # YYYY-MM
+    charges = db.Column(db.Integer, nullable=False)
+    total = db.Column(db.Integer, nullable=False)
+    seconds = db.Column(db.Float, nullable=False)
+    run_at = db.Column(db.DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return '<ChargeRun %r>' % self.period
+
+class Statistic(db.Model):
+    # running aggregates for the admin dashboard, kept by pghr.stats
+    name = db.Column(db.String(80), primary_key=True)
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<Statistic %r %r>' % (self.name, self.value)
+
+class Event(db.Model):
+    # append-only history of booking and ticket changes, written by pghr.events
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False) # room_booking, mess_booking, ticket
+    entity_id = db.Column(db.Integer, nullable=False)
+    action = db.Column(db.String(20), nullable=False) # snapshot, created, status, deleted
+    old_status = db.Column(db.String(80)) # before a status change
+    status = db.Column(db.String(80), nullable=False) # after the change; the last one for deleted
+    user_id = db.Column(db.Integer, nullable=False) # the booking's or ticket's resident
+    item_id = db.Column(db.Integer) # room or mess id of a booking
+    actor_id = db.Column(db.Integer) # user who made the change; empty for jobs, imports and the CLI
+    at = db.Column(db.DateTime, nullable=False) # UTC
+    __table_args__ = (
+        db.Index('ix_event_entity_at', 'entity', 'at'),
+        db.Index('ix_event_entity_entity_id', 'entity', 'entity_id'),
+    )
+
+    def __repr__(self):
+        return '<Event %r %r %r>' % (self.entity, self.entity_id, self.action)
@@ -0,0 +1,63 @@
+"""Resident notifications, sent from background jobs.
+
+Mail goes through the SMTP server at MAIL_SERVER. Without one (the default)
+messages are only written to the log, so development needs no mail setup.
+"""
+import logging
+import smtplib
+from email.message import EmailMessage
+from flask import current_app as app
+from .database import db
+from .jobs import job
+from .models import User, Announcements
+
+logger = logging.getLogger(__name__)
+
+BATCH = 500
+
+
+def send_emails(messages):
+    """Send (to, subject, body) tuples over one SMTP connection; returns how many were sent."""
+    messages = list(messages)
+    if not messages:
+        return 0
+    if not app.config['MAIL_SERVER']:
+        for to, subject, body in messages:
+            logger.info('mail to %s: %s', to, subject)
+        return len(messages)
+    with smtplib.SMTP(app.config['MAIL_SERVER'], app.config['MAIL_PORT'], timeout=30) as smtp:
+        for to, subject, body in messages:
+            message = EmailMessage()
+            message['From'] = app.config['MAIL_SENDER']
+            message['To'] = to
+            message['Subject'] = subject
+            message.set_content(body)
+            smtp.send_message(message)
+    return len(messages)
+
+
+@job('notify')
+def notify(user_ids, subject, body):
+    sent = 0
+    for start in range(0, len(user_ids), BATCH):
+        emails = db.session.query(User.email).filter(User.id.in_(user_ids[start:start + BATCH]))
+        sent += send_emails((email, subject, body) for email, in emails)
+    return {'sent': sent}
+
+
+@job('announce')
+def announce(announcement_id):
+    """Mail an announcement to every resident, a batch of users at a time."""
+    announcement = Announcements.query.get(announcement_id)
+    if announcement is None:
+        return {'sent': 0}
+    subject = 'Announcement: %s' % announcement.title
+    sent = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(User.id, User.email).filter(User.admin == False, User.id > last_id).order_by(User.id).limit(BATCH).all()  # noqa: E712
+        if not rows:
+            break
+        sent += send_emails((email, subject, announcement.description or '') for _, email in rows)
+        last_id = rows[-1][0]
+    return {'sent': sent}
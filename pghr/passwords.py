@@ -0,0 +1,85 @@
+"""Password hashing off the request thread.
+
+Hashing and checking passwords is deliberately slow, so a burst of logins
+can occupy every web worker. PasswordHasher runs that work in a small pool
+of its own (PASSWORD_HASH_WORKERS threads, or processes with
+PASSWORD_HASH_POOL = 'process'); pbkdf2 releases the GIL, so threads scale
+across cores too. At most PASSWORD_HASH_QUEUE jobs may wait for the pool;
+beyond that, or when a job has not finished within PASSWORD_HASH_TIMEOUT
+seconds, HasherBusy is raised so the view can answer 503 instead of piling
+up requests.
+
+New hashes use PASSWORD_HASH_METHOD. Hashes made with any other method (the
+plain 'sha256' used by old signups, or a lower iteration count) are reported
+by needs_rehash() and replaced on the user's next successful login.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher():
+    def __init__(self, method='pbkdf2:sha256:260000', workers=4, queue=32, timeout=5, pool='thread'):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self.pool = pool
+        # one slot per running or waiting job
+        self.slots = threading.BoundedSemaphore(workers + queue)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config['PASSWORD_HASH_METHOD'], config['PASSWORD_HASH_WORKERS'], config['PASSWORD_HASH_QUEUE'],
+                   config['PASSWORD_HASH_TIMEOUT'], config['PASSWORD_HASH_POOL'])
+
+    def _executor(self):
+        # created on first use so a pre-forking server starts its pool in each worker
+        with self.lock:
+            if self.executor is None:
+                if self.pool == 'process':
+                    self.executor = ProcessPoolExecutor(self.workers)
+                else:
+                    self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='password-hasher')
+            return self.executor
+
+    def _run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise HasherBusy('too many password checks in progress')
+        try:
+            future = self._executor().submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda future: self.slots.release())
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            future.cancel()
+            self.rejected += 1
+            raise HasherBusy('password check timed out')
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        return not pwhash.startswith(self.method + '$')
+
+    def stats(self):
+        return {'workers': self.workers, 'pool': self.pool, 'method': self.method, 'rejected': self.rejected}
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
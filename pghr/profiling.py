@@ -0,0 +1,179 @@
+"""Opt-in per-request profiling.
+
+When PROFILING is set in the config, init_profiling() hooks SQLAlchemy engine
+events and Flask request hooks to record, per endpoint, the number of SQL
+statements, time spent in the database, time spent rendering templates and
+the slowest statements seen. The totals are kept in process memory and read
+by the /admin/metrics pages in controllers.py.
+
+QUERY_BUDGETS maps endpoint names to the most statements a request to them
+may run. Going over budget logs a warning, or raises QueryBudgetExceeded
+when QUERY_BUDGET_ENFORCE is set (meant for test runs).
+"""
+import heapq
+import threading
+import time
+from flask import current_app as app, g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from .database import db
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class EndpointStats():
+    def __init__(self):
+        self.requests = 0
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.request_time = 0.0
+        self.max_queries = 0
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'queries': self.queries,
+            'max_queries': self.max_queries,
+            'db_seconds': self.db_time,
+            'template_seconds': self.template_time,
+            'request_seconds': self.request_time,
+        }
+
+
+class Profiler():
+    def __init__(self, slow_queries=10):
+        self.slow_queries = slow_queries
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            # min-heap of (seconds, endpoint, statement) keeping the slowest ones
+            self.slowest = []
+
+    def record(self, endpoint, state, elapsed):
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, EndpointStats())
+            stats.requests += 1
+            stats.queries += state['queries']
+            stats.max_queries = max(stats.max_queries, state['queries'])
+            stats.db_time += state['db_time']
+            stats.template_time += state['template_time']
+            stats.request_time += elapsed
+            for seconds, statement in state['statements']:
+                entry = (seconds, endpoint, statement)
+                if len(self.slowest) < self.slow_queries:
+                    heapq.heappush(self.slowest, entry)
+                elif entry > self.slowest[0]:
+                    heapq.heapreplace(self.slowest, entry)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'endpoints': {name: stats.to_dict() for name, stats in sorted(self.endpoints.items())},
+                'slowest_queries': [
+                    {'seconds': seconds, 'endpoint': endpoint, 'statement': statement}
+                    for seconds, endpoint, statement in sorted(self.slowest, reverse=True)
+                ],
+            }
+
+    def prometheus(self):
+        metrics = [
+            ('pghr_requests_total', 'counter', 'Requests served', 'requests'),
+            ('pghr_db_queries_total', 'counter', 'SQL statements executed', 'queries'),
+            ('pghr_db_queries_max', 'gauge', 'Most SQL statements run by one request', 'max_queries'),
+            ('pghr_db_seconds_total', 'counter', 'Time spent executing SQL', 'db_seconds'),
+            ('pghr_template_seconds_total', 'counter', 'Time spent rendering templates', 'template_seconds'),
+            ('pghr_request_seconds_total', 'counter', 'Time spent handling requests', 'request_seconds'),
+        ]
+        endpoints = self.snapshot()['endpoints']
+        lines = []
+        for name, kind, help_text, key in metrics:
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for endpoint, stats in endpoints.items():
+                lines.append('%s{endpoint="%s"} %s' % (name, endpoint, stats[key]))
+        return '\n'.join(lines) + '\n'
+
+
+profiler = None
+
+
+def current_state():
+    if has_request_context():
+        return g.get('profiling')
+    return None
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            state = current_state()
+            if state is not None:
+                state['template_time'] += time.perf_counter() - start
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    record_query(conn, statement)
+
+
+def handle_error(exception_context):
+    # a failed statement never reaches after_cursor_execute; its start time is popped here instead
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_start') and exception_context.statement is not None:
+        record_query(conn, exception_context.statement)
+
+
+def record_query(conn, statement):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    state = current_state()
+    if state is not None:
+        state['queries'] += 1
+        state['db_time'] += elapsed
+        state['statements'].append((elapsed, ' '.join(statement.split())))
+
+
+def start_request():
+    g.profiling = {'start': time.perf_counter(), 'queries': 0, 'db_time': 0.0, 'template_time': 0.0, 'statements': []}
+
+
+def finish_request(response):
+    state = g.pop('profiling', None)
+    if state is None:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    profiler.record(endpoint, state, time.perf_counter() - state['start'])
+    budget = app.config['QUERY_BUDGETS'].get(endpoint)
+    if budget is not None and state['queries'] > budget:
+        message = '%s ran %d queries, budget is %d' % (endpoint, state['queries'], budget)
+        if app.config['QUERY_BUDGET_ENFORCE']:
+            raise QueryBudgetExceeded(message)
+        app.logger.warning(message)
+    return response
+
+
+def init_profiling(app):
+    global profiler
+    if not app.config['PROFILING']:
+        return
+    profiler = Profiler(app.config['PROFILING_SLOW_QUERIES'])
+    app.jinja_env.template_class = TimedTemplate
+    with app.app_context():
+        # the primary and any replicas
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+            event.listen(engine, 'handle_error', handle_error)
+    app.before_request(start_request)
+    app.after_request(finish_request)
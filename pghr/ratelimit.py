@@ -0,0 +1,285 @@
+"""Rate limits for login, signup and other abusable form posts.
+
+Each limit is a token bucket: a client may make `count` requests in a burst
+and then one more every `period / count` seconds, e.g. '5/minute'. Limits
+are configured per group of routes in RATE_LIMITS and keyed by scope:
+
+    ip        the client's address (the RATE_LIMIT_PROXIES'th from the right
+              in X-Forwarded-For behind that many trusted proxies)
+    account   the logged-in user's id from the session cookie, or else the
+              username posted to the form together with the address, so
+              one address guessing a password is limited per account while
+              the account's owner, from another address, can still log in
+    username  the username posted to the form across every address, a
+              looser cap on guessing one account's password from many
+              addresses; set it high, since anyone can use it up to keep
+              the owner out until it refills
+
+    RATE_LIMITS = {'login': {'ip': '20/minute', 'account': '5/minute', 'username': '50/hour'}}
+
+A view opts in with @rate_limiter.limit('login'), placed right below
+@app.route and above @login_required. The check runs before the view and
+before Flask-Login loads the user, using only the request and the session
+cookie, so a rejected request costs no SQL and no password hashing. It is
+answered 429 with Retry-After. GET requests are let through unless the
+group lists them in `methods`.
+
+Buckets live in one of two backends, chosen by RATE_LIMIT_BACKEND:
+    'memory'  in-process (default); each worker limits on its own, so with
+              N workers a client gets up to N times the limit
+    'sqlite'  a SQLite file at RATE_LIMIT_SQLITE_PATH shared by every
+              worker on the host, one short transaction per check
+
+Both count the checks allowed and rejected per group and scope, and remember
+which keys were rejected most; /admin/ratelimits shows them.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import wraps
+from flask import Response, jsonify, request, session
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+SCOPES = ('ip', 'account', 'username')
+
+
+class LimitError(ValueError):
+    pass
+
+
+def parse_limit(text):
+    """(burst, tokens per second) of a limit written 'count/period'."""
+    count, _, period = text.partition('/')
+    if not count.strip().isdigit() or period.strip() not in PERIODS or int(count) < 1:
+        raise LimitError('a rate limit looks like 5/minute, not %r' % text)
+    return int(count), int(count) / PERIODS[period.strip()]
+
+
+def refill(tokens, updated, now, burst, rate):
+    """Take one token from a bucket last left with `tokens` at `updated`: (allowed, tokens left, seconds until the next one)."""
+    tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+    if tokens >= 1:
+        return True, tokens - 1, 0.0
+    return False, tokens, (1 - tokens) / rate
+
+
+class MemoryBackend():
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        # key: [tokens, updated, rejected]; least recently used first, which are the idle buckets
+        self.buckets = OrderedDict()
+        self.counters = Counter()
+
+    def take(self, counter, key, burst, rate):
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [float(burst), now, 0]
+                if len(self.buckets) > self.max_keys:
+                    # forgetting a bucket only refills it early
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            allowed, bucket[0], wait = refill(bucket[0], bucket[1], now, burst, rate)
+            bucket[1] = now
+            if not allowed:
+                bucket[2] += 1
+            self.counters[(counter, allowed)] += 1
+        return allowed, wait
+
+    def stats(self, top=10):
+        with self.lock:
+            rejected = sorted(((bucket[2], key) for key, bucket in self.buckets.items() if bucket[2]), reverse=True)[:top]
+            return {'keys': len(self.buckets), 'counters': dict(self.counters), 'top_rejected': [(key, count) for count, key in rejected]}
+
+    def clear(self):
+        with self.lock:
+            self.buckets.clear()
+            self.counters.clear()
+
+
+class SQLiteBackend():
+    # every this many checks, buckets that have refilled completely are deleted
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.checks = 0
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated REAL, full_at REAL, rejected INTEGER)')
+        connection.execute('CREATE INDEX IF NOT EXISTS ix_bucket_full_at ON bucket (full_at)')
+        connection.execute('CREATE TABLE IF NOT EXISTS counter (name TEXT, allowed INTEGER, count INTEGER, PRIMARY KEY (name, allowed))')
+        connection.close()
+
+    def connection(self):
+        # one connection per thread and process; a forked worker never uses its parent's
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self.local.connection.execute('PRAGMA synchronous=NORMAL')
+            self.local.pid = os.getpid()
+        return self.local.connection
+
+    def take(self, counter, key, burst, rate):
+        connection = self.connection()
+        now = time.time()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+        except sqlite3.OperationalError:
+            # still locked after `timeout`: let the request through rather than fail it
+            return True, 0.0
+        try:
+            row = connection.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+            allowed, tokens, wait = refill(*(row or (burst, now)), now, burst, rate)
+            connection.execute('INSERT INTO bucket VALUES (?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, '
+                               'updated = excluded.updated, full_at = excluded.full_at, rejected = rejected + excluded.rejected',
+                               (key, tokens, now, now + (burst - tokens) / rate, 0 if allowed else 1))
+            connection.execute('INSERT INTO counter VALUES (?, ?, 1) ON CONFLICT (name, allowed) DO UPDATE SET count = count + 1', (counter, allowed))
+            self.checks += 1
+            if self.checks % self.PURGE_EVERY == 0:
+                connection.execute('DELETE FROM bucket WHERE full_at < ?', (now,))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        return allowed, wait
+
+    def stats(self, top=10):
+        connection = self.connection()
+        return {
+            'keys': connection.execute('SELECT count(*) FROM bucket').fetchone()[0],
+            'counters': {(name, bool(allowed)): count for name, allowed, count in connection.execute('SELECT name, allowed, count FROM counter')},
+            'top_rejected': [tuple(row) for row in connection.execute('SELECT key, rejected FROM bucket WHERE rejected > 0 ORDER BY rejected DESC LIMIT ?', (top,))],
+        }
+
+    def clear(self):
+        connection = self.connection()
+        connection.execute('DELETE FROM bucket')
+        connection.execute('DELETE FROM counter')
+
+
+class RateLimiter():
+    def __init__(self, backend, limits, proxies=0, enabled=True):
+        self.backend = backend
+        self.proxies = proxies
+        self.enabled = enabled
+        # group: ({scope: (burst, rate)}, methods)
+        self.limits = {}
+        for group, spec in limits.items():
+            unknown = set(spec) - set(SCOPES) - {'methods'}
+            if unknown:
+                raise LimitError('unknown rate limit scope for %s: %s' % (group, ', '.join(sorted(unknown))))
+            self.limits[group] = ({scope: parse_limit(spec[scope]) for scope in SCOPES if scope in spec},
+                                  tuple(spec.get('methods', ('POST', 'PUT', 'PATCH', 'DELETE'))))
+
+    @classmethod
+    def from_config(cls, config):
+        if config['RATE_LIMIT_BACKEND'] == 'sqlite':
+            backend = SQLiteBackend(config['RATE_LIMIT_SQLITE_PATH'])
+        elif config['RATE_LIMIT_BACKEND'] == 'memory':
+            backend = MemoryBackend(config['RATE_LIMIT_MAX_KEYS'])
+        else:
+            raise RuntimeError("RATE_LIMIT_BACKEND must be 'memory' or 'sqlite'")
+        return cls(backend, config['RATE_LIMITS'], config['RATE_LIMIT_PROXIES'], config['RATE_LIMITING'])
+
+    def client_address(self):
+        if self.proxies:
+            route = request.access_route
+            return route[-self.proxies] if len(route) >= self.proxies else route[0]
+        return request.remote_addr or ''
+
+    def username(self):
+        return request.form.get('username', '').strip().lower() or None
+
+    def account(self):
+        # the session cookie rather than current_user, which would load the user
+        user_id = session.get('_user_id')
+        if user_id is not None:
+            return 'user:%s' % user_id
+        username = self.username()
+        # with the address, so nobody else can use up the owner's bucket
+        return 'name:%s@%s' % (username, self.client_address()) if username else None
+
+    def key(self, scope):
+        if scope == 'ip':
+            return self.client_address()
+        if scope == 'account':
+            return self.account()
+        username = self.username()
+        return 'name:%s' % username if username else None
+
+    def check(self, group):
+        """Seconds to wait before `group` may be requested again, or 0 when this request may go ahead."""
+        scopes, methods = self.limits.get(group, ({}, ()))
+        if request.method not in methods:
+            return 0
+        for scope, (burst, rate) in scopes.items():
+            key = self.key(scope)
+            if key is None:
+                continue
+            allowed, wait = self.backend.take('%s:%s' % (group, scope), '%s:%s:%s' % (group, scope, key), burst, rate)
+            if not allowed:
+                # the address is checked first, so a flood is turned away before the form is parsed
+                return wait
+        return 0
+
+    def limit(self, group):
+        """Decorate a view so requests over `group`'s limits get 429. Place right below @app.route."""
+        if group not in self.limits:
+            raise LimitError('no RATE_LIMITS entry for %r' % group)
+
+        def decorator(view):
+            if not self.enabled:
+                return view
+
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                return self.call(group, view, *args, **kwargs)
+            return wrapper
+        return decorator
+
+    def call(self, group, view, *args, **kwargs):
+        """Run `view`, or answer 429 when this request is over `group`'s limits."""
+        wait = self.check(group) if self.enabled else 0
+        if wait:
+            return too_many_requests(wait)
+        return view(*args, **kwargs)
+
+    def stats(self):
+        backend = self.backend.stats()
+        counters = {}
+        for (name, allowed), count in backend['counters'].items():
+            counters.setdefault(name, {'allowed': 0, 'rejected': 0})['allowed' if allowed else 'rejected'] += count
+        return {
+            'enabled': self.enabled,
+            'backend': type(self.backend).__name__,
+            'limits': {group: {scope: '%d per %.0fs' % (burst, burst / rate) for scope, (burst, rate) in scopes.items()}
+                       for group, (scopes, methods) in self.limits.items()},
+            'keys': backend['keys'],
+            'checks': counters,
+            'top_rejected': [{'key': key, 'rejected': count} for key, count in backend['top_rejected']],
+        }
+
+    def prometheus(self):
+        stats = self.stats()
+        lines = ['# TYPE pghr_rate_limit_checks_total counter']
+        for name, counts in sorted(stats['checks'].items()):
+            group, scope = name.split(':', 1)
+            for outcome, count in sorted(counts.items()):
+                lines.append('pghr_rate_limit_checks_total{group="%s",scope="%s",outcome="%s"} %d' % (group, scope, outcome, count))
+        lines += ['# TYPE pghr_rate_limit_keys gauge', 'pghr_rate_limit_keys %d' % stats['keys']]
+        return '\n'.join(lines) + '\n'
+
+
+def too_many_requests(wait):
+    headers = {'Retry-After': str(max(1, math.ceil(wait)))}
+    if request.is_json:
+        return jsonify({'error': 'too many requests'}), 429, headers
+    return Response('<h1>Too many requests, please try again in a moment</h1>', 429, headers)
@@ -0,0 +1,99 @@
+"""Read replicas.
+
+SQLALCHEMY_REPLICA_URIS lists databases that replicate the primary
+(PostgreSQL streaming replicas, or copies of a SQLite file for trying it
+locally). create_app() adds them as the binds 'replica1', 'replica2', ...
+
+db.session is a RoutingSession, one per request as before (Flask-SQLAlchemy
+scopes it to the app context and removes it at teardown). It reads from the
+primary unless the view is marked @read_only and the request is a GET or
+HEAD. Then each SELECT goes to one replica, picked at random for the whole
+request, until the request writes: a flush or an INSERT, UPDATE, DELETE,
+SELECT ... FOR UPDATE or raw SQL statement sends everything after it to the
+primary.
+
+A replica lags the primary, so a user who has just committed a change
+would not see it on the next page. Every commit made while serving a
+request puts the end of a REPLICA_STICKY_SECONDS window in the user's
+session cookie (whether or not it wrote: Core writes on
+session.connection() never pass through get_bind); that user's reads stay
+on the primary until it passes, while everyone else's keep going to the
+replicas.
+
+Caches filled from a lagging replica would keep the stale rows under a
+fresh version, so code that fills one reads inside primary_reads().
+"""
+import random
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, has_request_context, request, session as cookie
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+PRIMARY = 'primary'
+REPLICA = 'replica'
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing:
+            reads = clause is None or (clause.is_select and getattr(clause, '_for_update_arg', None) is None)
+            if not reads:
+                self.info['wrote'] = True
+            elif self.info.get('reads') == REPLICA and not self.info.get('wrote'):
+                return self.replica()
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def replica(self):
+        keys = replica_keys(current_app)
+        if 'replica' not in self.info:
+            self.info['replica'] = random.choice(keys)
+        return self._db.engines[self.info['replica']]
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def flushed(session, flush_context):
+    session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def committed(session):
+    if has_request_context() and replica_keys(current_app):
+        cookie['_primary_until'] = time.time() + current_app.config['REPLICA_STICKY_SECONDS']
+
+
+def replica_keys(app):
+    return ['replica%d' % number for number in range(1, len(app.config['SQLALCHEMY_REPLICA_URIS']) + 1)]
+
+
+def replica_binds(app):
+    """SQLALCHEMY_BINDS entries for the configured replicas."""
+    return dict(zip(replica_keys(app), app.config['SQLALCHEMY_REPLICA_URIS']))
+
+
+def sticky():
+    """Whether this user committed a write recently enough to read their own writes."""
+    return cookie.get('_primary_until', 0) > time.time()
+
+
+def read_only(view):
+    """Let a view's GET requests read from a replica. Place right below @app.route."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method in ('GET', 'HEAD') and replica_keys(current_app) and not sticky():
+            current_app.extensions['sqlalchemy'].session.info['reads'] = REPLICA
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@contextmanager
+def primary_reads(session=None):
+    """Read from the primary inside the block, whatever the request allows."""
+    session = session or current_app.extensions['sqlalchemy'].session
+    previous = session.info.get('reads')
+    session.info['reads'] = PRIMARY
+    try:
+        yield
+    finally:
+        session.info['reads'] = previous
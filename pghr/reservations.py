@@ -0,0 +1,199 @@
+"""Date-ranged room reservations.
+
+A room booking reserves one bed for the days [starts_on, ends_on); ends_on
+may be empty for an open-ended stay. Bookings without dates start the day
+they are made and stay open-ended, which is what every booking used to mean.
+
+A room has `size` beds, so a stay fits when fewer than `size` pending or
+approved bookings overlap any of its days. StayTree answers that question
+for one room: it is a segment tree over day numbers where each booking adds
+one to its range of days, so "most beds taken on any day in [a, b)" and
+adding or removing a booking each cost O(log days), however many bookings
+the room has.
+
+pghr.bookings.claim_bed checks every new stay against the bookings in the
+database, inside the transaction that holds the room's row lock, so
+concurrent requests can never overfill a room. The in-process ReservationBook
+keeps a StayTree per room for searches ("is room X free for [a, b)", "which
+rooms are free"). It is refreshed the same way as the availability index.
+"""
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime
+from sqlalchemy import or_
+from .database import db
+from .replicas import primary_reads
+from .models import RoomBookings
+
+HOLDING_STATUSES = ('pending', 'approved')
+
+EPOCH = date(1970, 1, 1)
+# day numbers 0 .. 2**17 - 1 cover 1970 to 2328; open-ended stays run to the end
+DAYS = 1 << 17
+
+
+class ReservationError(Exception):
+    pass
+
+
+def day_number(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        value = value.date()
+    return min(max((value - EPOCH).days, 0), DAYS)
+
+
+def parse_day(value, name):
+    """A date from a YYYY-MM-DD form or query value; None when empty."""
+    value = (value or '').strip()
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ReservationError('%s must be a date as YYYY-MM-DD' % name)
+
+
+def check_stay(starts_on, ends_on, today=None):
+    """Validate a requested stay and fill in the defaults: (starts_on, ends_on)."""
+    today = today or date.today()
+    starts_on = starts_on or today
+    if starts_on < today:
+        raise ReservationError('A stay cannot start in the past.')
+    if ends_on is not None and ends_on <= starts_on:
+        raise ReservationError('A stay must end after it starts.')
+    return starts_on, ends_on
+
+
+def stay_days(starts_on, ends_on):
+    """[start, end) day numbers of a stay; an unknown start counts from the beginning."""
+    start = day_number(starts_on) or 0
+    end = day_number(ends_on)
+    return start, DAYS if end is None else end
+
+
+class StayTree():
+    """Beds taken per day in one room, as a lazy segment tree over day numbers.
+
+    Node 0 is the root; children are created on first use, and a missing child
+    stands for a range with nothing booked. `top` is the most beds taken on
+    any day under a node, `add` the bookings covering the node's whole range.
+    """
+    __slots__ = ('top', 'add', 'left', 'right')
+
+    def __init__(self):
+        self.top, self.add, self.left, self.right = [0], [0], [0], [0]
+
+    def __bool__(self):
+        return self.top[0] > 0
+
+    def child(self, node, side):
+        children = self.left if side == 0 else self.right
+        if not children[node]:
+            children[node] = len(self.top)
+            for column in (self.top, self.add, self.left, self.right):
+                column.append(0)
+        return children[node]
+
+    def update(self, start, end, delta, node=0, low=0, high=DAYS):
+        if start <= low and high <= end:
+            self.add[node] += delta
+            self.top[node] += delta
+            return
+        middle = (low + high) // 2
+        if start < middle:
+            self.update(start, end, delta, self.child(node, 0), low, middle)
+        if end > middle:
+            self.update(start, end, delta, self.child(node, 1), middle, high)
+        left, right = self.left[node], self.right[node]
+        self.top[node] = self.add[node] + max(self.top[left] if left else 0, self.top[right] if right else 0)
+
+    def peak(self, start, end, node=0, low=0, high=DAYS):
+        """Most beds taken on any day in [start, end)."""
+        if start <= low and high <= end:
+            return self.top[node]
+        middle = (low + high) // 2
+        best = 0
+        if start < middle and self.left[node]:
+            best = self.peak(start, end, self.left[node], low, middle)
+        if end > middle and self.right[node]:
+            best = max(best, self.peak(start, end, self.right[node], middle, high))
+        return self.add[node] + best
+
+
+def holding_bookings(room_ids=None):
+    query = db.session.query(RoomBookings.room_id, RoomBookings.starts_on, RoomBookings.ends_on) \
+        .filter(RoomBookings.status.in_(HOLDING_STATUSES))
+    if room_ids is not None:
+        query = query.filter(RoomBookings.room_id.in_(room_ids))
+    return query
+
+
+def beds_taken(room_id, starts_on, ends_on):
+    """Most beds booked in the room on any day of [starts_on, ends_on), read from the database."""
+    start, end = stay_days(starts_on, ends_on)
+    if start >= end:
+        return 0
+    tree = StayTree()
+    overlapping = holding_bookings([room_id]).filter(
+        or_(RoomBookings.starts_on == None, RoomBookings.starts_on < (ends_on or date.max)),  # noqa: E711
+        or_(RoomBookings.ends_on == None, RoomBookings.ends_on > starts_on))  # noqa: E711
+    for _, booking_starts_on, booking_ends_on in overlapping:
+        tree.update(*stay_days(booking_starts_on, booking_ends_on), 1)
+    return tree.peak(start, end)
+
+
+class ReservationBook():
+    """A StayTree for every room with pending or approved bookings."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.trees = {}
+        self.stale = set()
+        self.loaded_at = None
+
+    def mark_stale(self, ids):
+        with self.lock:
+            self.stale.update(ids)
+
+    def expire(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def refresh(self, max_age):
+        """Reload the bookings of stale rooms, or of every room once older than `max_age` seconds."""
+        with self.lock:
+            full = self.loaded_at is None or time.monotonic() - self.loaded_at > max_age
+            ids, self.stale = self.stale, set()
+        if not full and not ids:
+            return
+        started = time.monotonic()
+        # bookings with the same dates in a room go into its tree as one update
+        with primary_reads():
+            stays = Counter((room_id, starts_on, ends_on) for room_id, starts_on, ends_on in holding_bookings(None if full else ids))
+        trees = {}
+        for (room_id, starts_on, ends_on), count in stays.items():
+            tree = trees.get(room_id)
+            if tree is None:
+                tree = trees[room_id] = StayTree()
+            tree.update(*stay_days(starts_on, ends_on), count)
+        with self.lock:
+            if full:
+                self.trees, self.loaded_at = trees, started
+                return
+            for id in ids:
+                self.trees.pop(id, None)
+            self.trees.update(trees)
+
+    def taken(self, room_id, start, end):
+        """Most beds booked on any day of [start, end), as day numbers."""
+        tree = self.trees.get(room_id)
+        return tree.peak(start, end) if tree and start < end else 0
+
+    def is_free(self, room_id, size, starts_on, ends_on=None):
+        """True when the room has a bed free on every day of [starts_on, ends_on)."""
+        return self.taken(room_id, *stay_days(starts_on, ends_on)) < size
+
+
+book = ReservationBook()
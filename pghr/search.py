@@ -0,0 +1,659 @@
+"""Full-text search over tickets, ticket replies and announcements.
+
+Every document has a key that encodes its kind in the high bits and its id in
+the low ones (KINDS), so the documents of one kind form a contiguous key range
+and newer documents have larger keys. A query matches documents containing
+every word, or for a word ending in `*`, any word with that prefix. Words are
+split and folded the same way by both backends: runs of letters and digits,
+lower-cased, accents removed.
+
+On SQLite builds with FTS5 the index is the search_index virtual table
+(created by migration 9), written by mapper events inside the transaction
+that changes the document, so it can never disagree with a committed row.
+Elsewhere (PostgreSQL, SQLite without FTS5, or SEARCH_BACKEND = 'memory') an
+in-process inverted index takes its place: it is built on the first search,
+follows this process's commits, picks up rows other processes insert on every
+search, and reloads in full every SEARCH_MAX_AGE seconds to catch their edits
+and deletions.
+
+Ranking every match of a common word is what makes full-text search slow
+on large tables, so matches are ranked a window at a time: each kind
+contributes its SEARCH_CANDIDATES newest matches, found by walking the
+posting lists newest first, and those are ranked best first. The pages
+after them continue with the next older window, which starts below the
+lowest key of the one before, so every match can be reached while a page
+never ranks more than one window. Both backends rank with the same BM25 (bm25(), title words
+count double); for FTS5 the scores are computed here from the candidates'
+text and cached per-term document counts rather than with FTS5's bm25(),
+which reads every posting of every term. The page's rows are then read from
+their own tables and highlighted here, so deleted rows drop out and the
+markup is escaped the same way for both backends.
+"""
+import math
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from markupsafe import Markup, escape
+from sqlalchemy import column, event, inspect, select, table
+from sqlalchemy.orm import Session
+from .database import db
+from .replicas import primary_reads
+from .models import Ticket, TicketReplies, Announcements
+
+SHIFT = 40
+# kind -> key prefix; the prefix is part of every stored key, so never renumber
+KINDS = {'ticket': 1, 'reply': 2, 'announcement': 3}
+CODES = {code: kind for kind, code in KINDS.items()}
+
+TITLE_WEIGHT = 2.0
+MAX_TERMS = 8
+SNIPPET_WORDS = 24
+
+WORD = re.compile(r'[^\W_]+')
+QUERY_WORD = re.compile(r'([^\W_]+)(\*?)')
+
+# prefix indexes make 2 and 3 letter prefixes as cheap as a whole word
+# owner holds u<user id> of a ticket's or reply's resident, so their own documents are found by intersecting posting lists
+FTS_TABLE = "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(title, body, owner, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+search_index = table('search_index', column('rowid'), column('title'), column('body'), column('owner'))
+# documents per word, for ranking
+FTS_TERMS = "CREATE VIRTUAL TABLE IF NOT EXISTS search_terms USING fts5vocab(search_index, 'row')"
+
+
+class QueryError(Exception):
+    pass
+
+
+def key(kind, id):
+    return KINDS[kind] << SHIFT | id
+
+
+def split_key(key):
+    return CODES[key >> SHIFT], key & ((1 << SHIFT) - 1)
+
+
+def key_range(kind):
+    return KINDS[kind] << SHIFT, (KINDS[kind] + 1 << SHIFT) - 1
+
+
+def fold(text):
+    text = text.lower()
+    if not text.isascii():
+        text = ''.join(char for char in unicodedata.normalize('NFKD', text) if not unicodedata.combining(char))
+    return text
+
+
+def words(text):
+    return WORD.findall(fold(text)) if text else []
+
+
+def parse_query(text):
+    """[(word, prefix)] for the words of a query; `word*` matches by prefix."""
+    terms = []
+    for word, star in QUERY_WORD.findall(text or ''):
+        word = fold(word)
+        # one letter prefixes would expand to most of the vocabulary
+        term = (word, bool(star) and len(word) > 1)
+        if term not in terms:
+            terms.append(term)
+    if not terms:
+        raise QueryError('Enter a word to search for.')
+    if len(terms) > MAX_TERMS:
+        raise QueryError('Search for at most %d words.' % MAX_TERMS)
+    return terms
+
+
+def fts_query(terms, owner=None):
+    # words are letters and digits only, so quoting them is enough
+    query = '{title body} : (%s)' % ' '.join('"%s"%s' % (word, '*' if prefix else '') for word, prefix in terms)
+    return query if owner is None else '%s AND owner : "u%d"' % (query, owner)
+
+
+# documents: (title, body, owner) of each kind, and where to read them from
+
+MODELS = {'ticket': Ticket, 'reply': TicketReplies, 'announcement': Announcements}
+
+
+def document_query(kind):
+    """SELECT of (id, title, body, owner) for every document of `kind`."""
+    if kind == 'ticket':
+        return select(Ticket.id, Ticket.title, Ticket.description, Ticket.user_id)
+    if kind == 'reply':
+        return select(TicketReplies.id, db.literal(''), TicketReplies.description, Ticket.user_id) \
+            .join_from(TicketReplies, Ticket, TicketReplies.ticket_id == Ticket.id)
+    return select(Announcements.id, Announcements.title, Announcements.description, db.null())
+
+
+def documents(connection, kind, after=None, id=None, ids=None):
+    """(key, title, body, owner) of every document of `kind`, of those with a larger id than `after`, or of one or `ids`."""
+    query = document_query(kind)
+    if after is not None:
+        query = query.where(MODELS[kind].id > after)
+    if id is not None:
+        query = query.where(MODELS[kind].id == id)
+    if ids is not None:
+        query = query.where(MODELS[kind].id.in_(ids))
+    for id, title, body, owner in connection.execute(query):
+        yield key(kind, id), title or '', body or '', owner
+
+
+def owner_token(owner):
+    return '' if owner is None else 'u%d' % owner
+
+
+# ranking
+
+K1, B = 1.2, 0.75
+
+
+def bm25(frequency, length, documents, matching, average):
+    """One term's BM25 score in one document: `matching` of `documents` contain the term."""
+    idf = max(math.log((max(documents - matching, 0) + 0.5) / (matching + 0.5)), 1e-6)
+    return idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average))
+
+
+def frequencies(terms, title, body):
+    """([weighted count of each term], length in words) of one document."""
+    title_words, body_words = words(title), words(body)
+    counts = []
+    for term, prefix in terms:
+        if prefix:
+            counts.append(TITLE_WEIGHT * sum(1 for word in title_words if word.startswith(term))
+                          + sum(1 for word in body_words if word.startswith(term)))
+        else:
+            counts.append(TITLE_WEIGHT * title_words.count(term) + body_words.count(term))
+    return counts, len(title_words) + len(body_words)
+
+
+# FTS5 backend
+
+fts_tables = {}  # database url -> whether search_index exists
+
+
+def fts_available(connection):
+    if connection.dialect.name != 'sqlite':
+        return False
+    return connection.execute(db.text("SELECT 1 FROM pragma_module_list WHERE name = 'fts5'")).first() is not None
+
+
+def has_fts(connection):
+    url = str(connection.engine.url)
+    if url not in fts_tables:
+        fts_tables[url] = connection.dialect.name == 'sqlite' and inspect(connection).has_table('search_index')
+    return fts_tables[url]
+
+
+def build_fts(connection):
+    """Create search_index if needed and fill it from the document tables."""
+    connection.execute(db.text(FTS_TABLE))
+    connection.execute(db.text(FTS_TERMS))
+    connection.execute(search_index.delete())
+    for kind, model in MODELS.items():
+        id, title, body, owner = document_query(kind).subquery().c
+        rows = select((KINDS[kind] << SHIFT) + id, db.func.coalesce(title, ''), db.func.coalesce(body, ''),
+                      db.func.coalesce('u' + db.cast(owner, db.String), ''))
+        connection.execute(search_index.insert().from_select(['rowid', 'title', 'body', 'owner'], rows))
+    connection.execute(db.text("INSERT INTO search_index (search_index) VALUES ('optimize')"))
+    fts_tables.pop(str(connection.engine.url), None)
+    term_counts.clear()
+
+
+def fts_write(connection, removed, added):
+    if removed:
+        connection.execute(search_index.delete().where(search_index.c.rowid == db.bindparam('key')), [{'key': key} for key in removed])
+    if added:
+        connection.execute(search_index.insert(), [{'rowid': key, 'title': title, 'body': body, 'owner': owner_token(owner)}
+                                                   for key, title, body, owner in added])
+
+
+def fts_candidates(connection, terms, kind, owner, limit, before=None):
+    """[(key, title, body)] of the `limit` newest documents of `kind` matching `terms`, only `owner`'s when given.
+
+    `before` continues from a previous window: only keys below it are found.
+    """
+    low, high = key_range(kind)
+    if before is not None:
+        high = min(high, before - 1)
+    # driver SQL: this runs once per kind on every search and returns hundreds of rows
+    return connection.exec_driver_sql(
+        'SELECT rowid, title, body FROM search_index WHERE search_index MATCH ? AND rowid BETWEEN ? AND ? ORDER BY rowid DESC LIMIT ?',
+        (fts_query(terms, owner), low, high, limit)).fetchall()
+
+
+class TermCounts():
+    """How many documents contain a term, and how many there are, cached for a while.
+
+    FTS5's own bm25() counts a term's documents by reading its whole posting
+    list on every query, which for a word in most documents costs far more
+    than finding the matches. The counts only steer the ranking and change
+    slowly, so they are read from the search_terms table and kept here.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}  # (word, prefix) or None for all documents -> (count, fetched at)
+
+    def clear(self):
+        with self.lock:
+            self.counts = {}
+
+    def get(self, connection, term, max_age):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.counts.get(term)
+        if cached is not None and now - cached[1] <= max_age:
+            return cached[0]
+        if term is None:
+            count = sum(connection.execute(select(db.func.count()).select_from(model)).scalar() for model in MODELS.values())
+        else:
+            word, prefix = term
+            if prefix:
+                following = word[:-1] + chr(ord(word[-1]) + 1)
+                count = connection.exec_driver_sql('SELECT sum(doc) FROM search_terms WHERE term >= ? AND term < ?', (word, following)).scalar()
+            else:
+                count = connection.exec_driver_sql('SELECT doc FROM search_terms WHERE term = ?', (word,)).scalar()
+        with self.lock:
+            if len(self.counts) > 10000:
+                self.counts = {}
+            self.counts[term] = (count or 0, now)
+        return count or 0
+
+
+term_counts = TermCounts()
+
+
+def fts_scored(connection, terms, rows, max_age):
+    """[(key, score)] for candidate rows from fts_candidates()."""
+    documents = term_counts.get(connection, None, max_age)
+    matching = [term_counts.get(connection, term, max_age) for term in terms]
+    counted = [(key,) + frequencies(terms, title, body) for key, title, body in rows]
+    # the candidates' mean length stands in for the whole index's
+    average = sum(length for key, counts, length in counted) / len(counted) if counted else 1.0
+    return [(key, sum(bm25(frequency, length, documents, count, average or 1.0) for frequency, count in zip(counts, matching)))
+            for key, counts, length in counted]
+
+
+# in-process backend
+
+class MemoryIndex():
+    """An inverted index with a posting list per kind and word: (code, word) -> {key: weighted count}.
+
+    Postings are kept in key order, newest last, so a search walks the
+    shortest one backwards and stops after `limit` matches.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.postings = {}
+        self.unsorted = set()   # postings that got a key out of order
+        self.counts = {}        # word -> documents containing it
+        self.lengths = {}
+        self.terms = {}         # key -> its words, to remove it again
+        self.owners = {}        # key -> owner, and owner -> keys
+        self.owned = {}
+        self.total = 0          # sum of lengths
+        self.vocabulary = None  # sorted words for prefix lookups, rebuilt when words are added
+        self.last_ids = {}      # kind -> largest id loaded
+        self.loaded_at = None
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def expire(self):
+        with self.lock:
+            self.loaded_at = None
+
+    def put(self, key, title, body, owner=None):
+        self.remove(key)
+        code = key >> SHIFT
+        counts = {}
+        title_words, body_words = words(title), words(body)
+        for word in title_words:
+            counts[word] = counts.get(word, 0) + TITLE_WEIGHT
+        for word in body_words:
+            counts[word] = counts.get(word, 0) + 1
+        for word, count in counts.items():
+            posting = self.postings.get((code, word))
+            if posting is None:
+                posting = self.postings[code, word] = {}
+            elif key < next(reversed(posting)):
+                self.unsorted.add((code, word))
+            posting[key] = count
+            if word not in self.counts:
+                self.counts[word] = 0
+                self.vocabulary = None
+            self.counts[word] += 1
+        self.terms[key] = tuple(counts)
+        self.lengths[key] = length = len(title_words) + len(body_words)
+        self.total += length
+        if owner is not None:
+            self.owners[key] = owner
+            self.owned.setdefault(owner, set()).add(key)
+
+    def remove(self, key):
+        terms = self.terms.pop(key, None)
+        if terms is None:
+            return
+        code = key >> SHIFT
+        for word in terms:
+            posting = self.postings[code, word]
+            del posting[key]
+            if not posting:
+                del self.postings[code, word]
+            self.counts[word] -= 1
+            if not self.counts[word]:
+                del self.counts[word]
+                self.vocabulary = None
+        self.total -= self.lengths.pop(key)
+        owner = self.owners.pop(key, None)
+        if owner is not None:
+            self.owned[owner].discard(key)
+
+    def apply(self, changes):
+        """Replay [(key, document or None when deleted)] in order."""
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            for key, document in changes:
+                self.remove(key)
+                if document is not None:
+                    self.put(*document)
+
+    def refresh(self, max_age):
+        """Load new rows, or everything once the index is older than `max_age` seconds."""
+        with self.lock:
+            full = self.loaded_at is None or time.monotonic() - self.loaded_at > max_age
+            if full:
+                self.clear()
+                self.loaded_at = time.monotonic()
+            with primary_reads():
+                connection = db.session.connection()
+                for kind, model in MODELS.items():
+                    after = self.last_ids.get(kind, 0)
+                    for document in documents(connection, kind, after):
+                        self.put(*document)
+                        after = max(after, split_key(document[0])[1])
+                    self.last_ids[kind] = after
+
+    def expand(self, word, prefix):
+        if not prefix:
+            return [word] if word in self.counts else []
+        if self.vocabulary is None:
+            self.vocabulary = sorted(self.counts)
+        found = []
+        index = bisect_left(self.vocabulary, word)
+        while index < len(self.vocabulary) and self.vocabulary[index].startswith(word):
+            found.append(self.vocabulary[index])
+            index += 1
+        return found
+
+    def posting(self, code, expansions):
+        """{key: weighted count} in key order of the documents of one kind containing any of `expansions`."""
+        if len(expansions) == 1:
+            word = expansions[0]
+            if (code, word) in self.unsorted:
+                self.unsorted.discard((code, word))
+                self.postings[code, word] = dict(sorted(self.postings[code, word].items()))
+            return self.postings.get((code, word), {})
+        merged = {}
+        for word in expansions:
+            for key, count in self.postings.get((code, word), {}).items():
+                merged[key] = merged.get(key, 0) + count
+        return dict(sorted(merged.items()))
+
+    def candidates(self, terms, kind, owner, limit, before=None):
+        """[(key, score)] of the `limit` newest documents of `kind` matching `terms`, only `owner`'s when given.
+
+        `before` continues from a previous window: only keys below it are found.
+        """
+        code = KINDS[kind]
+        low, high = key_range(kind)
+        if before is not None:
+            high = min(high, before - 1)
+        with self.lock:
+            expanded = [self.expand(word, prefix) for word, prefix in terms]
+            postings = [self.posting(code, expansions) for expansions in expanded]
+            matching = [sum(self.counts[word] for word in expansions) for expansions in expanded]
+            if owner is not None:
+                keys = sorted((key for key in self.owned.get(owner, ()) if low <= key <= high), reverse=True)
+            else:
+                keys = reversed(min(postings, key=len))
+            found = []
+            for key in keys:
+                if key > high:
+                    continue
+                if all(key in posting for posting in postings):
+                    found.append(key)
+                    if len(found) == limit:
+                        break
+            documents = len(self.lengths)
+            average = self.total / documents if documents else 1.0
+            return [(key, sum(bm25(posting[key], self.lengths[key], documents, count, average) for posting, count in zip(postings, matching)))
+                    for key in found]
+
+
+memory = MemoryIndex()
+
+
+def use_fts(connection):
+    return current_app.config['SEARCH_BACKEND'] != 'memory' and has_fts(connection)
+
+
+# keeping the index current
+
+def changed(connection, target, kind, removed=False):
+    """Write the document to search_index now and to the in-process index after the commit."""
+    id = key(kind, target.id)
+    added = []
+    if not removed:
+        # read back as the index would load it, which also finds a reply's owner
+        added = list(documents(connection, kind, id=target.id))
+    Session.object_session(target).info.setdefault('search_changes', []).append((id, added[0] if added else None))
+    if has_fts(connection):
+        fts_write(connection, [id], added)
+
+
+def documents_added(kind, ids):
+    """Index documents inserted without the ORM, in the current transaction like changed()."""
+    connection = db.session.connection()
+    added = list(documents(connection, kind, ids=ids))
+    db.session.info.setdefault('search_changes', []).extend((document[0], document) for document in added)
+    if has_fts(connection):
+        fts_write(connection, [], added)
+
+
+def watch(model, kind, fields):
+    def inserted(mapper, connection, target):
+        changed(connection, target, kind)
+
+    def updated(mapper, connection, target):
+        state = inspect(target)
+        if any(state.attrs[name].history.has_changes() for name in fields):
+            changed(connection, target, kind)
+
+    def deleted(mapper, connection, target):
+        changed(connection, target, kind, removed=True)
+
+    event.listen(model, 'after_insert', inserted)
+    event.listen(model, 'after_update', updated)
+    event.listen(model, 'after_delete', deleted)
+
+
+watch(Ticket, 'ticket', ('title', 'description', 'user_id'))
+watch(TicketReplies, 'reply', ('description', 'ticket_id'))
+watch(Announcements, 'announcement', ('title', 'description'))
+
+
+@event.listens_for(Session, 'after_commit')
+def index_after_commit(session):
+    changes = session.info.pop('search_changes', None)
+    if changes:
+        memory.apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_after_rollback(session):
+    session.info.pop('search_changes', None)
+
+
+# searching
+
+def matches(word, terms):
+    word = fold(word)
+    return any(word.startswith(term) if prefix else word == term for term, prefix in terms)
+
+
+def term_pattern(terms):
+    """A regex finding the words of ASCII text that match `terms`."""
+    return re.compile(r'(?<![^\W_])(?:%s)(?![^\W_])' % '|'.join(
+        re.escape(term) + (r'[^\W_]*' if prefix else '') for term, prefix in terms), re.IGNORECASE)
+
+
+def highlight(text, terms):
+    """`text` as HTML with the words matching `terms` in <mark>."""
+    return Markup(''.join(highlighted(text or '', terms, 0, len(text or ''))))
+
+
+def highlighted(text, terms, start, end):
+    if text.isascii():
+        found = term_pattern(terms).finditer(text, start, end)
+    else:
+        # folding can change the length of accented text, so compare word by word
+        found = (match for match in WORD.finditer(text, start, end) if matches(match.group(), terms))
+    parts, position = [], start
+    for match in found:
+        parts.append(escape(text[position:match.start()]))
+        parts.append('<mark>%s</mark>' % escape(match.group()))
+        position = match.end()
+    parts.append(escape(text[position:end]))
+    return parts
+
+
+def snippet(text, terms, size=SNIPPET_WORDS):
+    """About `size` words of `text` around its first match, highlighted."""
+    text = text or ''
+    spans = [match.span() for match in WORD.finditer(text)]
+    if len(spans) <= size:
+        return highlight(text, terms)
+    first = 0
+    for number, (start, end) in enumerate(spans):
+        if matches(text[start:end], terms):
+            first = number
+            break
+    first = max(0, min(first - size // 4, len(spans) - size))
+    start = spans[first][0] if first else 0
+    end = spans[first + size][0] if first + size < len(spans) else len(text)
+    parts = highlighted(text, terms, start, end)
+    return Markup(('&hellip; ' if start else '') + ''.join(parts).rstrip() + (' &hellip;' if end < len(text) else ''))
+
+
+def load_rows(kind, ids):
+    """{id: (title, body, created_at, ticket_id)} for the page's documents of one kind."""
+    if kind == 'ticket':
+        query = db.session.query(Ticket.id, Ticket.title, Ticket.description, Ticket.created_at, Ticket.id).filter(Ticket.id.in_(ids))
+    elif kind == 'reply':
+        query = db.session.query(TicketReplies.id, Ticket.title, TicketReplies.description, TicketReplies.created_at, TicketReplies.ticket_id) \
+            .join(Ticket, TicketReplies.ticket_id == Ticket.id).filter(TicketReplies.id.in_(ids))
+    else:
+        query = db.session.query(Announcements.id, Announcements.title, Announcements.description, Announcements.created_at, db.literal(None)) \
+            .filter(Announcements.id.in_(ids))
+    return {row[0]: row[1:] for row in query}
+
+
+def search(text, kinds=None, user_id=None, page=1, per_page=None):
+    """One page of documents matching every word of `text`, and whether another page follows.
+
+    Results are best first within each window of SEARCH_CANDIDATES newest
+    matches per kind; later pages go on to older windows until every match
+    has been listed.
+
+    Each result is a dict with kind, id, ticket_id (of a ticket or reply),
+    created_at, score, and title and snippet as HTML with the matches
+    marked. `user_id` limits tickets and replies to that resident's own;
+    admins pass None.
+    """
+    terms = parse_query(text)
+    kinds = kinds or list(KINDS)
+    unknown = [kind for kind in kinds if kind not in KINDS]
+    if unknown:
+        raise QueryError('Unknown kind: %s' % ', '.join(unknown))
+    if page < 1:
+        raise QueryError('page must be at least 1')
+    per_page = per_page or current_app.config['SEARCH_RESULTS_PER_PAGE']
+    limit = current_app.config['SEARCH_CANDIDATES']
+
+    connection = db.session.connection()
+    fts = use_fts(connection)
+    if not fts:
+        memory.refresh(current_app.config['SEARCH_MAX_AGE'])
+    # skip whole windows of candidates up to the one holding this page, then rank
+    # that window and as many after it as the page needs
+    offset = (page - 1) * per_page
+    before = dict.fromkeys(kinds)
+    left = list(kinds)
+    found = []
+    while left:
+        window, more = [], []
+        for kind in left:
+            owner = None if kind == 'announcement' else user_id
+            if fts:
+                rows = fts_candidates(connection, terms, kind, owner, limit + 1, before[kind])
+            else:
+                rows = memory.candidates(terms, kind, owner, limit + 1, before[kind])
+            if len(rows) > limit:
+                rows = rows[:limit]
+                more.append(kind)
+            if rows:
+                # newest first, so the last key is where the next window starts
+                before[kind] = rows[-1][0]
+            window.extend(rows)
+        left = more
+        if offset >= len(window) and left:
+            offset -= len(window)
+            continue
+        if fts:
+            window = fts_scored(connection, terms, window, current_app.config['SEARCH_MAX_AGE'])
+        window.sort(key=lambda item: (-item[1], -item[0]))
+        found.extend(window[offset:])
+        offset = 0
+        if len(found) > per_page:
+            break
+    found = found[:per_page + 1]
+
+    by_kind = {}
+    for item_key, score in found[:per_page]:
+        kind, id = split_key(item_key)
+        by_kind.setdefault(kind, []).append(id)
+    rows = {kind: load_rows(kind, ids) for kind, ids in by_kind.items()}
+    results = []
+    for item_key, score in found[:per_page]:
+        kind, id = split_key(item_key)
+        row = rows[kind].get(id)
+        if row is None:
+            continue  # deleted since the in-process index last saw it
+        title, body, created_at, ticket_id = row
+        results.append({'kind': kind, 'id': id, 'ticket_id': ticket_id, 'created_at': created_at, 'score': round(score, 4),
+                        'title': highlight(title, terms), 'snippet': snippet(body, terms)})
+    return results, len(found) > per_page
+
+
+def rebuild_search_index():
+    """Rebuild the FTS5 table from the document tables (when this database has FTS5) and drop the in-process index."""
+    with db.engine.begin() as connection:
+        if fts_available(connection):
+            build_fts(connection)
+    memory.expire()
+
+
+@click.command('rebuild-search-index')
+@with_appcontext
+def rebuild_search_index_command():
+    """Rebuild the full-text search index for tickets, replies and announcements."""
+    rebuild_search_index()
+    click.echo('Search index rebuilt.')
@@ -0,0 +1,276 @@
+"""Running aggregates for the admin dashboard.
+
+Every figure on the dashboard is a named counter in the statistic table, so
+the dashboard reads a fixed handful of rows however much data there is:
+
+    room_bookings:<status>, mess_bookings:<status>  bookings per status
+    revenue:room, revenue:mess                       monthly price of approved bookings
+    rooms:count, rooms:beds                          available rooms and their beds
+    tickets:<status>                                 tickets per status
+    tickets:answered, tickets:reply_seconds          tickets with a reply, total time to first reply
+
+ORM writes keep the counters current through mapper events: each change adds
+its deltas to the session, and they are applied with one INSERT ... ON
+CONFLICT DO UPDATE per counter when the session flushes, inside the same
+transaction as the change. Core
+statements bypass those events, so code that changes bookings with bulk
+UPDATEs (pghr.bookings.bulk_set_status) calls add() itself. rebuild_stats()
+recomputes everything from the base tables.
+
+The one figure read from elsewhere is the list of full rooms, whose bookings
+fill or exceed their beds: it compares Room.occupancy (kept by pghr.bookings)
+with Room.size and shows at most FULL_ROOMS_SHOWN of them.
+"""
+from collections import Counter
+from datetime import datetime, timezone
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+from .availability import AVAILABLE
+from .database import db
+from .models import Room, Mess, RoomBookings, MessBookings, Ticket, TicketReplies, Statistic
+
+table = Statistic.__table__
+
+BOOKINGS = {
+    RoomBookings: ('room', Room, RoomBookings.room_id),
+    MessBookings: ('mess', Mess, MessBookings.mess_id),
+}
+
+
+# a counter's first write creates it; ON CONFLICT makes that safe against another transaction creating it too
+UPSERT = db.text('INSERT INTO statistic (name, value) VALUES (:name, :value) '
+                 'ON CONFLICT (name) DO UPDATE SET value = statistic.value + excluded.value')
+
+# full rooms listed on the dashboard, most over capacity first
+FULL_ROOMS_SHOWN = 20
+
+
+def apply(connection, deltas):
+    # in name order, so concurrent transactions lock the rows in the same order
+    rows = [{'name': name, 'value': delta} for name, delta in sorted(deltas.items()) if delta]
+    if rows:
+        connection.execute(UPSERT, rows)
+
+
+def add(deltas):
+    """Apply {name: delta} in the current transaction, for writes made without the ORM."""
+    apply(db.session, deltas)
+
+
+def pending(target):
+    return Session.object_session(target).info.setdefault('stat_deltas', Counter())
+
+
+@event.listens_for(Session, 'after_flush')
+def apply_pending(session, flush_context):
+    deltas = session.info.pop('stat_deltas', None)
+    if deltas:
+        apply(session.connection(), deltas)
+
+
+def previous(target, name):
+    history = inspect(target).attrs[name].history
+    return history.deleted[0] if history.deleted else getattr(target, name)
+
+
+def utc(value):
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def count_bookings(deltas, kind, status, price, sign=1):
+    deltas['%s_bookings:%s' % (kind, status)] += sign
+    if status == 'approved':
+        deltas['revenue:%s' % kind] += sign * price
+
+
+def booking_changes(kind, changes):
+    """Counter deltas for [(old status, new status, monthly price)] of `kind` bookings."""
+    deltas = Counter()
+    for old, new, price in changes:
+        count_bookings(deltas, kind, old, price, -1)
+        count_bookings(deltas, kind, new, price)
+    return deltas
+
+
+def booking_price(connection, model, target):
+    kind, item, item_id = BOOKINGS[model]
+    return connection.execute(select(item.price).where(item.id == getattr(target, item_id.key))).scalar() or 0
+
+
+def watch_booking(model):
+    kind = BOOKINGS[model][0]
+
+    @event.listens_for(model, 'after_insert')
+    def booking_inserted(mapper, connection, target):
+        count_bookings(pending(target), kind, target.status, booking_price(connection, model, target))
+
+    @event.listens_for(model, 'after_update')
+    def booking_updated(mapper, connection, target):
+        old = previous(target, 'status')
+        if old != target.status:
+            pending(target).update(booking_changes(kind, [(old, target.status, booking_price(connection, model, target))]))
+
+    @event.listens_for(model, 'after_delete')
+    def booking_deleted(mapper, connection, target):
+        count_bookings(pending(target), kind, target.status, booking_price(connection, model, target), -1)
+
+
+watch_booking(RoomBookings)
+watch_booking(MessBookings)
+
+
+def count_room(deltas, status, size, sign=1):
+    if status in AVAILABLE:
+        deltas['rooms:count'] += sign
+        deltas['rooms:beds'] += sign * size
+
+
+@event.listens_for(Room, 'after_insert')
+def room_inserted(mapper, connection, target):
+    count_room(pending(target), target.status, target.size)
+
+
+@event.listens_for(Room, 'after_update')
+def room_updated(mapper, connection, target):
+    deltas = pending(target)
+    count_room(deltas, previous(target, 'status'), previous(target, 'size'), -1)
+    count_room(deltas, target.status, target.size)
+    price_changed(connection, RoomBookings, RoomBookings.room_id, target, 'room')
+
+
+@event.listens_for(Room, 'after_delete')
+def room_deleted(mapper, connection, target):
+    count_room(pending(target), target.status, target.size, -1)
+
+
+@event.listens_for(Mess, 'after_update')
+def mess_updated(mapper, connection, target):
+    price_changed(connection, MessBookings, MessBookings.mess_id, target, 'mess')
+
+
+def price_changed(connection, model, item_id, target, kind):
+    old = previous(target, 'price')
+    if old != target.price:
+        approved = connection.execute(select(func.count(model.id)).where(item_id == target.id, model.status == 'approved')).scalar()
+        pending(target)['revenue:%s' % kind] += approved * (target.price - old)
+
+
+@event.listens_for(Ticket, 'after_insert')
+def ticket_inserted(mapper, connection, target):
+    pending(target)['tickets:%s' % target.status] += 1
+
+
+@event.listens_for(Ticket, 'after_update')
+def ticket_updated(mapper, connection, target):
+    old = previous(target, 'status')
+    if old != target.status:
+        deltas = pending(target)
+        deltas['tickets:%s' % old] -= 1
+        deltas['tickets:%s' % target.status] += 1
+
+
+@event.listens_for(Ticket, 'before_delete')
+def ticket_deleted(mapper, connection, target):
+    deltas = pending(target)
+    deltas['tickets:%s' % target.status] -= 1
+    created_at, first_reply_at = connection.execute(select(Ticket.created_at, Ticket.first_reply_at).where(Ticket.id == target.id)).one()
+    if first_reply_at is not None:
+        deltas['tickets:answered'] -= 1
+        deltas['tickets:reply_seconds'] -= int((utc(first_reply_at) - utc(created_at)).total_seconds())
+
+
+@event.listens_for(TicketReplies, 'after_insert')
+def reply_inserted(mapper, connection, target):
+    now = datetime.utcnow()
+    tickets = Ticket.__table__
+    first = connection.execute(tickets.update().where(tickets.c.id == target.ticket_id, tickets.c.first_reply_at == None).values(first_reply_at=now))  # noqa: E711
+    if first.rowcount == 1:
+        created_at = connection.execute(select(tickets.c.created_at).where(tickets.c.id == target.ticket_id)).scalar()
+        deltas = pending(target)
+        deltas['tickets:answered'] += 1
+        deltas['tickets:reply_seconds'] += int((now - utc(created_at)).total_seconds())
+
+
+def backfill_first_replies(connection):
+    """Set Ticket.first_reply_at from replies written without the ORM."""
+    tickets, replies = Ticket.__table__, TicketReplies.__table__
+    first = select(func.min(replies.c.created_at)).where(replies.c.ticket_id == tickets.c.id).scalar_subquery()
+    connection.execute(tickets.update().where(tickets.c.first_reply_at == None).values(first_reply_at=first))  # noqa: E711
+
+
+def compute_stats(connection):
+    """Every counter computed from the base tables."""
+    values = Counter()
+    for model, (kind, item, item_id) in BOOKINGS.items():
+        for status, count in connection.execute(select(model.status, func.count(model.id)).group_by(model.status)):
+            values['%s_bookings:%s' % (kind, status)] = count
+        values['revenue:%s' % kind] = connection.execute(
+            select(func.coalesce(func.sum(item.price), 0)).select_from(model).join(item, item_id == item.id).where(model.status == 'approved')).scalar()
+    values['rooms:count'], values['rooms:beds'] = connection.execute(
+        select(func.count(Room.id), func.coalesce(func.sum(Room.size), 0)).where(Room.status.in_(AVAILABLE))).one()
+    for status, count in connection.execute(select(Ticket.status, func.count(Ticket.id)).group_by(Ticket.status)):
+        values['tickets:%s' % status] = count
+    for created_at, first_reply_at in connection.execute(select(Ticket.created_at, Ticket.first_reply_at).where(Ticket.first_reply_at != None)):  # noqa: E711
+        values['tickets:answered'] += 1
+        values['tickets:reply_seconds'] += int((utc(first_reply_at) - utc(created_at)).total_seconds())
+    return values
+
+
+def store_stats(connection):
+    connection.execute(table.delete())
+    values = compute_stats(connection)
+    if values:
+        connection.execute(table.insert(), [{'name': name, 'value': value} for name, value in values.items()])
+
+
+def rebuild_stats():
+    store_stats(db.session)
+    db.session.commit()
+
+
+def dashboard_stats():
+    """The dashboard figures, from the statistic rows and the list of full rooms."""
+    values = Counter(dict(db.session.query(Statistic.name, Statistic.value)))
+    tickets = {name.split(':', 1)[1]: value for name, value in values.items()
+               if name.startswith('tickets:') and name not in ('tickets:answered', 'tickets:reply_seconds')}
+    beds_held = values['room_bookings:pending'] + values['room_bookings:approved']
+    full_count, rooms = full_rooms()
+    return {
+        'rooms': values['rooms:count'],
+        'beds': values['rooms:beds'],
+        'beds_held': beds_held,
+        'beds_approved': values['room_bookings:approved'],
+        'occupancy': 100.0 * beds_held / values['rooms:beds'] if values['rooms:beds'] else 0.0,
+        'pending_rooms': values['room_bookings:pending'],
+        'pending_mess': values['mess_bookings:pending'],
+        'tickets': tickets,
+        'open_tickets': sum(count for status, count in tickets.items() if status != 'closed'),
+        'closed_tickets': tickets.get('closed', 0),
+        'mean_reply_hours': values['tickets:reply_seconds'] / 3600.0 / values['tickets:answered'] if values['tickets:answered'] else None,
+        'revenue_room': values['revenue:room'],
+        'revenue_mess': values['revenue:mess'],
+        'revenue': values['revenue:room'] + values['revenue:mess'],
+        'full_room_count': full_count,
+        'full_rooms': rooms,
+    }
+
+
+def full_rooms(limit=FULL_ROOMS_SHOWN):
+    """(count, [(name, occupancy, size)]) of rooms held by at least as many bookings as they have beds."""
+    full = Room.occupancy >= Room.size
+    count = db.session.query(func.count(Room.id)).filter(full).scalar()
+    rooms = db.session.query(Room.name, Room.occupancy, Room.size).filter(full) \
+        .order_by((Room.occupancy - Room.size).desc(), Room.name).limit(limit).all()
+    return count, rooms
+
+
+@click.command('rebuild-stats')
+@with_appcontext
+def rebuild_stats_command():
+    """Recompute the admin dashboard statistics from the base tables."""
+    rebuild_stats()
+    click.echo('Dashboard statistics rebuilt.')
@@ -0,0 +1,564 @@
+"""Bulk export and import of rooms, users, bookings and tickets.
+
+export_rows() streams one table as CSV or JSON lines, in id order. Rows are
+read through a server-side cursor CHUNK at a time and written out as they
+arrive, so memory stays flat however large the table is. The admin Data
+page and `flask export-data` both use it.
+
+import_rows() loads the same formats a batch of CHUNK rows at a time. Each
+batch takes the table's write lock, checks every row's types, lengths and
+required fields, then checks the batch's unique and foreign-key values with
+one IN query per column, and inserts the rows that pass with one
+executemany. Every batch commits, so an interrupted import can simply be
+run again: rows whose ids were already loaded are rejected as duplicates
+the second time. Rejected rows are reported with their line number and the
+reason; `flask import-data` writes them to an error file in the input's
+format, which can be corrected and imported again.
+
+The inserts bypass the ORM, so each batch does what the mapper events do
+for single writes: dashboard counters, room occupancy, the room and search
+indexes, the event history and the page cache are updated in the same
+transaction. Pending and
+approved room bookings are refused when their room has no bed free on some
+day of the stay, as pghr.bookings would refuse them.
+
+Password hashes are left out of user exports unless asked for. An imported
+password may be a werkzeug hash, stored as it is, or a plain password,
+hashed with PASSWORD_HASH_METHOD. Hashing is slow on purpose, so only
+`flask import-data` accepts plain passwords; uploads through the Data page
+must carry hashes.
+"""
+import csv
+import hashlib
+import io
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import Boolean, Date, DateTime, Integer, bindparam, false, func, or_, select, text, update
+from werkzeug.security import generate_password_hash
+from . import events, stats
+from .availability import room_changed
+from .billing import existing_ids
+from .caching import tags_changed
+from .database import db
+from .models import User, Room, RoomBookings, MessBookings, Ticket
+from .reservations import HOLDING_STATUSES, StayTree, day_number, stay_days
+from .search import documents_added
+
+# rows per batch, and per fetch while exporting
+CHUNK = 1000
+
+FORMATS = {'csv': 'text/csv; charset=utf-8', 'jsonl': 'application/x-ndjson'}
+
+TABLES = {
+    'rooms': (Room, ('id', 'name', 'size', 'attached_bathroom', 'status', 'price', 'description')),
+    'users': (User, ('id', 'username', 'email', 'admin', 'created_at', 'password')),
+    'room_bookings': (RoomBookings, ('id', 'user_id', 'room_id', 'status', 'check_in', 'check_out', 'starts_on', 'ends_on')),
+    'mess_bookings': (MessBookings, ('id', 'user_id', 'mess_id', 'status', 'check_in', 'check_out')),
+    'tickets': (Ticket, ('id', 'user_id', 'title', 'description', 'created_at', 'status')),
+}
+
+BOOKING_STATUSES = HOLDING_STATUSES + ('cancelled',)
+BOOLEANS = {'true': True, 'false': False, '1': True, '0': False, 'yes': True, 'no': False}
+
+
+class TransferError(Exception):
+    pass
+
+
+def table_fields(name):
+    if name not in TABLES:
+        raise TransferError('table must be one of: %s' % ', '.join(TABLES))
+    return TABLES[name]
+
+
+def check_format(format):
+    if format not in FORMATS:
+        raise TransferError('format must be one of: %s' % ', '.join(FORMATS))
+    return format
+
+
+def format_of(path, default='csv'):
+    """The format a file name implies: .csv, or .jsonl / .ndjson for JSON lines."""
+    extension = os.path.splitext(path or '')[1].lower()
+    return {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}.get(extension, default)
+
+
+# export
+
+def exported_fields(fields, passwords=False):
+    return tuple(field for field in fields if passwords or field != 'password')
+
+
+def csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def json_default(value):
+    # only called for values json cannot write itself
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError('cannot export %r' % value)
+
+
+def export_rows(name, format, passwords=False):
+    """Yield table `name` as CSV or JSON lines text, CHUNK rows at a time, in id order."""
+    model, fields = table_fields(name)
+    check_format(format)
+    fields = exported_fields(fields, passwords)
+    table = model.__table__
+    query = select(*[table.c[field] for field in fields]).order_by(table.c.id)
+    result = db.session.execute(query.execution_options(stream_results=True, max_row_buffer=CHUNK))
+    if format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(fields)
+        for rows in result.partitions(CHUNK):
+            writer.writerows([csv_value(value) for value in row] for row in rows)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            # an empty table is just the header
+            yield buffer.getvalue()
+    else:
+        encode = json.JSONEncoder(default=json_default).encode
+        for rows in result.partitions(CHUNK):
+            yield ''.join(encode(dict(zip(fields, row))) + '\n' for row in rows)
+
+
+# import: reading and checking rows
+
+def read_rows(stream, format):
+    """(line number, row dict) for each record of a text stream; a record that cannot be read comes as a TransferError.
+
+    CSV that cannot be parsed past some point raises TransferError instead.
+    """
+    if check_format(format) == 'csv':
+        reader = csv.DictReader(stream)
+        try:
+            for row in reader:
+                # values beyond the header row are filed under None
+                row.pop(None, None)
+                yield reader.line_num, row
+        except csv.Error as error:
+            # a NUL byte, broken quoting or an oversized field: the records after it cannot be told apart
+            raise TransferError('the CSV cannot be read after line %d (%s)' % (reader.line_num, error))
+        return
+    for line, record in enumerate(stream, 1):
+        if not record.strip():
+            continue
+        try:
+            row = json.loads(record)
+        except ValueError:
+            row = TransferError('not a valid JSON line')
+        if not isinstance(row, (dict, TransferError)):
+            row = TransferError('a line must hold one JSON object')
+        yield line, row
+
+
+def type_name(kind):
+    if isinstance(kind, Boolean):
+        return 'true or false'
+    if isinstance(kind, Integer):
+        return 'a whole number'
+    if isinstance(kind, DateTime):
+        return 'a date and time as YYYY-MM-DD HH:MM:SS'
+    if isinstance(kind, Date):
+        return 'a date as YYYY-MM-DD'
+    return 'text'
+
+
+def parse_value(column, value):
+    """A CSV or JSON value as the column's Python type; None when empty."""
+    if value is None or isinstance(value, str) and not value.strip():
+        return None
+    kind = column.type
+    try:
+        if isinstance(value, (dict, list)):
+            raise TypeError(value)
+        if isinstance(kind, Boolean):
+            return value if isinstance(value, bool) else BOOLEANS[str(value).strip().lower()]
+        if isinstance(kind, Integer):
+            if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+                raise ValueError(value)
+            return int(value)
+        if isinstance(kind, DateTime):
+            return stats.utc(datetime.fromisoformat(str(value).strip()))
+        if isinstance(kind, Date):
+            return date.fromisoformat(str(value).strip())
+    except (KeyError, TypeError, ValueError):
+        raise TransferError('%s must be %s' % (column.key, type_name(kind)))
+    value = str(value)
+    if kind.length and len(value) > kind.length:
+        raise TransferError('%s is longer than %d characters' % (column.key, kind.length))
+    return value
+
+
+def default(column, now):
+    """The value a column gets when a row leaves it empty."""
+    if column.default is not None:
+        return column.default.arg(None) if column.default.is_callable else column.default.arg
+    if column.server_default is not None and isinstance(column.type, DateTime):
+        return now
+    return None
+
+
+def is_hash(password):
+    method = password.split('$', 1)[0]
+    return password.count('$') == 2 and (method.startswith(('pbkdf2:', 'scrypt')) or method in hashlib.algorithms_guaranteed)
+
+
+def check_room(values):
+    if values['size'] < 1:
+        raise TransferError('size must be at least 1')
+    if values['price'] < 0:
+        raise TransferError('price cannot be negative')
+
+
+def check_user(values):
+    if '@' not in values['email']:
+        raise TransferError('email must be an email address')
+    if not is_hash(values['password']) and len(values['password']) < 8:
+        raise TransferError('password must be a password hash or at least 8 characters')
+
+
+def check_booking(values):
+    if values['status'] not in BOOKING_STATUSES:
+        raise TransferError('status must be one of: %s' % ', '.join(BOOKING_STATUSES))
+    if values.get('ends_on') is not None and values['ends_on'] <= values['starts_on']:
+        raise TransferError('a stay must end after it starts')
+
+
+CHECKS = {Room: check_room, User: check_user, RoomBookings: check_booking, MessBookings: check_booking}
+
+
+def check_row(model, fields, row, now):
+    """The row's values as column types, or TransferError for its first problem."""
+    if isinstance(row, TransferError):
+        raise row
+    columns = model.__table__.c
+    values = {}
+    for name in fields:
+        column = columns[name]
+        value = parse_value(column, row.get(name))
+        if value is None:
+            value = default(column, now)
+        if value is None and not column.nullable and not column.primary_key:
+            raise TransferError('%s is required' % name)
+        values[name] = value
+    if model in CHECKS:
+        CHECKS[model](values)
+    return values
+
+
+def sift(checked, errors, reason):
+    """Keep the (line, row, values) for which reason(values) is None; refuse the others."""
+    kept = []
+    for line, row, values in checked:
+        message = reason(values)
+        if message:
+            errors.append((line, row, message))
+        else:
+            kept.append((line, row, values))
+    return kept
+
+
+def unique_columns(table):
+    columns = [column for column in table.columns if column.primary_key or column.unique]
+    columns += [list(index.columns)[0] for index in table.indexes if index.unique and len(index.columns) == 1]
+    return columns
+
+
+def check_unique(table, checked, errors):
+    """Refuse values the table already has, or that an earlier row of the batch has."""
+    for column in unique_columns(table):
+        name = column.key
+        taken = existing_ids(column, {values[name] for _, _, values in checked if values[name] is not None})
+        seen = set()
+
+        def duplicate(values):
+            value = values[name]
+            if value is None:
+                return None
+            if value in taken or value in seen:
+                return '%s %s is already taken' % (name, value)
+            seen.add(value)
+
+        checked = sift(checked, errors, duplicate)
+    return checked
+
+
+def check_references(table, checked, errors):
+    for column in table.columns:
+        for foreign_key in column.foreign_keys:
+            target = foreign_key.column
+            found = existing_ids(target, {values[column.key] for _, _, values in checked})
+            checked = sift(checked, errors, lambda values: None if values[column.key] in found
+                           else 'no such %s %s' % (target.table.name, values[column.key]))
+    return checked
+
+
+def check_beds(checked, errors):
+    """Refuse pending and approved room bookings whose room has no bed free on some day of the stay."""
+    room_ids = {values['room_id'] for _, _, values in checked if values['status'] in HOLDING_STATUSES}
+    if not room_ids:
+        return checked
+    # like claim_bed, lock the rooms' rows before reading their bookings
+    db.session.execute(update(Room).where(Room.id.in_(room_ids)).values(occupancy=Room.occupancy).execution_options(synchronize_session=False))
+    sizes = dict(db.session.query(Room.id, Room.size).filter(Room.id.in_(room_ids)))
+    today = date.today()
+    # days already past cannot be double-booked any more, so stays that ended are left out
+    held = db.session.query(RoomBookings.room_id, RoomBookings.starts_on, RoomBookings.ends_on, func.count(RoomBookings.id)) \
+        .filter(RoomBookings.room_id.in_(room_ids), RoomBookings.status.in_(HOLDING_STATUSES),
+                or_(RoomBookings.ends_on == None, RoomBookings.ends_on > today)) \
+        .group_by(RoomBookings.room_id, RoomBookings.starts_on, RoomBookings.ends_on).all()  # noqa: E711
+    booked = Counter(values['room_id'] for _, _, values in checked if values['status'] in HOLDING_STATUSES)
+    for room_id, _, _, count in held:
+        booked[room_id] += count
+    # a room with no more bookings than beds has a bed free every day; only the others are checked day by day
+    trees = {room_id: StayTree() for room_id in room_ids if booked[room_id] > sizes[room_id]}
+    for room_id, starts_on, ends_on, count in held:
+        if room_id in trees:
+            trees[room_id].update(*stay_days(starts_on, ends_on), count)
+    first = day_number(today)
+
+    def full(values):
+        room_id = values['room_id']
+        if values['status'] not in HOLDING_STATUSES or room_id not in trees:
+            return None
+        start, end = stay_days(values['starts_on'], values['ends_on'])
+        if max(start, first) < end and trees[room_id].peak(max(start, first), end) >= sizes[room_id]:
+            return 'room %d has no free bed for those dates' % room_id
+        trees[room_id].update(start, end, 1)
+
+    return sift(checked, errors, full)
+
+
+# import: writing rows
+
+def quoted(table):
+    return db.engine.dialect.identifier_preparer.format_table(table)
+
+
+def lock_table(table):
+    """Hold the table's write lock until the commit, so what a batch checked stays true for its insert."""
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text('LOCK TABLE %s IN SHARE ROW EXCLUSIVE MODE' % quoted(table)))
+    else:
+        # SQLite takes its lock at the first write; this one changes nothing
+        db.session.execute(table.update().where(false()).values(id=table.c.id))
+
+
+def assign_ids(table, rows):
+    """Give rows without an id the next free ones; the table is locked, so nobody else takes them."""
+    missing = [values for values in rows if values['id'] is None]
+    if not missing:
+        return
+    top = max([db.session.query(func.max(table.c.id)).scalar() or 0] + [values['id'] for values in rows if values['id'] is not None])
+    for id, values in enumerate(missing, top + 1):
+        values['id'] = id
+
+
+def sync_sequence(table):
+    # explicit ids leave a PostgreSQL sequence behind; move it past them
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(text("SELECT setval(pg_get_serial_sequence(:table, 'id'), (SELECT max(id) FROM %s))" % quoted(table)),
+                           {'table': quoted(table)})
+
+
+def hash_passwords(rows):
+    plain = [values for values in rows if not is_hash(values['password'])]
+    if not plain:
+        return
+    method = current_app.config['PASSWORD_HASH_METHOD']
+    with ThreadPoolExecutor(current_app.config['PASSWORD_HASH_WORKERS']) as pool:
+        hashes = pool.map(lambda password: generate_password_hash(password, method), [values['password'] for values in plain])
+        for values, password in zip(plain, hashes):
+            values['password'] = password
+
+
+def inserted(model, rows):
+    """Do for rows inserted without the ORM what the mapper events would have done."""
+    deltas = Counter()
+    if model is Room:
+        for values in rows:
+            stats.count_room(deltas, values['status'], values['size'])
+        room_changed(*[values['id'] for values in rows])
+        tags_changed(db.session, 'room')
+    elif model in stats.BOOKINGS:
+        kind, item, item_id = stats.BOOKINGS[model]
+        prices = dict(db.session.query(item.id, item.price).filter(item.id.in_({values[item_id.key] for values in rows})))
+        for values in rows:
+            stats.count_bookings(deltas, kind, values['status'], prices[values[item_id.key]])
+        if model is RoomBookings:
+            held = Counter(values['room_id'] for values in rows if values['status'] in HOLDING_STATUSES)
+            if held:
+                rooms = Room.__table__
+                db.session.execute(rooms.update().where(rooms.c.id == bindparam('room')).values(occupancy=rooms.c.occupancy + bindparam('beds')),
+                                   [{'room': room_id, 'beds': beds} for room_id, beds in held.items()])
+                room_changed(*held)
+    elif model is Ticket:
+        deltas.update('tickets:%s' % values['status'] for values in rows)
+        documents_added('ticket', [values['id'] for values in rows])
+    stats.add(deltas)
+    if model in events.ENTITIES:
+        # imported rows enter the history as they are, at the time they were made when the file says
+        entity, item_id = events.ENTITIES[model]
+        created = 'created_at' if model is Ticket else 'check_in'
+        events.add([events.entry(model, 'snapshot', values['id'], values['user_id'], values['status'],
+                                 item_id=values[item_id.key] if item_id is not None else None, at=values.get(created))
+                    for values in rows])
+
+
+def import_batch(model, fields, batch, errors, plain_passwords=True):
+    """Check and insert one batch of (line, row); (line, row, reason) of refused rows go to `errors`. Returns the rows inserted."""
+    table = model.__table__
+    lock_table(table)
+    now = datetime.utcnow()
+    checked = []
+    for line, row in batch:
+        try:
+            checked.append((line, row, check_row(model, fields, row, now)))
+        except TransferError as error:
+            errors.append((line, row, str(error)))
+    checked = check_unique(table, checked, errors)
+    checked = check_references(table, checked, errors)
+    if model is RoomBookings:
+        checked = check_beds(checked, errors)
+    if model is User and not plain_passwords:
+        checked = sift(checked, errors, lambda values: None if is_hash(values['password']) else
+                       'password must be a password hash; import plain passwords with flask import-data')
+    rows = [values for _, _, values in checked]
+    if not rows:
+        return 0
+    if model is User:
+        hash_passwords(rows)
+    assign_ids(table, rows)
+    db.session.execute(table.insert(), rows)
+    sync_sequence(table)
+    inserted(model, rows)
+    return len(rows)
+
+
+def import_rows(name, rows, rejected=None, progress=None, plain_passwords=True):
+    """Load (line, row) pairs into table `name`, committing every CHUNK rows.
+
+    rejected(line, row, reason) is called for each row that is not loaded,
+    and progress(report) after each batch. Returns the report:
+    {"rows": read, "imported": n, "rejected": n}. With plain_passwords off,
+    users whose password is not already a hash are rejected.
+    """
+    model, fields = table_fields(name)
+    report = {'rows': 0, 'imported': 0, 'rejected': 0}
+    rows = iter(rows)
+    while True:
+        batch = [row for _, row in zip(range(CHUNK), rows)]
+        if not batch:
+            break
+        errors = []
+        try:
+            imported = import_batch(model, fields, batch, errors, plain_passwords)
+            db.session.commit()
+        except BaseException:
+            db.session.rollback()
+            raise
+        report['rows'] += len(batch)
+        report['imported'] += imported
+        report['rejected'] += len(errors)
+        if rejected is not None:
+            for line, row, reason in sorted(errors, key=lambda error: error[0]):
+                rejected(line, row, reason)
+        if progress is not None:
+            progress(report)
+    return report
+
+
+class ErrorFile():
+    """Rejected rows with their line and reason, in the import's format; the file is created on the first one."""
+    def __init__(self, path, format, fields):
+        self.path = path
+        self.format = format
+        self.fields = fields
+        self.stream = None
+        self.writer = None
+
+    def write(self, line, row, reason):
+        if self.stream is None:
+            self.stream = open(self.path, 'w', encoding='utf-8', newline='')
+            if self.format == 'csv':
+                self.writer = csv.DictWriter(self.stream, ('line', 'error') + self.fields, extrasaction='ignore', lineterminator='\n')
+                self.writer.writeheader()
+        record = dict(row if isinstance(row, dict) else {}, line=line, error=reason)
+        if self.writer is not None:
+            self.writer.writerow(record)
+        else:
+            self.stream.write(json.dumps(record, default=str) + '\n')
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@click.command('export-data')
+@click.argument('table', type=click.Choice(list(TABLES)))
+@click.option('--output', '-o', default='-', help='File to write, standard output by default.')
+@click.option('--format', 'format', type=click.Choice(list(FORMATS)), default=None, help='Taken from the output file name by default.')
+@click.option('--passwords', is_flag=True, help="Include users' password hashes.")
+@with_appcontext
+def export_data_command(table, output, format, passwords):
+    """Write a table as CSV or JSON lines."""
+    format = format or format_of(output)
+    with click.open_file(output, 'w', encoding='utf-8') as stream:
+        for chunk in export_rows(table, format, passwords):
+            stream.write(chunk)
+
+
+@click.command('import-data')
+@click.argument('table', type=click.Choice(list(TABLES)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'format', type=click.Choice(list(FORMATS)), default=None, help='Taken from the file name by default.')
+@click.option('--errors', 'errors_path', default=None, help='File for the rejected rows, PATH with .errors before the extension by default.')
+@with_appcontext
+def import_data_command(table, path, format, errors_path):
+    """Load a CSV or JSON lines file into a table."""
+    format = format or format_of(path)
+    root, extension = os.path.splitext(path)
+    errors_path = errors_path or '%s.errors%s' % (root, extension or '.' + format)
+    started = shown = time.monotonic()
+
+    def progress(report):
+        nonlocal shown
+        now = time.monotonic()
+        if now - shown >= 1:
+            shown = now
+            click.echo('%d rows read, %d imported, %d rejected (%.0f rows/s)' % (
+                report['rows'], report['imported'], report['rejected'], report['rows'] / (now - started)), err=True)
+
+    with open(path, encoding='utf-8', newline='') as stream, ErrorFile(errors_path, format, TABLES[table][1]) as errors:
+        try:
+            report = import_rows(table, read_rows(stream, format), errors.write, progress)
+        except (TransferError, UnicodeDecodeError) as error:
+            raise click.ClickException('%s; the batches before it were imported.' % error)
+    click.echo('%s: %d rows, %d imported, %d rejected in %.1fs.' % (
+        table, report['rows'], report['imported'], report['rejected'], time.monotonic() - started))
+    if report['rejected']:
+        click.echo('Rejected rows are in %s.' % errors_path)
@@ -0,0 +1,7 @@
+"""WSGI entry point for production servers.
+
+    PGHR_CONFIG=production gunicorn -c gunicorn.conf.py wsgi:application
+"""
+from pghr import create_app
+
+application = create_app()